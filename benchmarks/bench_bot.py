@@ -0,0 +1,316 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+End to end benchmark of the bot handlers, fully offline.
+
+The TPL FVG APIs are replaced by the fake server in `fake_tplfvg.py` and the
+Telegram Bot API by an in-process transport returning canned responses, so
+only the bot's own work (and the configured fake latency) is measured.
+Synthetic updates are fed to `Application.process_update` and the latency of
+each one is reported per scenario, along with the throughput.
+
+  python benchmarks/bench_bot.py --updates 2000 --concurrency 50 --latency 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+from fake_tplfvg import FIXTURES_DIR, FakeTPLFVG, load_fixture
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "TPL FVG Monitor", "username": "tplfvg_bench_bot"}
+
+class FakeBotAPI(BaseRequest):
+  """
+  Bot API transport answering every method successfully without any I/O.
+  Sent messages are echoed back with increasing ids; calls are counted by
+  method.
+  """
+
+  def __init__(self):
+    self.message_id = 0
+    self.calls = {}
+
+  async def initialize(self):
+    pass
+
+  async def shutdown(self):
+    pass
+
+  @property
+  def read_timeout(self):
+    return None
+
+  async def do_request(self, url: str, method: str, request_data: RequestData = None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+    endpoint = url.rsplit("/", 1)[-1]
+    self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+    parameters = request_data.parameters if request_data else {}
+    if endpoint == "getMe":
+      result = BOT_USER
+    elif endpoint == "sendMessage" or (endpoint.startswith("editMessage") and "chat_id" in parameters):
+      self.message_id += 1
+      result = {
+        "message_id": parameters.get("message_id", self.message_id),
+        "date": int(time.time()),
+        "chat": {"id": parameters["chat_id"], "type": "private"},
+        "from": BOT_USER,
+        "text": parameters.get("text", "")
+      }
+    else:
+      result = True
+    return 200, json.dumps({"ok": True, "result": result}).encode()
+
+class Updates:
+  """
+  Factory of synthetic updates from distinct users, built from the fixtures.
+  """
+
+  def __init__(self, bot, sessions):
+    self.bot = bot
+    self.sessions = sessions
+    self.update_id = 0
+    stops = load_fixture("all_stops.json")["features"]
+    self.codes = [feature["properties"]["code"] for feature in stops]
+    self.names = [feature["properties"]["name"] for feature in stops]
+    self.points = [feature["geometry"]["coordinates"] for feature in stops]
+    self.runs = load_fixture("mrcruns.json")
+
+  def next_ids(self):
+    self.update_id += 1
+    return self.update_id, 100000 + self.update_id
+
+  def user(self, user_id: int):
+    return {"id": user_id, "is_bot": False, "first_name": "Bench", "language_code": "it"}
+
+  def message(self, **fields):
+    update_id, user_id = self.next_ids()
+    return Update.de_json({
+      "update_id": update_id,
+      "message": {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": self.user(user_id),
+        **fields
+      }
+    }, self.bot)
+
+  def callback(self, data: str):
+    update_id, user_id = self.next_ids()
+    return Update.de_json({
+      "update_id": update_id,
+      "callback_query": {
+        "id": str(update_id),
+        "chat_instance": str(user_id),
+        "from": self.user(user_id),
+        "data": data,
+        "message": {
+          "message_id": update_id,
+          "date": int(time.time()),
+          "chat": {"id": user_id, "type": "private"},
+          "from": BOT_USER,
+          "text": "Monitor"
+        }
+      }
+    }, self.bot)
+
+  def stop_code(self):
+    code = random.choice(self.codes)
+    return self.message(text=f"/{code}", entities=[{"type": "bot_command", "offset": 0, "length": len(code) + 1}])
+
+  def stop_name(self):
+    return self.message(text=random.choice(self.names).split(" ")[-1])
+
+  def location(self):
+    lng, lat = random.choice(self.points)
+    return self.message(location={"latitude": lat, "longitude": lng})
+
+  def nearby(self):
+    lng, lat = random.choice(self.points)
+    return self.callback(f"nearby+{lat:.5f}+{lng:.5f}")
+
+  def fav(self):
+    return self.callback(f"fav+stop+{random.choice(self.codes)}")
+
+  def show_route(self):
+    return self.callback(f"showroute+stop+{random.choice(self.codes)}")
+
+  def route(self):
+    r = random.choice(self.runs)
+    return self.callback(
+      f"showroute+route+{r['Line']}|{r['LineCode']}|{r['Direction']}|{r['Race']}|{random.choice(self.codes)}|{r['ArrivalTime']}"
+    )
+
+  def dashboard(self):
+    update = self.message(text="/dashboard", entities=[{"type": "bot_command", "offset": 0, "length": 10}])
+    self.sessions.upsert(update.effective_user.id, {
+      "fav_stops": {code: f"Preferita {code}" for code in random.sample(self.codes, 8)}
+    })
+    return update
+
+  def zone(self):
+    return self.callback(f"zone+{random.choice('GMPTU')}")
+
+  def inline(self):
+    update_id, user_id = self.next_ids()
+    name = random.choice(self.names)
+    return Update.de_json({
+      "update_id": update_id,
+      "inline_query": {
+        "id": str(update_id),
+        "from": self.user(user_id),
+        "query": name[:random.randint(2, len(name))],
+        "offset": ""
+      }
+    }, self.bot)
+
+  def inline_chosen(self):
+    update_id, user_id = self.next_ids()
+    return Update.de_json({
+      "update_id": update_id,
+      "chosen_inline_result": {
+        "result_id": random.choice(self.codes),
+        "from": self.user(user_id),
+        "query": "",
+        "inline_message_id": str(update_id)
+      }
+    }, self.bot)
+
+SCENARIOS = ["stop_code", "stop_name", "location", "nearby", "fav", "show_route", "route", "dashboard", "zone", "inline", "inline_chosen"]
+
+# Exceptions raised by the handlers, counted by the error handler
+errors = []
+
+async def count_error(update: object, context):
+  errors.append(context.error)
+
+async def run_scenario(app, make_update, count: int, concurrency: int):
+  semaphore = asyncio.Semaphore(concurrency)
+  latencies = []
+  errors.clear()
+
+  async def process(update):
+    async with semaphore:
+      start = time.perf_counter()
+      await app.process_update(update)
+      latencies.append(time.perf_counter() - start)
+
+  updates = [make_update() for _ in range(count)]
+  start = time.perf_counter()
+  await asyncio.gather(*[process(update) for update in updates])
+  elapsed = time.perf_counter() - start
+  latencies.sort()
+  return {
+    "p50": statistics.median(latencies),
+    "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+    "rate": count / elapsed,
+    "errors": len(errors)
+  }
+
+async def main(args):
+  import bot
+  from tplfvg_rt_python_api import metrics
+
+  transport = FakeBotAPI()
+  app = bot.build_application(os.environ["TELEGRAM_BOT_API_KEY"], request=transport)
+  app.add_error_handler(count_error, block=True)
+  await app.initialize()
+  # Running, so that tasks created by handlers (e.g. debounced inline answers)
+  # are awaited when stopping
+  await app.start()
+  await bot.startup(app)
+  updates = Updates(app.bot, bot.sessions)
+
+  print(f"{'scenario':<12} {'updates':>8} {'p50 ms':>8} {'p99 ms':>8} {'upd/s':>9} {'errors':>7}")
+  try:
+    for scenario in args.scenarios:
+      make_update = getattr(updates, scenario)
+      # Warm up caches and connections, as a long running bot would be
+      await run_scenario(app, make_update, min(args.updates, args.concurrency), args.concurrency)
+      result = await run_scenario(app, make_update, args.updates, args.concurrency)
+      print(
+        f"{scenario:<12} {args.updates:>8} {result['p50'] * 1000:>8.2f} {result['p99'] * 1000:>8.2f} " + \
+          f"{result['rate']:>9.0f} {result['errors']:>7}"
+      )
+  finally:
+    await app.stop()
+    await bot.shutdown(app)
+    await app.shutdown()
+
+  if args.verbose:
+    print()
+    for error in {repr(error) for error in errors}:
+      print(f"Last scenario error: {error}")
+    for line in metrics.format_summary():
+      print(line)
+    print(f"Bot API calls: {transport.calls}")
+    if app.bot.rate_limiter:
+      print(f"Send scheduler: {app.bot.rate_limiter.stats()}")
+    print(f"Cache warmer: {bot.warmer.stats()}")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark the bot handlers against local stand-ins.")
+  parser.add_argument("--updates", type=int, default=500, help="updates per scenario")
+  parser.add_argument("--concurrency", type=int, default=20, help="updates processed at the same time")
+  parser.add_argument("--latency", type=float, default=0.0, help="fake API latency in seconds")
+  parser.add_argument("--jitter", type=float, default=0.0, help="fake API latency jitter in seconds")
+  parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake API requests failing")
+  parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--verbose", action="store_true", help="also print upstream and cache metrics")
+  args = parser.parse_args()
+  random.seed(args.seed)
+
+  server = FakeTPLFVG(("127.0.0.1", 0), args.latency, args.jitter, args.error_rate)
+  server.start()
+
+  # The bot loads its local dataset and sessions from the working directory
+  workdir = tempfile.mkdtemp(prefix="tplfvg-bench-")
+  local_dir = os.path.join(workdir, "tplfvg_rt_python_api", "local")
+  os.makedirs(local_dir)
+  for name in ["all_stops.json", "lines_by_stop.json"]:
+    shutil.copy(os.path.join(FIXTURES_DIR, name), local_dir)
+  os.chdir(workdir)
+
+  os.environ.update({
+    "TELEGRAM_BOT_API_KEY": "123456:bench",
+    "TPLFVG_API_URL": f"{server.url}/services/bus-stops/",
+    "TPLFVG_RT_API_URL": f"{server.url}/API/v1.0/",
+    "TPLFVG_ROUTE_CACHE_FILE": "",
+    "TPLFVG_WARMER_FILE": "",
+    "TPLFVG_SESSIONS_DB": os.path.join(workdir, "storage.sqlite"),
+    # Keep the outbound scheduler in the path without throttling the fake API
+    "TPLFVG_RATE_LIMIT_GLOBAL": "1000000",
+    "TPLFVG_RATE_LIMIT_CHAT": "1000000"
+  })
+  try:
+    asyncio.run(main(args))
+  finally:
+    server.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
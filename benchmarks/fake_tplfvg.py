@@ -0,0 +1,196 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Local stand-in for the TPL FVG bus stop and realtime APIs, serving responses
+built from the fixtures in `benchmarks/fixtures`.
+
+Point the bot at it with:
+
+  TPLFVG_API_URL=http://127.0.0.1:8765/services/bus-stops/
+  TPLFVG_RT_API_URL=http://127.0.0.1:8765/API/v1.0/
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import threading
+import time
+import unicodedata
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def load_fixture(name: str):
+  with open(os.path.join(FIXTURES_DIR, name), "r") as f:
+    return json.loads(f.read())
+
+def fold(text: str) -> str:
+  text = unicodedata.normalize("NFKD", text)
+  return "".join(c for c in text if not unicodedata.combining(c)).lower()
+
+class Fixtures:
+  def __init__(self):
+    self.stops = load_fixture("all_stops.json")
+    # Scheduled times are recorded on some past day, move them to today
+    today = datetime.date.today().isoformat()
+    self.monitor = [{
+      **run,
+      "DepartureTime": today + run["DepartureTime"][10:],
+      "ArrivalTime": today + run["ArrivalTime"][10:] if run["ArrivalTime"][4:5] == "-" else run["ArrivalTime"]
+    } for run in load_fixture("mrcruns.json")]
+    self.info = load_fixture("info.json")
+    self.timetable = load_fixture("getlinetimetable.json")
+    self.stops_by_code = {
+      feature["properties"]["code"]: feature for feature in self.stops["features"]
+    }
+
+  def stop_info(self, stop_code: str):
+    stop = self.stops_by_code.get(stop_code)
+    if stop is None:
+      return None
+    return {
+      **self.info,
+      "Address": stop["properties"]["name"],
+      "StopCode": stop_code,
+      "Latitude": stop["geometry"]["coordinates"][1],
+      "Longitude": stop["geometry"]["coordinates"][0]
+    }
+
+  def stops_by_keyword(self, query: str):
+    query = fold(query)
+    return {"results": [{
+      "id": feature["properties"]["code"],
+      "text": feature["properties"]["name"]
+    } for feature in self.stops["features"] if query in fold(feature["properties"]["name"])]}
+
+  def stops_in_polygon(self, polygon: dict):
+    points = polygon["geometry"]["coordinates"][0]
+    lats = [p[1] for p in points]
+    lngs = [p[0] for p in points]
+    return {"type": "FeatureCollection", "features": [
+      feature for feature in self.stops["features"]
+        if min(lats) <= feature["geometry"]["coordinates"][1] <= max(lats) and \
+          min(lngs) <= feature["geometry"]["coordinates"][0] <= max(lngs)
+    ]}
+
+class FakeTPLFVG(ThreadingHTTPServer):
+  """
+  HTTP server answering like the TPL FVG APIs. Each response is delayed by
+  `latency` seconds, plus up to `jitter` seconds, and a fraction `error_rate`
+  of the requests fail with a 503. Served requests are counted by endpoint.
+  """
+  daemon_threads = True
+
+  def __init__(self, address: tuple[str, int], latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+    super().__init__(address, Handler)
+    self.fixtures = Fixtures()
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+    self.counts = {}
+    self.lock = threading.Lock()
+
+  @property
+  def url(self) -> str:
+    host, port = self.server_address[:2]
+    return f"http://{host}:{port}"
+
+  def count(self, endpoint: str):
+    with self.lock:
+      self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+  def start(self) -> threading.Thread:
+    """
+    Serve in a background thread.
+    """
+    thread = threading.Thread(target=self.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  server: FakeTPLFVG
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    self.handle_api()
+
+  def do_POST(self):
+    self.handle_api()
+
+  def read_body(self) -> str:
+    length = int(self.headers.get("Content-Length") or 0)
+    return self.rfile.read(length).decode() if length else ""
+
+  def reply(self, status: int, body):
+    payload = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def handle_api(self):
+    url = urlsplit(self.path)
+    endpoint = url.path.strip("/")
+    params = {k: v[0] for k, v in parse_qs(url.query).items()}
+    body = self.read_body()
+    self.server.count(endpoint)
+
+    delay = self.server.latency + random.uniform(0, self.server.jitter)
+    if delay:
+      time.sleep(delay)
+    if self.server.error_rate and random.random() < self.server.error_rate:
+      return self.reply(503, {"error": "injected failure"})
+
+    fixtures = self.server.fixtures
+    if endpoint == "API/v1.0/polemonitor/mrcruns":
+      if params.get("StopCode") not in fixtures.stops_by_code:
+        return self.reply(200, [])
+      return self.reply(200, fixtures.monitor)
+    if endpoint == "API/v1.0/polemonitor/info":
+      return self.reply(200, fixtures.stop_info(params.get("StopCode")))
+    if endpoint == "API/v1.0/polemonitor/getlinetimetable":
+      return self.reply(200, fixtures.timetable)
+    if endpoint == "services/bus-stops/keyword":
+      return self.reply(200, fixtures.stops_by_keyword(parse_qs(body).get("query", [""])[0]))
+    if endpoint == "services/bus-stops/polygon":
+      return self.reply(200, fixtures.stops_in_polygon(json.loads(body)))
+    if endpoint == "services/bus-stops/all":
+      return self.reply(200, fixtures.stops)
+    return self.reply(404, {"error": f"unknown endpoint {endpoint}"})
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Serve a local stand-in for the TPL FVG APIs.")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each response")
+  parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more seconds, at random")
+  parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with a 503")
+  args = parser.parse_args()
+
+  server = FakeTPLFVG((args.host, args.port), args.latency, args.jitter, args.error_rate)
+  print(f"Serving on {server.url}")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
@@ -15,31 +15,107 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler
+from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, CallbackQueryHandler, \
+  InlineQueryHandler, ChosenInlineResultHandler
 from telegram.helpers import escape_markdown
 from telegram.constants import MessageLimit
+from telegram.request import BaseRequest, HTTPXRequest
 
+import asyncio
+import logging
 import os
 import re
 import json
 import random
 
-from tinydb import TinyDB, Query
 from dotenv import load_dotenv
 load_dotenv()
 
-from tplfvg_rt_python_api.api import get_stops_by_keyword, get_stop_monitor, get_stops_by_location, get_stop_info, get_line_route
+from tplfvg_rt_python_api.async_api import get_stops_by_keyword, get_stop_monitor, get_stops_by_location, get_stop_info, get_line_route
 from tplfvg_rt_python_api.model import RTResult, StopInfo, RouteStop
-from utils import format_stop_monitor, format_lines_for_stop, format_line_route, split_entities_if_needed, filter_stops_by_zone
+from tplfvg_rt_python_api import async_utils, breaker, metrics
+from tplfvg_rt_python_api.cache import configure_rt_cache, configure_shared_cache
+from tplfvg_rt_python_api.api import load_route_cache, save_route_cache
+from utils import format_stop_monitor, format_stops_list, format_dashboard_stop, pack_sections, filter_stops_by_zone, get_stops_in_zones, get_departures
+import utils
 
 import callbacks
+import inline
 import markups
-from constants import Session, all_zones
+from constants import all_zones
+from storage import SessionStore, migrate_from_tinydb
+from follow import StopFollower
+from warmer import CacheWarmer
+from processing import PerUserUpdateProcessor
+import profiling
+from ratelimit import SendScheduler
+from sharding import get_shard
 
-db = TinyDB('storage.json')
-sessions = db.table("sessions")
+# Shard of this process when running as a worker of the multi-process mode
+SHARD = get_shard()
+
+def get_shard_path(path: str | None) -> str | None:
+  """
+  Per-shard variant of the path of a file written by the bot, so that workers
+  do not overwrite each other's, e.g. routes.json -> routes.1.json.
+  """
+  if not path or SHARD is None:
+    return path
+  base, ext = os.path.splitext(path)
+  return f"{base}.{SHARD[0]}{ext}"
+
+sessions = SessionStore(os.environ.get("TPLFVG_SESSIONS_DB", "storage.sqlite"), shard=SHARD)
+if SHARD is None:
+  migrate_from_tinydb(sessions, "storage.json")
 callbacks.sessions = sessions
-markups.sessions = sessions
+inline.sessions = sessions
+
+follower = StopFollower(
+  sessions,
+  interval=float(os.environ.get("TPLFVG_FOLLOW_INTERVAL", 30)),
+  duration=float(os.environ.get("TPLFVG_FOLLOW_DURATION", 15 * 60))
+)
+callbacks.follower = follower
+
+# The call budget of the cache warmer is per process, so workers split it
+# among themselves too
+WARMER_BUDGET = float(os.environ.get("TPLFVG_WARMER_BUDGET", 30)) / (SHARD[1] if SHARD else 1)
+WARMER_FILE = get_shard_path(os.environ.get("TPLFVG_WARMER_FILE", "demand.json"))
+warmer = CacheWarmer(
+  sessions,
+  budget=WARMER_BUDGET,
+  interval=float(os.environ.get("TPLFVG_WARMER_INTERVAL", 10)),
+  lead=float(os.environ.get("TPLFVG_WARMER_LEAD", 15)),
+  min_demand=float(os.environ.get("TPLFVG_WARMER_MIN_DEMAND", 1))
+)
+utils.warmer = warmer
+
+REMOTE_SEARCH_FALLBACK = os.environ.get("TPLFVG_REMOTE_SEARCH_FALLBACK", "0") == "1"
+NEARBY_STOPS_RADIUS = float(os.environ.get("TPLFVG_NEARBY_STOPS_RADIUS", 400))
+NEARBY_STOPS_LIMIT = int(os.environ.get("TPLFVG_NEARBY_STOPS_LIMIT", 20))
+# Queries looked up as stop codes with the RT API when not in the local index
+STOP_CODE_PATTERN = re.compile(r"^[A-Z]?\d+$")
+DATASET_WATCH_INTERVAL = float(os.environ.get("TPLFVG_DATASET_WATCH_INTERVAL", 60))
+ROUTE_CACHE_FILE = get_shard_path(os.environ.get("TPLFVG_ROUTE_CACHE_FILE", "routes.json"))
+DASHBOARD_CONCURRENCY = int(os.environ.get("TPLFVG_DASHBOARD_CONCURRENCY", 8))
+DASHBOARD_TIMEOUT = float(os.environ.get("TPLFVG_DASHBOARD_TIMEOUT", 5))
+DASHBOARD_DEPARTURES = int(os.environ.get("TPLFVG_DASHBOARD_DEPARTURES", 3))
+METRICS_LOG_INTERVAL = float(os.environ.get("TPLFVG_METRICS_LOG_INTERVAL", 0))
+METRICS_FILE = get_shard_path(os.environ.get("TPLFVG_METRICS_FILE"))
+METRICS_PORT = int(os.environ.get("TPLFVG_METRICS_PORT", 0))
+if METRICS_PORT and SHARD is not None:
+  METRICS_PORT += SHARD[0]
+
+# Outbound Bot API requests are throttled to stay within Telegram's flood
+# limits; the global limit is per bot, so workers split it among themselves
+RATE_LIMIT = os.environ.get("TPLFVG_RATE_LIMIT", "1") == "1"
+RATE_LIMIT_GLOBAL = float(os.environ.get("TPLFVG_RATE_LIMIT_GLOBAL", 30)) / (SHARD[1] if SHARD else 1)
+RATE_LIMIT_CHAT = float(os.environ.get("TPLFVG_RATE_LIMIT_CHAT", 1))
+RATE_LIMIT_GROUP = float(os.environ.get("TPLFVG_RATE_LIMIT_GROUP", 20 / 60))
+RATE_LIMIT_BURST = float(os.environ.get("TPLFVG_RATE_LIMIT_BURST", 3))
+
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.WARNING)
+logging.getLogger("tplfvg_rt_python_api.metrics").setLevel(logging.INFO)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
   return await update.message.reply_markdown_v2(
@@ -47,15 +123,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
       "e i passaggi in tempo reale delle linee gestite da TPL FVG\\.\n\nPuoi ottenere i " + \
         "prossimi passaggi usando il *codice identificativo* della fermata o " + \
           "cercandola per *nome*, oppure puoi inviare una *posizione*\\. ",
-    reply_markup=markups.get_fav_stops_markup(update)
+    reply_markup=markups.get_fav_stops_markup(sessions.get(update.effective_user.id))
   )
 
 async def favorites(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-  fav_stops = (sessions.search(
-    Session.user_id == update.effective_user.id
-  )[0].get("fav_stops") or {}) if sessions.contains(
-    Session.user_id == update.effective_user.id
-  ) else {}
+  fav_stops = sessions.get(update.effective_user.id).get("fav_stops") or {}
   if not fav_stops:
     return await update.message.reply_text("Nessuna fermata preferita.")
   return await update.message.reply_markdown_v2(
@@ -64,12 +136,29 @@ async def favorites(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     for stop in fav_stops])
   )
 
+async def dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  fav_stops = sessions.get(update.effective_user.id).get("fav_stops") or {}
+  fav_stops = {stop: name for stop, name in fav_stops.items() if name}
+  if not fav_stops:
+    return await update.message.reply_text("Nessuna fermata preferita.")
+
+  semaphore = asyncio.Semaphore(DASHBOARD_CONCURRENCY)
+
+  async def get_monitor(stop):
+    # Stops that fail or take too long are shown from the timetable, or as
+    # unavailable, without holding back the others
+    async with semaphore:
+      return await get_departures(stop, DASHBOARD_TIMEOUT)
+
+  monitors = await asyncio.gather(*[get_monitor(stop) for stop in fav_stops])
+  msgs = pack_sections([
+    format_dashboard_stop(fav_stops[stop], stop, monitor, DASHBOARD_DEPARTURES)
+    for stop, monitor in zip(fav_stops, monitors)
+  ], header="Prossimi passaggi alle fermate preferite \\(in tempo reale se segnalato con ✱\\):\n\n")
+  return [await update.message.reply_markdown_v2(msg) for msg in msgs]
+
 async def zones(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-  zones = (sessions.search(
-    Session.user_id == update.effective_user.id
-  )[0].get("zones") or []) if sessions.contains(
-    Session.user_id == update.effective_user.id
-  ) else []
+  zones = sessions.get(update.effective_user.id).get("zones") or []
   return await update.message.reply_markdown_v2(
     "Scegli una *zona* per aggiungerla o rimuoverla dai filtri di ricerca\\. Quando cerchi fermate " + \
       "e linee vedrai solo risultati nelle zone che hai selezionato " + \
@@ -81,32 +170,24 @@ async def zones(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
   )
 
 async def message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-  session = sessions.search(
-    Session.user_id == update.effective_user.id
-  )[0] if sessions.contains(
-    Session.user_id == update.effective_user.id
-  ) else None
+  session = sessions.get(update.effective_user.id)
 
-  naming_fav = session.get("status") == "naming_fav" if session else False
+  naming_fav = session.get("status") == "naming_fav"
   if naming_fav:
     if not re.search(r"\w{2,}", update.message.text):
       return await update.message.reply_text(
         "Usa almeno due caratteri alfanumerici come nome per una fermata preferita."
       )
-    fav_stops = (sessions.search(
-      Session.user_id == update.effective_user.id
-    )[0].get("fav_stops") or {}) if sessions.contains(
-      Session.user_id == update.effective_user.id
-    ) else {}
-    sessions.upsert({
+    fav_stops = session.get("fav_stops") or {}
+    sessions.upsert(update.effective_user.id, {
       "status": None,
       "fav_stops": {
         stop: fav_stops[stop] or update.message.text for stop in fav_stops
       }
-    }, Session.user_id == update.effective_user.id)
+    })
     return await update.message.reply_markdown_v2(
       f"Salvata tra i preferiti con nome *{escape_markdown(update.message.text, version=2)}*\\.",
-      reply_markup=markups.get_fav_stops_markup(update)
+      reply_markup=markups.get_fav_stops_markup(session)
     )
 
   query = update.message.text or ""
@@ -115,89 +196,88 @@ async def message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
   else:
     query = update.message.text
 
-  fav_stops = (session.get("fav_stops") or {}) if session else {}
+  fav_stops = session.get("fav_stops") or {}
   if query in [fav_stops[stop] for stop in fav_stops]:
     query = [stop for stop in fav_stops if fav_stops[stop] == query][0]
     print(query)
 
-  recent_stops = (session.get("recent_stops") or []) if session else []
+  recent_stops = session.get("recent_stops") or []
   recent_stops_ids = [
     (recent_stop[1:] if recent_stop.startswith("/") else recent_stop).split(" ")[0]
   for recent_stop in recent_stops]
 
-  def get_monitor_response(stop_name, query):
-    monitor: list[RTResult] = get_stop_monitor(query)
+  async def get_monitor_response(stop_name, query):
+    monitor: list[RTResult] = await get_departures(query)
     if monitor:
       if query not in recent_stops_ids:
-        sessions.upsert({
-          "user_id": update.effective_user.id,
+        sessions.upsert(update.effective_user.id, {
           "recent_stops": [f"/{query} {stop_name}"] + (recent_stops[:-1] if len(recent_stops) > 7 else recent_stops)
-        }, Session.user_id == update.effective_user.id)
-      return update.message.reply_markdown_v2(
+        })
+      return await update.message.reply_markdown_v2(
         format_stop_monitor(stop_name, query, monitor),
-        reply_markup=InlineKeyboardMarkup(markups.get_monitor_default_buttons(query=query, user_id=update.effective_user.id))
-        # reply_markup=markups.get_fav_stops_markup(update)
+        reply_markup=InlineKeyboardMarkup(markups.get_monitor_default_buttons(query=query, session=session))
+        # reply_markup=markups.get_fav_stops_markup(session)
       )
-    return update.message.reply_markdown_v2(
+    return await update.message.reply_markdown_v2(
       escape_markdown("Nessun passaggio trovato per questa fermata.", version=2),
-      reply_markup=markups.get_fav_stops_markup(update)
+      reply_markup=markups.get_fav_stops_markup(session)
     )
 
   if query:
-    info = get_stop_info(query)
-    if info:
-      return await get_monitor_response(info.address, query)
+    name = utils.stop_index.get_name(query) if utils.stop_index else None
+    if name is not None:
+      return await get_monitor_response(name, query)
+    # Stop codes missing from the local index, e.g. stops added since it was
+    # built, are looked up upstream; names are searched below
+    if STOP_CODE_PATTERN.match(query):
+      info = await get_stop_info(query)
+      if info:
+        return await get_monitor_response(info.address, query)
 
+  # Only keep stops in the zones selected by the user, if any, filtering
+  # within the local indexes when possible
+  zones = session.get("zones") or []
+  allowed = get_stops_in_zones(zones)
   if update.message.location:
-    results = get_stops_by_location(update.message.location.latitude, update.message.location.longitude)
+    if utils.spatial_index:
+      results = utils.spatial_index.within(
+        update.message.location.latitude, update.message.location.longitude, NEARBY_STOPS_RADIUS,
+        limit=NEARBY_STOPS_LIMIT, allowed=allowed
+      )
+    else:
+      results = filter_stops_by_zone(
+        await get_stops_by_location(update.message.location.latitude, update.message.location.longitude) or [], zones
+      )
   else:
-    results = get_stops_by_keyword(query)
-
-  # Filter stops by zone, if requested by the user
-  zones = session.get("zones") if session else []
-  if zones:
-    results = filter_stops_by_zone(results, zones)
+    results = utils.stop_index.search(query, allowed=allowed) if utils.stop_index else None
+    # Only resort to the remote search if the local index is unavailable or,
+    # if explicitly enabled, when it finds nothing
+    if utils.stop_index is None or (not results and REMOTE_SEARCH_FALLBACK):
+      results = filter_stops_by_zone(await get_stops_by_keyword(query) or [], zones)
 
   if results:
     if len(results) == 1:
       if results[0]["id"] not in recent_stops_ids:
-        sessions.upsert({
-          "user_id": update.effective_user.id,
+        sessions.upsert(update.effective_user.id, {
           "recent_stops": [f"/{query} {results[0]['text']}"] + (recent_stops[:-1] if len(recent_stops) > 7 else recent_stops)
-        }, Session.user_id == update.effective_user.id)
+        })
       return await get_monitor_response(results[0]["text"], results[0]["id"])
 
-    stops_msg_shortest = "Fermate trovate:\n\n" + "\n".join(
-      [f"/{escape_markdown(result['id'], version=2)} {escape_markdown(result['text'], version=2)}" for result in results]
-    )
-    stops_msg_short = "Fermate trovate:\n\n" + "\n".join(
-      [f"/{escape_markdown(result['id'], version=2)} {escape_markdown(result['text'], version=2)}" + format_lines_for_stop(result['id'], result['text'], False) for result in results]
-    )
-    stops_msg_long = "Fermate trovate:\n\n" + "\n".join(
-      [f"/{escape_markdown(result['id'], version=2)} {escape_markdown(result['text'], version=2)}" + format_lines_for_stop(result['id'], result['text'], True) for result in results]
-    )
-
-    msgs = []
-    if len(stops_msg_long) <= MessageLimit.MAX_TEXT_LENGTH:
-      msgs = split_entities_if_needed(stops_msg_long)
-    elif len(stops_msg_short) <= MessageLimit.MAX_TEXT_LENGTH:
-      msgs = split_entities_if_needed(stops_msg_short)
-    elif len(stops_msg_shortest) <= MessageLimit.MAX_TEXT_LENGTH:
-      msgs = split_entities_if_needed(stops_msg_shortest)
+    msgs = format_stops_list(results)
     if msgs:
+      # Locations also get to see the departures from all the stops found
+      last_markup = InlineKeyboardMarkup(markups.get_nearby_departures_buttons(
+        update.message.location.latitude, update.message.location.longitude
+      )) if update.message.location else ReplyKeyboardRemove()
       return [await update.message.reply_markdown_v2(
-        msg, reply_markup=ReplyKeyboardRemove()
-      ) for msg in msgs]
+        msg, reply_markup=last_markup if i == len(msgs) - 1 else ReplyKeyboardRemove()
+      ) for i, msg in enumerate(msgs)]
     return await update.message.reply_text("Troppi risultati trovati. Restringi la ricerca inserendo più termini.")
 
-  return await update.message.reply_text("Nessuna fermata trovata.", reply_markup=markups.get_fav_stops_markup(update))
+  return await update.message.reply_text("Nessuna fermata trovata.", reply_markup=markups.get_fav_stops_markup(session))
 
 async def recents(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-  recent_stops = (sessions.search(
-    Session.user_id == update.effective_user.id
-  )[0].get("recent_stops") or {}) if sessions.contains(
-    Session.user_id == update.effective_user.id
-  ) else {}
+  recent_stops = sessions.get(update.effective_user.id).get("recent_stops") or []
   return await update.message.reply_markdown_v2(
     ("Fermate recenti:\n\n" + "\n".join([
       f"👉 {escape_markdown(stop, version=2)}" for stop in recent_stops
@@ -205,34 +285,126 @@ async def recents(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
   )
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-  status = (sessions.search(
-    Session.user_id == update.effective_user.id
-  )[0].get("status") or None) if sessions.contains(
-    Session.user_id == update.effective_user.id
-  ) else None
-  if status == "naming_fav":
-    fav_stops = (sessions.search(
-      Session.user_id == update.effective_user.id
-    )[0].get("fav_stops") or {}) if sessions.contains(
-      Session.user_id == update.effective_user.id
-    ) else {}
-    sessions.upsert({
+  session = sessions.get(update.effective_user.id)
+  if session.get("status") == "naming_fav":
+    fav_stops = session.get("fav_stops") or {}
+    sessions.upsert(update.effective_user.id, {
       "status": None,
       "fav_stops": {
         stop: fav_stops[stop] for stop in fav_stops if fav_stops[stop]
       }
-    }, Session.user_id == update.effective_user.id)
+    })
     await update.message.reply_text("Fermata non inserita tra i preferiti.")
 
+background_tasks: list[asyncio.Task] = []
+metrics_servers: list[asyncio.Server] = []
+
+async def startup(application: Application) -> None:
+  if ROUTE_CACHE_FILE:
+    try:
+      print(f"Loaded {load_route_cache(ROUTE_CACHE_FILE)} cached trip routes")
+    except Exception as e:
+      print(f"Warning: could not load cached trip routes: {e!r}")
+  sessions.start()
+  background_tasks.append(asyncio.get_running_loop().create_task(utils.watch_dataset(DATASET_WATCH_INTERVAL)))
+  if METRICS_LOG_INTERVAL or METRICS_FILE:
+    background_tasks.append(asyncio.get_running_loop().create_task(metrics.export_periodically(
+      METRICS_LOG_INTERVAL or 60, log=bool(METRICS_LOG_INTERVAL), path=METRICS_FILE
+    )))
+  if METRICS_PORT:
+    metrics_servers.append(await metrics.serve_prometheus(port=METRICS_PORT))
+  follower.start(application.bot)
+  if WARMER_FILE and os.path.exists(WARMER_FILE):
+    try:
+      print(f"Loaded the demand for {warmer.load(WARMER_FILE)} stops")
+    except Exception as e:
+      print(f"Warning: could not load the demand for stops: {e!r}")
+  if WARMER_BUDGET:
+    warmer.start()
+
+async def shutdown(application: Application) -> None:
+  for task in background_tasks:
+    task.cancel()
+  await asyncio.gather(*background_tasks, return_exceptions=True)
+  for server in metrics_servers:
+    server.close()
+  await follower.close()
+  await warmer.close()
+  if WARMER_FILE:
+    try:
+      warmer.save(WARMER_FILE)
+    except Exception as e:
+      print(f"Warning: could not save the demand for stops: {e!r}")
+  await sessions.close()
+  await async_utils.close()
+  if ROUTE_CACHE_FILE:
+    save_route_cache(ROUTE_CACHE_FILE)
+
+async_utils.configure(
+  timeout=float(os.environ.get("TPLFVG_API_TIMEOUT", async_utils.DEFAULT_TIMEOUT)),
+  connect_timeout=float(os.environ.get("TPLFVG_API_CONNECT_TIMEOUT", async_utils.DEFAULT_CONNECT_TIMEOUT)),
+  max_connections=int(os.environ.get("TPLFVG_API_MAX_CONNECTIONS", async_utils.DEFAULT_MAX_CONNECTIONS)),
+  max_concurrency=int(os.environ.get("TPLFVG_API_MAX_CONCURRENCY", async_utils.DEFAULT_MAX_CONCURRENCY))
+)
+if "TPLFVG_MONITOR_CACHE_TTL" in os.environ:
+  configure_rt_cache("polemonitor/mrcruns", ttl=float(os.environ["TPLFVG_MONITOR_CACHE_TTL"]))
+if "TPLFVG_MONITOR_STALE_TTL" in os.environ:
+  configure_rt_cache("polemonitor/mrcruns", stale_ttl=float(os.environ["TPLFVG_MONITOR_STALE_TTL"]))
+if "TPLFVG_STOP_INFO_CACHE_TTL" in os.environ:
+  configure_rt_cache("polemonitor/info", ttl=float(os.environ["TPLFVG_STOP_INFO_CACHE_TTL"]))
+breaker.configure(
+  failure_threshold=int(os.environ.get("TPLFVG_BREAKER_THRESHOLD", breaker.DEFAULT_FAILURE_THRESHOLD)),
+  reset_timeout=float(os.environ.get("TPLFVG_BREAKER_RESET_TIMEOUT", breaker.DEFAULT_RESET_TIMEOUT))
+)
+if os.environ.get("TPLFVG_SHARED_CACHE"):
+  configure_shared_cache(os.environ["TPLFVG_SHARED_CACHE"])
+
+CONCURRENT_UPDATES = int(os.environ.get("TPLFVG_CONCURRENT_UPDATES", 64))
+# Updates of a user waiting for the previous one, past which new ones are dropped
+MAX_PENDING_UPDATES = int(os.environ.get("TPLFVG_MAX_PENDING_UPDATES", 32))
+
+def build_application(token: str, request: BaseRequest = None, concurrent_updates: int = CONCURRENT_UPDATES) -> Application:
+  """
+  Build the bot application with all handlers registered. Up to
+  `concurrent_updates` updates are processed at the same time, each user's in
+  order. A custom `request` can be given to replace the Bot API transport,
+  e.g. for benchmarks. Handlers are profiled if `TPLFVG_PROFILE` is set.
+  """
+  builder = Application.builder().token(token).post_init(startup).post_shutdown(shutdown) \
+    .concurrent_updates(PerUserUpdateProcessor(concurrent_updates, MAX_PENDING_UPDATES))
+  if RATE_LIMIT:
+    builder = builder.rate_limiter(SendScheduler(
+      rate=RATE_LIMIT_GLOBAL, chat_rate=RATE_LIMIT_CHAT, group_rate=RATE_LIMIT_GROUP, chat_burst=RATE_LIMIT_BURST
+    ))
+  if request is not None:
+    builder = builder.get_updates_request(request)
+  if profiling.ENABLED:
+    # Same pool size as the transport built by default
+    request = profiling.ProfiledRequest(request or HTTPXRequest(connection_pool_size=256))
+  if request is not None:
+    builder = builder.request(request)
+  app = builder.build()
+  app.add_handler(CommandHandler("start", start))
+  app.add_handler(CommandHandler("cancel", cancel))
+  app.add_handler(CommandHandler("favorites", favorites))
+  app.add_handler(CommandHandler("dashboard", dashboard))
+  app.add_handler(CommandHandler("recents", recents))
+  app.add_handler(CommandHandler("zones", zones))
+  app.add_handler(CallbackQueryHandler(callbacks.fav_callback, r"fav\+.*"))
+  app.add_handler(CallbackQueryHandler(callbacks.show_route_callback, r"showroute\+.*\+.*"))
+  app.add_handler(CallbackQueryHandler(callbacks.zone_callback, r"zone\+.*"))
+  app.add_handler(CallbackQueryHandler(callbacks.follow_callback, r"follow\+.*\+.*"))
+  app.add_handler(CallbackQueryHandler(callbacks.nearby_callback, r"nearby\+.*\+.*"))
+  app.add_handler(CallbackQueryHandler(inline.inline_monitor_callback, r"inline\+.*"))
+  app.add_handler(InlineQueryHandler(inline.inline_query))
+  app.add_handler(ChosenInlineResultHandler(inline.chosen_inline_result))
+  app.add_handler(MessageHandler(None, message))
+  if profiling.ENABLED:
+    profiling.instrument(app)
+  return app
 
-app = Application.builder().token(os.environ["TELEGRAM_BOT_API_KEY"]).build()
-app.add_handler(CommandHandler("start", start))
-app.add_handler(CommandHandler("cancel", cancel))
-app.add_handler(CommandHandler("favorites", favorites))
-app.add_handler(CommandHandler("recents", recents))
-app.add_handler(CommandHandler("zones", zones))
-app.add_handler(CallbackQueryHandler(callbacks.fav_callback, r"fav\+.*"))
-app.add_handler(CallbackQueryHandler(callbacks.show_route_callback, r"showroute\+.*\+.*"))
-app.add_handler(CallbackQueryHandler(callbacks.zone_callback, r"zone\+.*"))
-app.add_handler(MessageHandler(None, message))
-app.run_polling(allowed_updates=Update.ALL_TYPES)
+if __name__ == "__main__":
+  # See main.py, the entry point which only loads the bot where updates are
+  # processed
+  import main
+  main.run(build_application)
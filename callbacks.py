@@ -14,18 +14,29 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import os
+
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton
 from telegram.ext import ContextTypes
 from telegram.helpers import escape_markdown
 
-from tplfvg_rt_python_api.api import get_stops_by_keyword, get_stop_monitor, get_stops_by_location, get_stop_info, get_line_route
-from tplfvg_rt_python_api.model import RTResult, StopInfo, RouteStop
-from utils import format_stop_monitor, format_lines_for_stop, format_line_route, split_entities_if_needed
+from tplfvg_rt_python_api.async_api import get_stops_by_keyword, get_stop_monitor, get_stops_by_location, get_stop_info, get_line_route
+from tplfvg_rt_python_api.model import RTResult, StopInfo, RouteStop, Route
+from utils import format_stop_monitor, format_lines_for_stop, format_line_route, split_entities_if_needed, \
+  format_nearby_departure, merge_departures, pack_sections, filter_stops_by_zone, get_stops_in_zones, get_departures
+import utils
 
 import markups
-from constants import Session, all_zones
+from constants import all_zones
 
 sessions = None
+follower = None
+
+NEARBY_DEPARTURES_RADIUS = float(os.environ.get("TPLFVG_NEARBY_DEPARTURES_RADIUS", 500))
+NEARBY_DEPARTURES_STOPS = int(os.environ.get("TPLFVG_NEARBY_DEPARTURES_STOPS", 6))
+NEARBY_DEPARTURES_LIMIT = int(os.environ.get("TPLFVG_NEARBY_DEPARTURES_LIMIT", 15))
+NEARBY_DEPARTURES_TIMEOUT = float(os.environ.get("TPLFVG_NEARBY_DEPARTURES_TIMEOUT", 5))
 
 async def fav_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
   """
@@ -34,42 +45,32 @@ async def fav_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
   await update.callback_query.answer()
   mode = update.callback_query.data.split("+")[1]
   code = update.callback_query.data.split("+")[2]
-  status = (sessions.search(
-    Session.user_id == update.effective_user.id
-  )[0].get("status") or None) if sessions.contains(
-    Session.user_id == update.effective_user.id
-  ) else None
-  info: StopInfo = get_stop_info(code)
-  if status == "naming_fav" or not info:
+  session = sessions.get(update.effective_user.id)
+  info: StopInfo = await get_stop_info(code)
+  if session.get("status") == "naming_fav" or not info:
     await update.callback_query.answer()
     return
   
   if mode == "stop":
-    fav_stops = (sessions.search(
-      Session.user_id == update.effective_user.id
-    )[0].get("fav_stops") or {}) if sessions.contains(
-      Session.user_id == update.effective_user.id
-    ) else {}
+    fav_stops = dict(session.get("fav_stops") or {})
     if code in fav_stops:
       deleted = fav_stops[code]
       del fav_stops[code]
-      sessions.upsert({
-        "user_id": update.effective_user.id,
+      sessions.upsert(update.effective_user.id, {
         "fav_stops": fav_stops
-      }, Session.user_id == update.effective_user.id)
+      })
       await update.callback_query.message.reply_markdown_v2(
         f"Fermata /{code} _{escape_markdown(deleted, version=2)}_ rimossa dai preferiti\\.",
-        reply_markup=markups.get_fav_stops_markup(update)
+        reply_markup=markups.get_fav_stops_markup(session)
       )
     else:
       fav_stops.update({
         code: None
       })
-      sessions.upsert({
-        "user_id": update.effective_user.id,
+      sessions.upsert(update.effective_user.id, {
         "fav_stops": fav_stops,
         "status": "naming_fav"
-      }, Session.user_id == update.effective_user.id)
+      })
       await update.callback_query.message.reply_markdown_v2(
         f"Scrivi un nome per salvare la fermata /{code} _{escape_markdown(info.address, version=2)}_  nei preferiti o /cancel per annullare\\.",
         reply_markup=ReplyKeyboardMarkup(
@@ -79,7 +80,11 @@ async def fav_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
       )
   await update.callback_query.edit_message_reply_markup(
     reply_markup=InlineKeyboardMarkup(
-      markups.get_monitor_default_buttons(query=code, user_id=update.effective_user.id)
+      markups.get_monitor_default_buttons(
+        query=code,
+        session=session,
+        following=follower.is_following(update.callback_query.message.chat_id, update.callback_query.message.message_id, code)
+      )
     )
   )
 
@@ -89,26 +94,31 @@ async def show_route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
   """
   mode = update.callback_query.data.split("+")[1]
   code = update.callback_query.data.split("+")[2]
+  session = sessions.get(update.effective_user.id)
+  message = update.callback_query.message
   if mode == "stop":
-    monitor: list[RTResult] = get_stop_monitor(code)
+    monitor: list[RTResult] = await get_stop_monitor(code)
     if not monitor:
       await update.callback_query.answer()
       return
-    buttons = [button for button in markups.get_monitor_default_buttons(query=code, user_id=update.effective_user.id) if "showroute+stop" not in button[0].callback_data]
+    buttons = [button for button in markups.get_monitor_default_buttons(
+      query=code, session=session, following=follower.is_following(message.chat_id, message.message_id, code)
+    ) if "showroute+stop" not in button[0].callback_data]
+    markup = InlineKeyboardMarkup([
+      *buttons,
+      [InlineKeyboardButton(
+        "👇 Scegli una linea o premi qui per annullare",
+        callback_data=f"showroute+cancel+{code}"
+      )],
+      *[[InlineKeyboardButton(
+        f'Linea {r.line_code} ⇒ {r.destination}' + (f" [{r.notes}]" if r.notes else "") + f" ({r.arrival_time})",
+        callback_data=f"showroute+route+{r.line}|{r.line_code}|{r.direction}|{r.trip}|{code}|{r.arrival_time}"
+      )] for r in monitor]
+    ])
+    # Automatic updates keep the line picker open until a line is chosen
+    follower.set_markup(message.chat_id, message.message_id, code, markup)
     await update.callback_query.answer()
-    await update.callback_query.message.edit_reply_markup(
-      reply_markup=InlineKeyboardMarkup([
-        *buttons,
-        [InlineKeyboardButton(
-          "👇 Scegli una linea o premi qui per annullare",
-          callback_data=f"showroute+cancel+{code}"
-        )],
-        *[[InlineKeyboardButton(
-          f'Linea {r.line_code} ⇒ {r.destination}' + (f" [{r.notes}]" if r.notes else "") + f" ({r.arrival_time})",
-          callback_data=f"showroute+route+{r.line}|{r.line_code}|{r.direction}|{r.trip}|{code}|{r.arrival_time}"
-        )] for r in monitor]
-      ])
-    )
+    await update.callback_query.message.edit_reply_markup(reply_markup=markup)
     # await update.callback_query.message.edit_reply_markup(
     #   reply_markup=InlineKeyboardMarkup([
     #     *buttons, 
@@ -119,15 +129,20 @@ async def show_route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     #   ])
     # )
   elif mode == "route":
+    line, line_code, trip_direction, trip_id, stop_code, trip_arrival_time = code.split("|")
+    follower.set_markup(message.chat_id, message.message_id, stop_code, None)
     await update.callback_query.answer()
     await update.callback_query.message.edit_reply_markup(
       reply_markup=InlineKeyboardMarkup([
-        *markups.get_monitor_default_buttons(query=code, user_id=update.effective_user.id)
+        *markups.get_monitor_default_buttons(
+          query=stop_code,
+          session=session,
+          following=follower.is_following(message.chat_id, message.message_id, stop_code)
+        )
       ])
     )
-    line, line_code, trip_direction, trip_id, stop_code, trip_arrival_time = code.split("|")
-    info: StopInfo = get_stop_info(stop_code)
-    route: list[RouteStop] = get_line_route(line, trip_direction, trip_id)
+    info: StopInfo = await get_stop_info(stop_code)
+    route: Route = await get_line_route(line, trip_direction, trip_id)
     if not info or not route:
       return await update.callback_query.message.reply_text(
         "Non è stato possibile recuperare informazioni su questa corsa. Verifica che la corsa non sia terminata e riprova."
@@ -136,32 +151,62 @@ async def show_route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
       format_line_route(code, info, route) 
     )
   elif mode == "cancel":
+    follower.set_markup(message.chat_id, message.message_id, code, None)
     await update.callback_query.answer()
     await update.callback_query.message.edit_reply_markup(
       reply_markup=InlineKeyboardMarkup([
-        *markups.get_monitor_default_buttons(query=code, user_id=update.effective_user.id)
+        *markups.get_monitor_default_buttons(
+          query=code,
+          session=session,
+          following=follower.is_following(message.chat_id, message.message_id, code)
+        )
       ])
     )
 
+async def follow_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  """
+
+  """
+  mode = update.callback_query.data.split("+")[1]
+  code = update.callback_query.data.split("+")[2]
+  message = update.callback_query.message
+  if mode == "start":
+    info: StopInfo = await get_stop_info(code)
+    if not info:
+      await update.callback_query.answer()
+      return
+    follower.follow(message.chat_id, message.message_id, update.effective_user.id, code, info.address)
+    await update.callback_query.answer(
+      f"La fermata verrà aggiornata automaticamente per {round(follower.duration / 60)} minuti."
+    )
+  else:
+    follower.unfollow(message.chat_id, message.message_id, code)
+    await update.callback_query.answer("Aggiornamento automatico interrotto.")
+  await message.edit_reply_markup(
+    reply_markup=InlineKeyboardMarkup(
+      markups.get_monitor_default_buttons(
+        query=code,
+        session=sessions.get(update.effective_user.id),
+        following=mode == "start"
+      )
+    )
+  )
+
 async def zone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
   """
 
   """
   zone = update.callback_query.data.split("+")[1]
-  zones = (sessions.search(
-    Session.user_id == update.effective_user.id
-  )[0].get("zones") or []) if sessions.contains(
-    Session.user_id == update.effective_user.id
-  ) else []
+  zones = list(sessions.get(update.effective_user.id).get("zones") or [])
   await update.callback_query.answer()
 
   if not zones:
     zones = [zone]
   elif zone in zones:
     zones.remove(zone)
-    sessions.upsert({
+    sessions.upsert(update.effective_user.id, {
       "zones": zones
-    }, Session.user_id == update.effective_user.id)
+    })
     return await update.callback_query.message.reply_markdown_v2(
       "Zona rimossa\\.\n" + f"_Zone attualmente selezionate:_ {", ".join([
         escape_markdown(all_zones[z], version=2) for z in zones
@@ -169,11 +214,45 @@ async def zone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     )
   else:
     zones.append(zone)
-  sessions.upsert({
+  sessions.upsert(update.effective_user.id, {
     "zones": zones
-  }, Session.user_id == update.effective_user.id)
+  })
   return await update.callback_query.message.reply_markdown_v2(
     "Zona aggiunta\\.\n" + f"_Zone attualmente selezionate:_ {", ".join([
       escape_markdown(all_zones[z], version=2) for z in zones
     ]) if zones else "nessuna"}"
-  )
\ No newline at end of file
+  )
+
+async def nearby_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  """
+  Show the next departures from the stops closest to a location, merged into
+  a single board.
+  """
+  await update.callback_query.answer()
+  lat, lng = [float(x) for x in update.callback_query.data.split("+")[1:3]]
+  zones = sessions.get(update.effective_user.id).get("zones") or []
+  if utils.spatial_index:
+    stops = utils.spatial_index.within(
+      lat, lng, NEARBY_DEPARTURES_RADIUS, limit=NEARBY_DEPARTURES_STOPS, allowed=get_stops_in_zones(zones)
+    )
+  else:
+    stops = filter_stops_by_zone(await get_stops_by_location(lat, lng) or [], zones)[:NEARBY_DEPARTURES_STOPS]
+  if not stops:
+    return await update.callback_query.message.reply_text("Nessuna fermata trovata nelle vicinanze.")
+
+  async def get_monitor(stop):
+    return await get_departures(stop["id"], NEARBY_DEPARTURES_TIMEOUT)
+
+  monitors = await asyncio.gather(*[get_monitor(stop) for stop in stops])
+  departures = merge_departures(stops, monitors)[:NEARBY_DEPARTURES_LIMIT]
+  if not departures:
+    return await update.callback_query.message.reply_text("Nessun passaggio trovato nelle vicinanze.")
+  msgs = pack_sections(
+    [format_nearby_departure(stop, r) for stop, r in departures],
+    header="🕒 Prossime partenze qui vicino \\(in tempo reale se segnalato con ✱\\):\n\n"
+  )
+  for i, msg in enumerate(msgs):
+    await update.callback_query.message.reply_markdown_v2(
+      msg,
+      reply_markup=InlineKeyboardMarkup(markups.get_nearby_departures_buttons(lat, lng)) if i == len(msgs) - 1 else None
+    )
@@ -14,9 +14,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from tinydb import Query
+from telegram import Update
+
+# Only the update types handled by the bot are requested from Telegram
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY, Update.CHOSEN_INLINE_RESULT]
 
-Session = Query()
 all_zones = {
   "G": "Gorizia",
   "M": "Monfalcone",
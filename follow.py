@@ -0,0 +1,170 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+
+from telegram import Bot, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden
+
+from tplfvg_rt_python_api.async_api import get_stop_monitor
+from utils import format_stop_monitor
+
+import markups
+import ratelimit
+
+class StopFollower:
+  """
+  Keeps stop monitor messages up to date by editing them in place.
+
+  Every `interval` seconds each followed stop is polled once, no matter how
+  many messages follow it, and the rendered monitor is fanned out to all of
+  them. Messages whose text would not change are not edited, and each
+  message is followed for at most `duration` seconds. Messages showing a
+  keyboard other than the default one (see `set_markup`) keep it across
+  edits.
+  """
+
+  def __init__(self, sessions, interval: float = 30, duration: float = 15 * 60):
+    self.sessions = sessions
+    self.interval = interval
+    self.duration = duration
+    # stop_code -> (chat_id, message_id) -> subscription
+    self.subscriptions = {}
+    self.bot = None
+    self.task = None
+
+  def __len__(self):
+    return sum(len(subscribers) for subscribers in self.subscriptions.values())
+
+  def is_following(self, chat_id: int, message_id: int, stop_code: str) -> bool:
+    return (chat_id, message_id) in self.subscriptions.get(stop_code, {})
+
+  def follow(self, chat_id: int, message_id: int, user_id: int, stop_code: str, stop_name: str):
+    """
+    Start (or extend) following the given message showing the given stop.
+    """
+    self.subscriptions.setdefault(stop_code, {})[(chat_id, message_id)] = {
+      "user_id": user_id,
+      "stop_name": stop_name,
+      "expires_at": time.monotonic() + self.duration,
+      "last_text": None,
+      "markup": None
+    }
+
+  def set_markup(self, chat_id: int, message_id: int, stop_code: str, markup: InlineKeyboardMarkup | None):
+    """
+    Keep the given keyboard (e.g. the line picker) on a followed message when
+    editing it, or go back to the default buttons if None.
+    """
+    subscription = self.subscriptions.get(stop_code, {}).get((chat_id, message_id))
+    if subscription is not None:
+      subscription["markup"] = markup
+
+  def unfollow(self, chat_id: int, message_id: int, stop_code: str):
+    subscribers = self.subscriptions.get(stop_code, {})
+    subscribers.pop((chat_id, message_id), None)
+    if not subscribers:
+      self.subscriptions.pop(stop_code, None)
+
+  def start(self, bot: Bot):
+    self.bot = bot
+    if self.task is None:
+      self.task = asyncio.get_running_loop().create_task(self.run())
+
+  async def close(self):
+    if self.task is not None:
+      self.task.cancel()
+      try:
+        await self.task
+      except asyncio.CancelledError:
+        pass
+      self.task = None
+
+  async def run(self):
+    while True:
+      await asyncio.sleep(self.interval)
+      try:
+        # Edits give way to replies to users when sending is rate limited
+        with ratelimit.background():
+          await self.tick()
+      except Exception as e:
+        print(f"Warning: could not refresh followed stops: {e!r}")
+
+  async def tick(self):
+    """
+    Poll every followed stop once and update the messages following it.
+    """
+    now = time.monotonic()
+    for stop_code in list(self.subscriptions):
+      for key, subscription in list(self.subscriptions[stop_code].items()):
+        if subscription["expires_at"] <= now:
+          self.unfollow(*key, stop_code)
+          await self.stop_editing(*key, stop_code, subscription)
+
+    stop_codes = list(self.subscriptions)
+    monitors = await asyncio.gather(*[get_stop_monitor(stop_code) for stop_code in stop_codes])
+    edits = []
+    for stop_code, monitor in zip(stop_codes, monitors):
+      if not monitor:
+        continue
+      rendered = {}
+      for key, subscription in list(self.subscriptions.get(stop_code, {}).items()):
+        stop_name = subscription["stop_name"]
+        if stop_name not in rendered:
+          rendered[stop_name] = format_stop_monitor(stop_name, stop_code, monitor)
+        text = rendered[stop_name]
+        if text == subscription["last_text"]:
+          continue
+        subscription["last_text"] = text
+        edits.append(self.edit(*key, stop_code, subscription, text))
+    await asyncio.gather(*edits, return_exceptions=True)
+
+  def get_buttons(self, stop_code: str, subscription: dict, following: bool):
+    return InlineKeyboardMarkup(markups.get_monitor_default_buttons(
+      query=stop_code,
+      session=self.sessions.get(subscription["user_id"]),
+      following=following
+    ))
+
+  async def edit(self, chat_id: int, message_id: int, stop_code: str, subscription: dict, text: str):
+    try:
+      await self.bot.edit_message_text(
+        text,
+        chat_id=chat_id,
+        message_id=message_id,
+        parse_mode=ParseMode.MARKDOWN_V2,
+        reply_markup=subscription["markup"] or self.get_buttons(stop_code, subscription, True)
+      )
+    except BadRequest as e:
+      if "not modified" not in str(e):
+        self.unfollow(chat_id, message_id, stop_code)
+    except Forbidden:
+      self.unfollow(chat_id, message_id, stop_code)
+
+  async def stop_editing(self, chat_id: int, message_id: int, stop_code: str, subscription: dict):
+    """
+    Restore the default buttons of a message that is no longer followed.
+    """
+    try:
+      await self.bot.edit_message_reply_markup(
+        chat_id=chat_id,
+        message_id=message_id,
+        reply_markup=self.get_buttons(stop_code, subscription, False)
+      )
+    except (BadRequest, Forbidden):
+      pass
@@ -0,0 +1,158 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Inline mode: `@bot trieste stazione` autocompletes stops from the local stop
+index as the user types, and picking one sends its stop monitor to the chat.
+
+The monitor is filled in by editing the sent message when Telegram reports
+the chosen result, which requires inline feedback to be enabled for the bot
+(/setinlinefeedback in BotFather). Without it the message shows a button to
+load the monitor instead.
+"""
+
+import asyncio
+import os
+
+from telegram import Update, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.ext import ContextTypes
+from telegram.helpers import escape_markdown
+
+from tplfvg_rt_python_api.async_api import get_stop_info
+from tplfvg_rt_python_api.cache import TTLCache
+from tplfvg_rt_python_api.search import normalize
+from utils import get_stops_in_zones, format_stop_monitor, get_departures
+import utils
+
+import markups
+
+sessions = None
+
+INLINE_RESULTS = int(os.environ.get("TPLFVG_INLINE_RESULTS", 20))
+INLINE_DEBOUNCE = float(os.environ.get("TPLFVG_INLINE_DEBOUNCE", 0.3))
+INLINE_CACHE_TIME = int(os.environ.get("TPLFVG_INLINE_CACHE_TIME", 300))
+
+# (normalized query, zones, dataset version) -> search results
+answers = TTLCache(ttl=INLINE_CACHE_TIME, maxsize=4096)
+# user id -> task answering the last inline query received from the user
+pending_queries = {}
+
+def search_stops(query: str, zones: list[str]) -> list[dict]:
+  """
+  Stops matching a partial query, cached by normalized query so that users
+  typing the same prefix share the work.
+  """
+  key = (" ".join(normalize(query)), tuple(sorted(zones)), utils.dataset_version)
+  results = answers.get(key)
+  if results is None:
+    results = utils.stop_index.search(query, limit=INLINE_RESULTS, allowed=get_stops_in_zones(zones))
+    answers.put(key, results)
+  return results
+
+def get_lines_description(code: str) -> str:
+  if not utils.lines_by_stop or not (lines := utils.lines_by_stop.get(code)):
+    return f"Fermata {code}"
+  return f"Fermata {code} · Linee " + ", ".join(line for line, _ in lines)
+
+def get_result(code: str, name: str) -> InlineQueryResultArticle:
+  return InlineQueryResultArticle(
+    id=code,
+    title=name,
+    description=get_lines_description(code),
+    input_message_content=InputTextMessageContent(
+      f"🚏 /{escape_markdown(code, version=2)} *{escape_markdown(name, version=2)}*\n\n_Caricamento dei passaggi\\.\\.\\._",
+      parse_mode=ParseMode.MARKDOWN_V2
+    ),
+    reply_markup=InlineKeyboardMarkup(markups.get_inline_monitor_buttons(code))
+  )
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  """
+  Answer an inline query with the matching stops, or the user's favourite
+  stops while the query is empty.
+
+  Telegram sends a query for every keystroke: the answer is delayed by the
+  debounce interval in a task of its own, which the next query of the user
+  cancels, so that waiting does not hold one of the updates processed at the
+  same time.
+  """
+  user_id = update.effective_user.id
+  pending = pending_queries.get(user_id)
+  if pending is not None:
+    pending.cancel()
+  pending_queries[user_id] = context.application.create_task(
+    answer_inline_query(update, user_id), update=update, name=f"inline_query:{user_id}"
+  )
+
+async def answer_inline_query(update: Update, user_id: int):
+  try:
+    await asyncio.sleep(INLINE_DEBOUNCE)
+  finally:
+    if pending_queries.get(user_id) is asyncio.current_task():
+      del pending_queries[user_id]
+
+  query = update.inline_query.query.strip()
+  session = sessions.get(user_id)
+  if not query:
+    fav_stops = session.get("fav_stops") or {}
+    results = [{"id": code, "text": name} for code, name in fav_stops.items() if name]
+  elif utils.stop_index:
+    results = search_stops(query, session.get("zones") or [])
+  else:
+    results = []
+  await update.inline_query.answer(
+    [get_result(result["id"], result["text"]) for result in results],
+    cache_time=INLINE_CACHE_TIME,
+    # Results depend on the user's favourites and zones
+    is_personal=not query or bool(session.get("zones"))
+  )
+
+async def show_inline_monitor(bot, inline_message_id: str, code: str):
+  info = await get_stop_info(code)
+  monitor = await get_departures(code) if info else None
+  if monitor:
+    text = format_stop_monitor(info.address, code, monitor)
+  else:
+    text = escape_markdown("Nessun passaggio trovato per questa fermata.", version=2)
+  try:
+    await bot.edit_message_text(
+      text,
+      inline_message_id=inline_message_id,
+      parse_mode=ParseMode.MARKDOWN_V2,
+      reply_markup=InlineKeyboardMarkup(markups.get_inline_monitor_buttons(code))
+    )
+  except BadRequest as e:
+    if "not modified" not in str(e):
+      raise
+
+async def chosen_inline_result(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  """
+  Fill in the stop monitor of a stop picked from the inline results.
+  """
+  result = update.chosen_inline_result
+  if result.inline_message_id:
+    await show_inline_monitor(context.bot, result.inline_message_id, result.result_id)
+
+async def inline_monitor_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+  """
+  Load or refresh the stop monitor of a message sent in inline mode.
+  """
+  await update.callback_query.answer()
+  if update.callback_query.inline_message_id:
+    code = update.callback_query.data.split("+")[1]
+    await show_inline_monitor(context.bot, update.callback_query.inline_message_id, code)
@@ -0,0 +1,82 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Entry point of the bot. In the multi-process mode, this process only forwards
+updates to the workers, so the bot (sessions, stop dataset, search indexes) is
+only loaded by them.
+"""
+
+import argparse
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from constants import ALLOWED_UPDATES
+from sharding import UpdateRouter
+
+def run(build_application=None):
+  """
+  Parse the command line and run the bot, with the given `build_application`
+  of the bot module when it is already loaded.
+  """
+  parser = argparse.ArgumentParser(description="Run the TPL FVG Monitor bot.")
+  parser.add_argument("--mode", choices=["polling", "webhook"], default=os.environ.get("TPLFVG_MODE", "polling"))
+  parser.add_argument("--concurrent-updates", type=int, default=int(os.environ.get("TPLFVG_CONCURRENT_UPDATES", 64)),
+    help="updates processed at the same time, per worker")
+  parser.add_argument("--workers", type=int, default=int(os.environ.get("TPLFVG_WORKERS", 1)),
+    help="worker processes to shard users across, 1 to process updates in this process")
+  parser.add_argument("--listen", default=os.environ.get("TPLFVG_WEBHOOK_LISTEN", "127.0.0.1"),
+    help="address the webhook server listens on")
+  parser.add_argument("--port", type=int, default=int(os.environ.get("TPLFVG_WEBHOOK_PORT", 8443)),
+    help="port the webhook server listens on")
+  parser.add_argument("--url-path", default=os.environ.get("TPLFVG_WEBHOOK_PATH", "telegram"),
+    help="path the webhook server accepts updates on")
+  parser.add_argument("--webhook-url", default=os.environ.get("TPLFVG_WEBHOOK_URL"),
+    help="public URL Telegram sends updates to, usually a reverse proxy in front of the webhook server")
+  args = parser.parse_args()
+  if args.mode == "webhook" and not args.webhook_url:
+    parser.error("--webhook-url (or TPLFVG_WEBHOOK_URL) is required in webhook mode")
+  if args.workers > 1 and build_application is not None:
+    # Workers would load the bot twice, as the main module and as a module
+    parser.error("--workers requires running main.py")
+
+  if args.workers > 1:
+    # Settings are handed down to the workers through the environment; stop
+    # monitors and stop information are shared through a local database
+    os.environ["TPLFVG_CONCURRENT_UPDATES"] = str(args.concurrent_updates)
+    os.environ.setdefault("TPLFVG_SHARED_CACHE", "cache.sqlite")
+    app = UpdateRouter("bot:build_application", os.environ["TELEGRAM_BOT_API_KEY"], args.workers).build_front_application()
+  else:
+    if build_application is None:
+      from bot import build_application
+    app = build_application(os.environ["TELEGRAM_BOT_API_KEY"], concurrent_updates=args.concurrent_updates)
+  if args.mode == "webhook":
+    # Requires the webhooks extra of python-telegram-bot
+    app.run_webhook(
+      listen=args.listen,
+      port=args.port,
+      url_path=args.url_path,
+      webhook_url=args.webhook_url,
+      secret_token=os.environ.get("TPLFVG_WEBHOOK_SECRET"),
+      allowed_updates=ALLOWED_UPDATES
+    )
+  else:
+    app.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+if __name__ == "__main__":
+  run()
@@ -17,19 +17,13 @@
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton
 from more_itertools import chunked
 
-from constants import all_zones, Session
+from constants import all_zones
 
-sessions = None
-
-def get_fav_stops_markup(update: Update):
+def get_fav_stops_markup(session: dict):
   """
 
   """
-  fav_stops = (sessions.search(
-    Session.user_id == update.effective_user.id
-  )[0].get("fav_stops") or []) if sessions.contains(
-    Session.user_id == update.effective_user.id
-  ) else []
+  fav_stops = session.get("fav_stops") or []
   fav_stops = [
     fav_stops[stop] for stop in fav_stops
   ]
@@ -45,12 +39,8 @@ def get_monitor_default_buttons(**kwargs):
 
   """
   query = kwargs["query"]
-  effective_user_id = kwargs["user_id"]
-  fav_stops = (sessions.search(
-    Session.user_id == effective_user_id
-  )[0].get("fav_stops") or []) if sessions.contains(
-    Session.user_id == effective_user_id
-  ) else []
+  fav_stops = kwargs["session"].get("fav_stops") or []
+  following = kwargs.get("following", False)
   return [[
     InlineKeyboardButton(
       "❤️ Aggiungi fermata ai preferiti" if query not in fav_stops else  "💔 Rimuovi fermata dai preferiti",
@@ -61,6 +51,35 @@ def get_monitor_default_buttons(**kwargs):
       "👉 Mostra percorso della corsa",
       callback_data=f"showroute+stop+{query}"
     )
+  ], [
+    InlineKeyboardButton(
+      "🔄 Aggiorna automaticamente" if not following else "⏹ Interrompi aggiornamento automatico",
+      callback_data=f"follow+{'start' if not following else 'stop'}+{query}"
+    )
+  ]]
+
+def get_nearby_departures_buttons(lat: float, lng: float):
+  """
+  Button showing (or refreshing) the departures from the stops close to the
+  given point.
+  """
+  return [[
+    InlineKeyboardButton(
+      "🕒 Partenze qui vicino",
+      callback_data=f"nearby+{lat:.5f}+{lng:.5f}"
+    )
+  ]]
+
+def get_inline_monitor_buttons(query: str):
+  """
+  Button refreshing a stop monitor sent in inline mode. Inline messages only
+  get this one, as the others reply to the message in the user's chat.
+  """
+  return [[
+    InlineKeyboardButton(
+      "🔄 Aggiorna",
+      callback_data=f"inline+{query}"
+    )
   ]]
 
 def get_zones_buttons():
@@ -0,0 +1,88 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+  """
+  Process up to `max_concurrent_updates` updates at the same time, while
+  keeping the updates of each user in order: a user's update only starts
+  once the previous one from the same user is done, so session state (e.g.
+  naming a favourite stop) never races with itself.
+
+  The concurrency limit is left to the base class, which holds a slot while
+  `do_process_update` runs. Updates arriving while one of the same user is
+  being processed are queued and return right away, freeing their slot: the
+  running update processes them next, so that each user takes up at most one
+  slot and a user sending a burst of updates cannot stall everyone else. Past
+  `max_pending_updates` queued updates per user, further ones are dropped.
+  Inline queries do not touch session state and are not kept in order.
+  """
+
+  def __init__(self, max_concurrent_updates: int, max_pending_updates: int = 32):
+    super().__init__(max_concurrent_updates)
+    self.max_pending_updates = max_pending_updates
+    # user or chat id -> updates waiting for the one being processed
+    self.queues = {}
+    self.dropped = 0
+
+  def get_key(self, update: object):
+    if not isinstance(update, Update) or update.inline_query:
+      return None
+    if update.effective_user:
+      return update.effective_user.id
+    if update.effective_chat:
+      return update.effective_chat.id
+    return None
+
+  async def do_process_update(self, update: object, coroutine):
+    key = self.get_key(update)
+    if key is None:
+      return await coroutine
+    queue = self.queues.get(key)
+    if queue is not None:
+      if len(queue) >= self.max_pending_updates:
+        coroutine.close()
+        self.dropped += 1
+        print(f"Warning: dropped an update from {key}, {len(queue)} are already waiting")
+      else:
+        queue.append(coroutine)
+      return
+    queue = self.queues[key] = collections.deque()
+    try:
+      while True:
+        try:
+          await coroutine
+        except Exception as e:
+          # Keep processing the updates queued behind the failed one
+          print(f"Warning: could not process an update from {key}: {e!r}")
+        if not queue:
+          break
+        coroutine = queue.popleft()
+    finally:
+      del self.queues[key]
+      # Only left over if cancelled
+      for coroutine in queue:
+        coroutine.close()
+
+  async def initialize(self):
+    pass
+
+  async def shutdown(self):
+    pass
@@ -0,0 +1,168 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Opt-in profiling of the bot handlers, enabled with `TPLFVG_PROFILE=1`.
+
+Every handler is wrapped to time the update it processes, broken down into
+phases: session lookups, upstream requests, message rendering and Bot API
+calls. Updates slower than `TPLFVG_PROFILE_SLOW_MS` are logged as a JSON
+line, and a fraction `TPLFVG_PROFILE_SAMPLE_RATE` of them are run under
+cProfile, with the stats dumped to `TPLFVG_PROFILE_DIR` (they can be turned
+into a flame graph with e.g. flameprof or snakeviz). As updates run
+concurrently on the same event loop, a dump also includes whatever else ran
+while the sampled update was being processed.
+
+Phases are timed with `tplfvg_rt_python_api.timing.timed`, which has no
+dependencies so that e.g. the session store can be used without the bot.
+When profiling is disabled, nothing is wrapped and `timed` returns the
+decorated function unchanged.
+"""
+
+import cProfile
+import functools
+import json
+import logging
+import os
+import random
+import time
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest, RequestData
+
+from tplfvg_rt_python_api import metrics
+from tplfvg_rt_python_api.timing import ENABLED, UpdateProfile, current_profile, timed
+
+logger = logging.getLogger(__name__)
+
+SLOW_MS = float(os.environ.get("TPLFVG_PROFILE_SLOW_MS", 1000))
+SAMPLE_RATE = float(os.environ.get("TPLFVG_PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.environ.get("TPLFVG_PROFILE_DIR", "profiles")
+
+# Only one cProfile profiler can be enabled at a time
+sampling = False
+
+class ProfiledRequest(BaseRequest):
+  """
+  Bot API transport recording the time spent in each call under the
+  `telegram` phase, delegating the actual requests to `request`.
+  """
+
+  def __init__(self, request: BaseRequest):
+    self.request = request
+
+  async def initialize(self):
+    await self.request.initialize()
+
+  async def shutdown(self):
+    await self.request.shutdown()
+
+  @property
+  def read_timeout(self):
+    return self.request.read_timeout
+
+  async def do_request(self, url: str, method: str, request_data: RequestData = None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+    profile = current_profile.get()
+    start = time.perf_counter()
+    try:
+      return await self.request.do_request(
+        url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+      )
+    finally:
+      if profile is not None:
+        profile.add("telegram", time.perf_counter() - start)
+
+def get_update_type(update: object) -> str:
+  if not isinstance(update, Update):
+    return type(update).__name__
+  for kind in Update.ALL_TYPES:
+    if getattr(update, kind, None) is not None:
+      return kind
+  return "unknown"
+
+def dump_profile(profiler: cProfile.Profile, handler: str, update: object) -> str:
+  os.makedirs(PROFILE_DIR, exist_ok=True)
+  update_id = getattr(update, "update_id", 0)
+  path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{handler}-{update_id}.prof")
+  profiler.dump_stats(path)
+  return path
+
+def log_update(handler: str, update: object, total: float, profile: UpdateProfile, events: list[dict], path: str = None):
+  user = getattr(update, "effective_user", None)
+  logger.warning("Slow update: %s", json.dumps({
+    "handler": handler,
+    "update_id": getattr(update, "update_id", None),
+    "update_type": get_update_type(update),
+    "user_id": user.id if user else None,
+    "total_ms": round(total * 1000, 1),
+    "phases_ms": {
+      "upstream": round(sum(event["duration"] for event in events) * 1000, 1),
+      **{phase: round(duration * 1000, 1) for phase, duration in profile.phases.items()}
+    },
+    "calls": {"upstream": len(events), **profile.calls},
+    "upstream": [{
+      "endpoint": event["endpoint"],
+      "ms": round(event["duration"] * 1000, 1),
+      "status": event["status"],
+      "error": type(event["error"]).__name__ if event["error"] else None
+    } for event in events],
+    "profile": path
+  }))
+
+def profile_handler(callback):
+  """
+  Wrap a handler callback to profile the updates it processes.
+  """
+  handler = getattr(callback, "__name__", type(callback).__name__)
+
+  @functools.wraps(callback)
+  async def wrapper(update: object, context):
+    global sampling
+    profile = UpdateProfile()
+    token = current_profile.set(profile)
+    profiler = None
+    if SAMPLE_RATE and not sampling and random.random() < SAMPLE_RATE:
+      profiler = cProfile.Profile()
+      try:
+        profiler.enable()
+        sampling = True
+      except ValueError:
+        # Another profiling tool is active, e.g. the bot runs under cProfile
+        profiler = None
+    start = time.perf_counter()
+    try:
+      with metrics.trace() as events:
+        return await callback(update, context)
+    finally:
+      total = time.perf_counter() - start
+      current_profile.reset(token)
+      path = None
+      if profiler is not None:
+        profiler.disable()
+        sampling = False
+        path = dump_profile(profiler, handler, update)
+      if total * 1000 >= SLOW_MS or path:
+        log_update(handler, update, total, profile, events, path)
+  return wrapper
+
+def instrument(app: Application):
+  """
+  Profile all the handlers registered so far on the application.
+  """
+  for handlers in app.handlers.values():
+    for handler in handlers:
+      handler.callback = profile_handler(handler.callback)
@@ -0,0 +1,216 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Requests answering the user directly, which Telegram does not count against
+# the message limits
+UNLIMITED_ENDPOINTS = {"answerCallbackQuery", "answerInlineQuery", "getMe", "setWebhook", "deleteWebhook"}
+EDIT_ENDPOINTS = {"editMessageText", "editMessageReplyMarkup", "editMessageCaption", "editMessageMedia"}
+
+# Idle per-chat buckets are dropped every so many requests
+PURGE_EVERY = 1000
+
+is_background: contextvars.ContextVar[bool] = contextvars.ContextVar("is_background", default=False)
+
+@contextlib.contextmanager
+def background():
+  """
+  Mark the Bot API requests made within this context (and the tasks it
+  spawns) as background ones, which give way to interactive replies.
+  """
+  token = is_background.set(True)
+  try:
+    yield
+  finally:
+    is_background.reset(token)
+
+class TokenBucket:
+  """
+  Allows `rate` requests per second on average, in bursts of up to `burst`.
+  """
+
+  def __init__(self, rate: float, burst: float):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = time.monotonic()
+
+  def refill(self, now: float):
+    if now > self.updated:
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+
+  def wait_time(self, now: float) -> float:
+    """
+    Seconds until a request can be made, 0 if it can be made now.
+    """
+    self.refill(now)
+    return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+  def is_full(self, now: float) -> bool:
+    return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+class SendScheduler(BaseRateLimiter):
+  """
+  Schedules the outbound Bot API requests to stay within Telegram's flood
+  limits rather than running into 429 errors.
+
+  Requests sending to a chat take a token from a global bucket (`rate`
+  requests per second) and from the bucket of the chat, which allows
+  `chat_rate` requests per second in private chats and `group_rate` in groups
+  and channels, in bursts of up to `chat_burst`. Requests to the same chat are
+  let through in order.
+
+  Background requests (see `background`) give way to interactive ones: they
+  only take a global token while no interactive request is waiting for one.
+  An edit of a message still waiting for its turn is dropped when a newer
+  edit of the same message comes in, returning True as Telegram would.
+
+  On a 429 all requests are held for the `retry_after` given by Telegram, then
+  the failed one is retried, up to `max_retries` times.
+  """
+
+  def __init__(self, rate: float = 30, chat_rate: float = 1, group_rate: float = 20 / 60, chat_burst: float = 3, max_retries: int = 2):
+    self.rate = rate
+    self.chat_rate = chat_rate
+    self.group_rate = group_rate
+    self.chat_burst = chat_burst
+    self.max_retries = max_retries
+    self.bucket = TokenBucket(rate, max(1, rate))
+    self.chat_buckets = {}
+    # chat -> [lock, number of requests holding or waiting for it]
+    self.chat_locks = {}
+    # message -> sequence number of its latest edit
+    self.edits = {}
+    self.sequence = 0
+    self.interactive_waiting = 0
+    self.paused_until = 0.0
+    self.requests = 0
+    self.throttled = 0
+    self.dropped = 0
+    self.retried = 0
+
+  async def initialize(self):
+    pass
+
+  async def shutdown(self):
+    pass
+
+  def stats(self) -> dict:
+    return {
+      "requests": self.requests,
+      "throttled": self.throttled,
+      "dropped": self.dropped,
+      "retried": self.retried,
+      "chats": len(self.chat_buckets)
+    }
+
+  def get_chat_bucket(self, chat_id) -> TokenBucket:
+    bucket = self.chat_buckets.get(chat_id)
+    if bucket is None:
+      rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+      bucket = self.chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+    return bucket
+
+  def purge(self):
+    now = time.monotonic()
+    for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items() if bucket.is_full(now)]:
+      del self.chat_buckets[chat_id]
+
+  async def wait_turn(self, chat_id, low_priority: bool, edit: tuple | None, sequence: int) -> bool:
+    """
+    Wait until the request can be sent and take its tokens. Return False if
+    the request is an edit that was superseded in the meantime.
+    """
+    waiting = throttled = False
+    try:
+      while True:
+        if edit is not None and self.edits.get(edit) != sequence:
+          return False
+        now = time.monotonic()
+        wait = self.paused_until - now
+        if wait <= 0:
+          global_wait = self.bucket.wait_time(now)
+          if not low_priority and global_wait > 0 and not waiting:
+            waiting = True
+            self.interactive_waiting += 1
+          if low_priority and self.interactive_waiting and global_wait <= 0:
+            global_wait = 1 / self.rate
+          wait = max(global_wait, self.get_chat_bucket(chat_id).wait_time(now) if chat_id is not None else 0)
+          if wait <= 0:
+            self.bucket.tokens -= 1
+            if chat_id is not None:
+              self.chat_buckets[chat_id].tokens -= 1
+            return True
+        if not throttled:
+          throttled = True
+          self.throttled += 1
+        await asyncio.sleep(wait)
+    finally:
+      if waiting:
+        self.interactive_waiting -= 1
+
+  async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+    if endpoint in UNLIMITED_ENDPOINTS:
+      return await callback(*args, **kwargs)
+    self.requests += 1
+    if self.requests % PURGE_EVERY == 0:
+      self.purge()
+
+    chat_id = data.get("chat_id") or data.get("inline_message_id")
+    edit = None
+    self.sequence += 1
+    sequence = self.sequence
+    if endpoint in EDIT_ENDPOINTS:
+      edit = (endpoint, chat_id, data.get("message_id"))
+      self.edits[edit] = sequence
+
+    entry = self.chat_locks.get(chat_id)
+    if entry is None:
+      entry = self.chat_locks[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+      for attempt in range(self.max_retries + 1):
+        async with entry[0]:
+          if not await self.wait_turn(chat_id, is_background.get(), edit, sequence):
+            self.dropped += 1
+            return True
+        try:
+          return await callback(*args, **kwargs)
+        except RetryAfter as e:
+          retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+          logger.warning("Flood limit hit on %s, holding all requests for %s seconds", endpoint, retry_after)
+          self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+          if attempt == self.max_retries:
+            raise
+          self.retried += 1
+    finally:
+      entry[1] -= 1
+      if not entry[1]:
+        del self.chat_locks[chat_id]
+      if edit is not None and self.edits.get(edit) == sequence:
+        del self.edits[edit]
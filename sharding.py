@@ -0,0 +1,183 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Multi-process mode: a front process receives updates from Telegram (polling
+or webhook) and routes each one to a worker process chosen by user id, so
+that each user is always served by the same worker, which only loads and
+saves the sessions of its own users.
+
+Workers are started with the spawn method and learn their shard from the
+`TPLFVG_SHARD` environment variable ("index/shards"), which is read while the
+bot module is being imported, i.e. before sessions are loaded. The front
+process only imports what routing needs (see `main.py`): workers import the
+bot themselves, and are restarted if they die.
+"""
+
+import asyncio
+import importlib
+import multiprocessing
+import os
+import signal
+import time
+
+from telegram import Update
+from telegram.ext import Application, ApplicationHandlerStop, ContextTypes, TypeHandler
+
+SHARD_ENV = "TPLFVG_SHARD"
+# Workers are checked this often (in seconds), and a dead worker is restarted
+# at most this often
+SUPERVISE_INTERVAL = 5
+
+def get_shard() -> tuple[int, int] | None:
+  """
+  Shard of the current process as (index, shards), None if not sharded.
+  """
+  shard = os.environ.get(SHARD_ENV)
+  if not shard:
+    return None
+  index, shards = shard.split("/")
+  return int(index), int(shards)
+
+def get_update_shard(update: Update, shards: int) -> int:
+  """
+  Shard in charge of the given update. Updates are routed by user id (by chat
+  id for updates without a user), the same as `SessionStore` partitions
+  sessions.
+  """
+  if update.effective_user:
+    return update.effective_user.id % shards
+  if update.effective_chat:
+    return update.effective_chat.id % shards
+  return 0
+
+def run_worker(target: str, token: str, queue: multiprocessing.Queue):
+  """
+  Entry point of the worker processes: build the application with the
+  function given as "module:function" and process the updates received on
+  the queue until None is received.
+  """
+  # Interrupts are handled by the front process, which stops the workers
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  module, function = target.split(":")
+  build_application = getattr(importlib.import_module(module), function)
+  asyncio.run(serve_worker(build_application(token), queue))
+
+async def serve_worker(app: Application, queue: multiprocessing.Queue):
+  async with app:
+    if app.post_init:
+      await app.post_init(app)
+    await app.start()
+    try:
+      while (data := await asyncio.to_thread(queue.get)) is not None:
+        await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+      await app.stop()
+      if app.post_shutdown:
+        await app.post_shutdown(app)
+
+class UpdateRouter:
+  """
+  Front end of the multi-process mode: starts `shards` workers running the
+  application built by `target` ("module:function", called with the token)
+  and forwards updates to them. Workers found dead, when routing an update
+  to them or every `SUPERVISE_INTERVAL` seconds, are restarted on the same
+  queue, so that the updates routed to them meanwhile are not lost.
+  """
+
+  def __init__(self, target: str, token: str, shards: int):
+    self.target = target
+    self.token = token
+    self.shards = shards
+    self.context = multiprocessing.get_context("spawn")
+    self.queues = [self.context.Queue() for _ in range(shards)]
+    self.processes = [None] * shards
+    self.started_at = [0.0] * shards
+    self.restarts = 0
+    self.supervisor = None
+
+  def start_worker(self, index: int):
+    os.environ[SHARD_ENV] = f"{index}/{self.shards}"
+    try:
+      process = self.context.Process(
+        target=run_worker,
+        args=(self.target, self.token, self.queues[index]),
+        name=f"tplfvg-worker-{index}"
+      )
+      process.start()
+    finally:
+      del os.environ[SHARD_ENV]
+    self.processes[index] = process
+    self.started_at[index] = time.monotonic()
+
+  def start(self):
+    for index in range(self.shards):
+      self.start_worker(index)
+
+  def check_worker(self, index: int):
+    """
+    Restart the worker of the given shard if it died, unless it was (re)started
+    less than `SUPERVISE_INTERVAL` seconds ago, e.g. while it keeps crashing.
+    """
+    process = self.processes[index]
+    if process is None or process.is_alive() or time.monotonic() - self.started_at[index] < SUPERVISE_INTERVAL:
+      return
+    print(f"Warning: {process.name} died with exit code {process.exitcode}, restarting it")
+    process.close()
+    self.restarts += 1
+    self.start_worker(index)
+
+  async def supervise(self):
+    while True:
+      await asyncio.sleep(SUPERVISE_INTERVAL)
+      for index in range(self.shards):
+        self.check_worker(index)
+
+  def stop(self, timeout: float = 30):
+    for queue in self.queues:
+      queue.put(None)
+    for process in self.processes:
+      if process is None:
+        continue
+      process.join(timeout)
+      if process.is_alive():
+        print(f"Warning: {process.name} did not stop in time, terminating it")
+        process.terminate()
+    self.processes = [None] * self.shards
+
+  async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    shard = get_update_shard(update, self.shards)
+    self.check_worker(shard)
+    self.queues[shard].put(update.to_dict())
+    raise ApplicationHandlerStop
+
+  def build_front_application(self) -> Application:
+    """
+    Build the application receiving updates in the front process. Workers are
+    started, supervised and stopped along with it.
+    """
+    async def startup(application: Application):
+      self.start()
+      self.supervisor = asyncio.get_running_loop().create_task(self.supervise())
+
+    async def shutdown(application: Application):
+      if self.supervisor is not None:
+        self.supervisor.cancel()
+      await asyncio.to_thread(self.stop)
+
+    app = Application.builder().token(self.token).post_init(startup).post_shutdown(shutdown).build()
+    app.add_handler(TypeHandler(Update, self.route))
+    return app
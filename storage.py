@@ -0,0 +1,166 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import os
+import sqlite3
+
+from tplfvg_rt_python_api.timing import timed
+
+class SessionStore:
+  """
+  User sessions kept in memory in a dict keyed by user id and persisted to a
+  SQLite database (WAL mode, one row per user) in batches: updates only mark
+  sessions as dirty, and dirty sessions are written out every `flush_interval`
+  seconds by a background task once `start()` has been called.
+
+  When the bot is sharded across processes, each one only loads the sessions
+  of its `shard`, given as (index, number of shards); see `sharding`.
+  """
+
+  def __init__(self, path: str, flush_interval: float = 5.0, shard: tuple[int, int] = None):
+    self.path = path
+    self.flush_interval = flush_interval
+    self.sessions = {}
+    self.dirty = set()
+    self.flush_task = None
+
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.execute(
+      "CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+    )
+    self.db.commit()
+    if shard is None:
+      rows = self.db.execute("SELECT user_id, data FROM sessions")
+    else:
+      index, shards = shard
+      rows = self.db.execute("SELECT user_id, data FROM sessions WHERE user_id % ? = ?", (shards, index))
+    for user_id, data in rows:
+      self.sessions[user_id] = json.loads(data)
+
+  def __len__(self):
+    return len(self.sessions)
+
+  def __contains__(self, user_id):
+    return user_id in self.sessions
+
+  @timed("session")
+  def get(self, user_id: int) -> dict:
+    """
+    Return the session of the given user, creating an empty one if needed.
+
+    The returned dict is the live session: it reflects later upserts, but it
+    must not be modified directly, as changes would not be persisted.
+    """
+    session = self.sessions.get(user_id)
+    if session is None:
+      session = self.sessions[user_id] = {"user_id": user_id}
+    return session
+
+  @timed("session")
+  def upsert(self, user_id: int, fields: dict):
+    """
+    Update the session of the given user with the given fields and schedule
+    it for persistence.
+    """
+    self.get(user_id).update(fields)
+    self.dirty.add(user_id)
+
+  def iter_sessions(self):
+    """
+    Iterate over the sessions of this process (of its shard only, if sharded),
+    including changes not persisted yet. Sessions are live, as returned by
+    `get`; the ones existing when iteration starts are listed.
+    """
+    yield from list(self.sessions.values())
+
+  def take_dirty_rows(self) -> list[tuple[int, str]]:
+    rows = [(user_id, json.dumps(self.sessions[user_id])) for user_id in self.dirty]
+    self.dirty.clear()
+    return rows
+
+  def write_rows(self, rows: list[tuple[int, str]]):
+    with self.db:
+      self.db.executemany(
+        "INSERT INTO sessions (user_id, data) VALUES (?, ?) " + \
+          "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+        rows
+      )
+
+  def flush(self):
+    """
+    Synchronously persist all dirty sessions.
+    """
+    if self.dirty:
+      self.write_rows(self.take_dirty_rows())
+
+  async def flush_periodically(self):
+    while True:
+      await asyncio.sleep(self.flush_interval)
+      if self.dirty:
+        # Serialize in the event loop, so that sessions are not read while
+        # being updated, and write in a worker thread
+        rows = self.take_dirty_rows()
+        try:
+          await asyncio.to_thread(self.write_rows, rows)
+        except Exception as e:
+          print(f"Warning: could not persist {len(rows)} sessions: {e!r}")
+          self.dirty.update(user_id for user_id, _ in rows)
+
+  def start(self):
+    """
+    Start the background write-behind task on the running event loop.
+    """
+    if self.flush_task is None:
+      self.flush_task = asyncio.get_running_loop().create_task(self.flush_periodically())
+
+  async def close(self):
+    """
+    Stop the background task, persist pending changes and close the database.
+    """
+    if self.flush_task is not None:
+      self.flush_task.cancel()
+      try:
+        await self.flush_task
+      except asyncio.CancelledError:
+        pass
+      self.flush_task = None
+    self.flush()
+    self.db.close()
+
+def migrate_from_tinydb(store: SessionStore, path: str = "storage.json", table: str = "sessions"):
+  """
+  One-shot import of sessions from the TinyDB JSON database formerly used by
+  the bot. The JSON file is renamed once imported, so that it is not imported
+  again on later runs.
+  """
+  if not os.path.exists(path):
+    return 0
+  with open(path, "r") as f:
+    documents = (json.loads(f.read() or "{}").get(table) or {}).values()
+  migrated = 0
+  for document in documents:
+    if "user_id" not in document:
+      continue
+    store.upsert(document["user_id"], document)
+    migrated += 1
+  store.flush()
+  os.replace(path, path + ".migrated")
+  print(f"Migrated {migrated} sessions from {path}")
+  return migrated
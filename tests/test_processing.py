@@ -0,0 +1,65 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+import time
+import unittest
+
+from telegram import Chat, Message, Update, User
+
+from processing import PerUserUpdateProcessor
+
+def make_update(update_id: int, user_id: int) -> Update:
+  return Update(update_id, message=Message(
+    update_id, datetime.datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=User(user_id, "Test", False), text="/start"
+  ))
+
+class PerUserUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self):
+    self.processed = []
+
+  async def handle(self, update: Update, duration: float):
+    await asyncio.sleep(duration)
+    self.processed.append((update.effective_user.id, update.update_id, time.monotonic()))
+
+  def submit(self, processor: PerUserUpdateProcessor, update: Update, duration: float) -> asyncio.Task:
+    return asyncio.create_task(processor.process_update(update, self.handle(update, duration)))
+
+  async def test_flooding_user_does_not_stall_others(self):
+    processor = PerUserUpdateProcessor(8, max_pending_updates=1000)
+    started = time.monotonic()
+    tasks = [self.submit(processor, make_update(i, 1), 0.01) for i in range(100)]
+    await asyncio.sleep(0)
+    tasks.append(self.submit(processor, make_update(1000, 2), 0.01))
+    await asyncio.gather(*tasks)
+
+    other = [finished for user_id, _, finished in self.processed if user_id == 2]
+    self.assertEqual(len(other), 1)
+    self.assertLess(other[0] - started, 0.2)
+    # The flooding user's updates are all processed, in order
+    self.assertEqual([update_id for user_id, update_id, _ in self.processed if user_id == 1], list(range(100)))
+
+  async def test_drops_updates_past_pending_limit(self):
+    processor = PerUserUpdateProcessor(8, max_pending_updates=3)
+    await asyncio.gather(*[self.submit(processor, make_update(i, 1), 0.01) for i in range(10)])
+    self.assertEqual([update_id for _, update_id, _ in self.processed], [0, 1, 2, 3])
+    self.assertEqual(processor.dropped, 6)
+    self.assertFalse(processor.queues)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,94 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import unittest
+
+from utils import split_entities_if_needed, CONTINUED_SUFFIX
+
+class SplitEntitiesTest(unittest.TestCase):
+
+  def split(self, sections: list[str], separator: str = "\n\n") -> list[str]:
+    """
+    Split the sections joined by `separator`, checking that the chunks add up
+    to the whole message.
+    """
+    msg = separator.join(sections)
+    chunks = split_entities_if_needed(msg)
+    for chunk in chunks[:-1]:
+      self.assertTrue(chunk.endswith(CONTINUED_SUFFIX))
+    self.assertEqual(separator.join(chunk.removesuffix(CONTINUED_SUFFIX) for chunk in chunks), msg)
+    return chunks
+
+  def test_short_message_is_not_split(self):
+    self.assertEqual(split_entities_if_needed("*Linea 9* ⇒ _Stazione_"), ["*Linea 9* ⇒ _Stazione_"])
+
+  def test_formatting(self):
+    for marker in ["*", "_", "__", "~", "||"]:
+      with self.subTest(marker=marker):
+        chunks = self.split([f"{marker}{i}{marker}" for i in range(150)])
+        self.assertEqual(len(chunks), 2)
+        # One entity per section, plus the continuation notice
+        self.assertEqual(chunks[0].count("\n\n"), 98 + 1)
+        for chunk in chunks:
+          self.assertEqual(chunk.removesuffix(CONTINUED_SUFFIX).count(marker) % 2, 0)
+
+  def assert_split_after(self, first: str):
+    """
+    Check that markers within `first` do not leave formatting open, which
+    would leave no place to split the bold sections following it.
+    """
+    chunks = self.split([first] + [f"*{i}*" for i in range(150)])
+    self.assertEqual(len(chunks), 2)
+    for chunk in chunks:
+      self.assertLessEqual(len(re.findall(r"\*\d+\*", chunk)), 99)
+
+  def test_code(self):
+    self.assert_split_after("`a*b_c`")
+
+  def test_pre(self):
+    self.assert_split_after("```\n*\n\n_\n```")
+    chunks = self.split([f"```\n{i}\n\n{i}\n```" for i in range(150)])
+    self.assertEqual(len(chunks), 2)
+    for chunk in chunks:
+      self.assertEqual(chunk.count("```") % 2, 0)
+
+  def test_links(self):
+    self.assert_split_after("[*link*](https://example.com/a_b\\))")
+    chunks = self.split([f"[{i}](https://example.com/{i})" for i in range(150)])
+    self.assertEqual(len(chunks), 2)
+    for chunk in chunks:
+      self.assertEqual(chunk.count("["), chunk.count("]("))
+
+  def test_blockquotes(self):
+    quotes = ["\n".join(f">{i}.{j} *x*" for j in range(10)) + f"\nafter {i}" for i in range(12)]
+    chunks = self.split(quotes, "\n")
+    self.assertGreater(len(chunks), 1)
+    # Quotes are only split before they start
+    for chunk in chunks:
+      self.assertTrue(chunk.startswith("after") or chunk.split(" ")[0].endswith(".0"), chunk[:10])
+
+  def test_expandable_blockquotes(self):
+    self.assert_split_after("**>start\n>end||")
+    quotes = ["**>" + "\n>".join(f"{i}.{j} *x*" for j in range(10)) + f"||\nafter {i}" for i in range(12)]
+    chunks = self.split(quotes, "\n")
+    self.assertGreater(len(chunks), 1)
+    for chunk in chunks:
+      self.assertTrue(chunk.startswith("after") or chunk.startswith("**>"), chunk[:10])
+      self.assertEqual(chunk.count("**>"), chunk.count("||"))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,75 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import types
+import unittest
+from unittest import mock
+
+from tplfvg_rt_python_api import async_utils
+from tplfvg_rt_python_api.async_api import get_stop_monitor_params, get_stop_info_params
+from tplfvg_rt_python_api.cache import get_rt_cache, make_cache_key
+from storage import SessionStore
+from warmer import CacheWarmer
+
+STOP_CODE = "01002"
+
+class CacheWarmerTest(unittest.IsolatedAsyncioTestCase):
+
+  def setUp(self):
+    self.monitors = get_rt_cache("polemonitor/mrcruns")
+    self.infos = get_rt_cache("polemonitor/info")
+    self.monitor_key = make_cache_key(get_stop_monitor_params(STOP_CODE))
+    self.monitors.invalidate()
+    self.infos.invalidate()
+    # Stop information is cached, so that only the monitor may be fetched
+    self.infos.put(make_cache_key(get_stop_info_params(STOP_CODE)), [time.time(), {}])
+    self.sessions = SessionStore(":memory:")
+    self.warmer = CacheWarmer(self.sessions, interval=10)
+    for _ in range(5):
+      self.warmer.record(STOP_CODE)
+    self.send_request = mock.AsyncMock(return_value=types.SimpleNamespace(content=b"[]"))
+
+  def tearDown(self):
+    self.monitors.invalidate()
+    self.infos.invalidate()
+
+  async def test_refetches_monitor_about_to_expire(self):
+    self.monitors.put(self.monitor_key, [time.time() - 5, []], ttl=5)
+    with mock.patch.object(async_utils, "send_request", self.send_request):
+      await self.warmer.tick()
+    self.send_request.assert_awaited_once()
+    self.assertEqual(self.send_request.await_args.args[0], "polemonitor/mrcruns")
+    self.assertGreater(self.monitors.expires_in(self.monitor_key), 5)
+    self.assertEqual(self.warmer.warmed, 1)
+    self.assertEqual(len(self.warmer.calls), 1)
+
+  async def test_skips_monitor_fresh_until_next_tick(self):
+    self.monitors.put(self.monitor_key, [time.time(), []], ttl=60)
+    with mock.patch.object(async_utils, "send_request", self.send_request):
+      await self.warmer.tick()
+    self.send_request.assert_not_awaited()
+    self.assertEqual(self.warmer.warmed, 0)
+    self.assertEqual(len(self.warmer.calls), 0)
+
+  def test_counts_stops_referenced_by_sessions(self):
+    self.sessions.upsert(1, {"fav_stops": {STOP_CODE: "Casa", "01003": None}, "recent_stops": [f"/{STOP_CODE} Stazione", "/01004 Piazza"]})
+    self.sessions.upsert(2, {"recent_stops": ["/01004 Piazza"]})
+    self.warmer.update_refs()
+    self.assertEqual(dict(self.warmer.refs), {STOP_CODE: 1, "01004": 2})
+
+if __name__ == "__main__":
+  unittest.main()
@@ -15,34 +15,150 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import geojson
+import dataclasses
 import datetime
 import json
 
-from .model import RTResult, StopInfo, RouteStop
+from .model import RTResult, StopInfo, RouteStop, Route, Monitor
 from .utils import build_square, make_api_request, make_rt_api_request
+from .cache import MISSING, route_cache
 
 
-def get_stops_by_location(lat: float, lng: float):
+def build_stops_polygon(lat: float, lng: float, side_length: float = 0.4) -> str:
   """
-  Construct a polygon around the (latitude, longitude) point and request
-  stops inside the generated polygon.
+  Construct a polygon around the (latitude, longitude) point and serialize it
+  as the GeoJSON feature expected by the polygon stop search endpoint.
   """
-  square = build_square(lat, lng, 0.4)
-  
+  square = build_square(lat, lng, side_length)
+
   # Invert latitude and longitude coordinates when building 
   # the Polygon object, for some reason
   polygon = geojson.Polygon([[(y, x) for x, y in square]])
+  return geojson.dumps(geojson.Feature(geometry=polygon))
 
-  f = make_api_request("polygon", data=geojson.dumps(
-    geojson.Feature(geometry=polygon)
-  ))
-  if not f:
-    return None
+def parse_stops_by_location(f: str):
+  """
+  Convert the GeoJSON body returned by the polygon stop search endpoint into
+  the list of stops (`id`, `text`) used by the keyword search as well.
+  """
   return [{
     "id": feature.properties["code"],
     "text": feature.properties["name"]
   } for feature in geojson.loads(f).features]
 
+def parse_stops_by_keyword(f: str):
+  """
+  Extract the list of stops from the keyword stop search response body.
+  """
+  return json.loads(f)["results"]
+
+def parse_stop_info(f: dict) -> StopInfo:
+  """
+  Build a StopInfo out of a `polemonitor/info` response.
+  """
+  return StopInfo(
+    address=f["Address"],
+    stop_code=f["StopCode"],
+    latitude=f["Latitude"],
+    longitude=f["Longitude"],
+    is_urban=f["IsUrban"],
+    is_extraurban=f["IsExtraUrban"],
+    is_maritime=f["IsMaritime"],
+    is_station=f["IsStation"]
+  )
+
+def parse_line_route(f: list) -> Route:
+  """
+  Build the Route out of a `polemonitor/getlinetimetable` response.
+  """
+  return Route([RouteStop(
+    stop["SequenceNumber"],
+    stop["LineSequenceNumber"],
+    stop["StopCode"],
+    stop["StopDescription"],
+    stop["StopType"],
+    stop["Time"]
+  ) for stop in f])
+
+def save_route_cache(path: str):
+  """
+  Save the trip routes cached for the current service day to disk.
+  """
+  route_cache.save(path, encode=lambda route: [dataclasses.asdict(stop) for stop in route])
+
+def load_route_cache(path: str) -> int:
+  """
+  Load trip routes saved by `save_route_cache`, if they are still valid.
+  """
+  return route_cache.load(path, decode=lambda stops: Route(RouteStop(**stop) for stop in stops))
+
+def is_iso_datetime(dt) -> bool:
+  """
+  Quick check for strings shaped like an ISO datetime, e.g.
+  2024-05-06T08:10:00, as opposed to labels such as "2'".
+  """
+  return type(dt) is str and len(dt) >= 19 and dt[4] == "-" and dt[10] == "T"
+
+def convert_rt_time_string_to_datetime(dt):
+  """
+  Convert a stop arrival time string into a datetime.datetime object.
+
+  Stop arrival time can either be in datetime ISO format or in the form of
+  a string label.
+  """
+  if is_iso_datetime(dt):
+    try:
+      return datetime.datetime.fromisoformat(dt)
+    except ValueError:
+      pass
+  return dt
+
+def parse_stop_monitor(f: list, fetched_at: datetime.datetime = None) -> Monitor:
+  """
+  Build the Monitor out of a `polemonitor/mrcruns` response fetched at the
+  given time (now by default).
+
+  The whole response is decoded in a single pass; times shared by several
+  results, e.g. the scheduled departures of different lines, are only parsed
+  once.
+  """
+  times = {}
+
+  def convert(dt):
+    converted = times.get(dt)
+    if converted is None:
+      converted = times[dt] = convert_rt_time_string_to_datetime(dt)
+    return converted
+
+  # Fields are given positionally, in the order RTResult declares them
+  return Monitor([RTResult(
+    result["Line"],
+    convert(result["DepartureTime"]),
+    result["Destination"],
+    convert(result["ArrivalTime"]),
+    result["NextPasses"],
+    result["Direction"],
+    result["LineCode"],
+    result["LineType"],
+    result["Departure"],
+    result["Vehicle"],
+    result["Race"],
+    result["Latitude"],
+    result["Longitude"],
+    result["Note"],
+    result["IsDestination"]
+  ) for result in f], fetched_at)
+
+def get_stops_by_location(lat: float, lng: float):
+  """
+  Construct a polygon around the (latitude, longitude) point and request
+  stops inside the generated polygon.
+  """
+  f = make_api_request("polygon", data=build_stops_polygon(lat, lng))
+  if not f:
+    return None
+  return parse_stops_by_location(f)
+
 
 def get_stops_by_keyword(query: str):
   """
@@ -53,7 +169,7 @@ def get_stops_by_keyword(query: str):
   })
   if not f:
     return None
-  return json.loads(f)["results"]
+  return parse_stops_by_keyword(f)
 
 
 def get_stop_info(stop_code: str):
@@ -70,21 +186,18 @@ def get_stop_info(stop_code: str):
   )
   if not f or f == "null":
     return None
-  return StopInfo(
-    address=f["Address"],
-    stop_code=f["StopCode"],
-    latitude=f["Latitude"],
-    longitude=f["Longitude"],
-    is_urban=f["IsUrban"],
-    is_extraurban=f["IsExtraUrban"],
-    is_maritime=f["IsMaritime"],
-    is_station=f["IsStation"]
-  )
+  return parse_stop_info(f)
 
-def get_line_route(line_code: str, trip_direction: str, trip_id: str) -> list[RouteStop]:
+def get_line_route(line_code: str, trip_direction: str, trip_id: str) -> Route:
   """
   Query RT API for route information for the given trip of the given line. 
+
+  Routes do not change during a service day, so they are cached until the
+  end of it.
   """
+  route = route_cache.get((line_code, trip_direction, trip_id), MISSING)
+  if route is not MISSING:
+    return route
 
   f = make_rt_api_request(
     "polemonitor/getlinetimetable",
@@ -97,16 +210,11 @@ def get_line_route(line_code: str, trip_direction: str, trip_id: str) -> list[Ro
   )
   if not f:
     return None
-  return [RouteStop(
-    seq=stop["SequenceNumber"],
-    line_seq=stop["LineSequenceNumber"],
-    stop_code=stop["StopCode"],
-    stop_description=stop["StopDescription"],
-    stop_type=stop["StopType"],
-    time=stop["Time"]
-  ) for stop in f]
+  route = parse_line_route(f)
+  route_cache.put((line_code, trip_direction, trip_id), route)
+  return route
 
-def get_stop_monitor(stop_code: str) -> list[RTResult]:
+def get_stop_monitor(stop_code: str) -> Monitor:
   """
   Query RT API for results that would be shown on a pole monitor, i.e. expected
   and scheduled bus trips calling at the given stop. The returned results can
@@ -118,19 +226,10 @@ def get_stop_monitor(stop_code: str) -> list[RTResult]:
   The `arrival_time` refers to the stop in question and is usually given in
   minutes or as a label when tracking information is included, or as a time
   label otherwise.
-  """
-
-  def convert_rt_time_string_to_datetime(dt):
-    """
-    Convert a stop arrival time string into a datetime.datetime object.
 
-    As mentioned above, stop arrival time can either be in datetime ISO format
-    or in the form of a string label.
-    """
-    try:
-      return datetime.datetime.fromisoformat(dt)
-    except:
-      return dt
+  None is only returned when the request failed, while a stop with no
+  departures gets an empty Monitor.
+  """
 
   f = make_rt_api_request(
     "polemonitor/mrcruns",
@@ -140,25 +239,9 @@ def get_stop_monitor(stop_code: str) -> list[RTResult]:
       "IsUrban": True
     }
   )
-  if not f:
+  if f is None:
     return None
-  return [RTResult(
-    line=result["Line"],
-    departure_time=convert_rt_time_string_to_datetime(result["DepartureTime"]),
-    arrival_time=convert_rt_time_string_to_datetime(result["ArrivalTime"]),
-    destination=result["Destination"],
-    origin=result["Departure"],
-    next_passes=result["NextPasses"],
-    direction=result["Direction"],
-    line_code=result["LineCode"],
-    line_type=result["LineType"],
-    vehicle=result["Vehicle"],
-    trip=result["Race"],
-    latitude=result["Latitude"],
-    longitude=result["Longitude"],
-    notes=result["Note"],
-    is_destination=result["IsDestination"]
-  ) for result in f]
+  return parse_stop_monitor(f)
 
 # print(build_square(45.651646, 13.7693294, 1.0))
 # print(get_stops_by_location(45.651646, 13.7693294))
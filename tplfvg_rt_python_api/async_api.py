@@ -0,0 +1,123 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+
+from .model import RTResult, StopInfo, RouteStop, Route, Monitor
+from .api import build_stops_polygon, parse_stops_by_location, parse_stops_by_keyword, parse_stop_info, parse_line_route, parse_stop_monitor
+from .async_utils import make_api_request, make_rt_api_request, fetch_rt_api_response
+from .cache import route_cache, get_rt_cache, make_cache_key
+
+
+async def get_stops_by_location(lat: float, lng: float):
+  """
+  Construct a polygon around the (latitude, longitude) point and request
+  stops inside the generated polygon.
+  """
+  f = await make_api_request("polygon", data=build_stops_polygon(lat, lng))
+  if not f:
+    return None
+  return parse_stops_by_location(f)
+
+
+async def get_stops_by_keyword(query: str):
+  """
+  Query the bus stop service for stops matching the given keyword(s).
+  """
+  f = await make_api_request("keyword", data={
+    "query": query
+  })
+  if not f:
+    return None
+  return parse_stops_by_keyword(f)
+
+
+def get_stop_info_params(stop_code: str) -> dict:
+  return {
+    "StopCode": stop_code
+  }
+
+def get_stop_monitor_params(stop_code: str) -> dict:
+  return {
+    "StopCode": stop_code,
+    "IsUrban": True
+  }
+
+def get_cached_ttl(endpoint: str, params: dict) -> float:
+  """
+  Seconds for which the cached response to the given RT API request is still
+  fresh, 0 if it is not cached.
+  """
+  cache = get_rt_cache(endpoint)
+  return cache.expires_in(make_cache_key(params)) if cache is not None else 0
+
+async def get_stop_info(stop_code: str) -> StopInfo:
+  """
+  Query RT API for information about the stop with the given stop_code.
+  """
+  f = await make_rt_api_request(
+    "polemonitor/info",
+    method="GET",
+    params=get_stop_info_params(stop_code)
+  )
+  if not f or f == "null":
+    return None
+  return parse_stop_info(f)
+
+async def get_line_route(line_code: str, trip_direction: str, trip_id: str) -> Route:
+  """
+  Query RT API for route information for the given trip of the given line.
+
+  Routes do not change during a service day, so they are cached until the
+  end of it.
+  """
+  async def fetch():
+    f = await make_rt_api_request(
+      "polemonitor/getlinetimetable",
+      method="GET",
+      params={
+        "Line": line_code,
+        "Direction": trip_direction,
+        "Race": trip_id
+      }
+    )
+    if not f:
+      raise LookupError(f"No route found for trip {trip_id} of line {line_code}")
+    return parse_line_route(f)
+
+  try:
+    return await route_cache.get_or_fetch((line_code, trip_direction, trip_id), fetch)
+  except LookupError:
+    return None
+
+async def get_stop_monitor(stop_code: str) -> Monitor:
+  """
+  Query RT API for results that would be shown on a pole monitor. See
+  `api.get_stop_monitor` for details about the returned results.
+
+  When the RT API is slow or unavailable, the last results fetched for the
+  stop may be returned instead: their `fetched_at` tells how old they are.
+  None is only returned when no results could be fetched at all, while a stop
+  with no departures gets an empty Monitor.
+  """
+  f, fetched_at = await fetch_rt_api_response(
+    "polemonitor/mrcruns",
+    method="GET",
+    params=get_stop_monitor_params(stop_code)
+  )
+  if f is None:
+    return None
+  return parse_stop_monitor(f, datetime.datetime.fromtimestamp(fetched_at))
@@ -0,0 +1,202 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import httpx
+import logging
+import time
+
+from .utils import API_URL, RT_API_URL, API_HEADERS, RT_API_HEADERS, json_loads
+from .breaker import CircuitOpenError, get_breaker
+from .cache import get_rt_cache, make_cache_key
+from .metrics import measure
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_MAX_CONNECTIONS = 32
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 16
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+DEFAULT_MAX_CONCURRENCY = 32
+
+config = {
+  "timeout": DEFAULT_TIMEOUT,
+  "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+  "max_connections": DEFAULT_MAX_CONNECTIONS,
+  "max_keepalive_connections": DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+  "keepalive_expiry": DEFAULT_KEEPALIVE_EXPIRY,
+  "max_concurrency": DEFAULT_MAX_CONCURRENCY
+}
+
+client: httpx.AsyncClient | None = None
+semaphore: asyncio.Semaphore | None = None
+
+def configure(**kwargs):
+  """
+  Update the HTTP client configuration. Accepted keys are the ones in `config`:
+  `timeout` (read/write/pool timeout, seconds), `connect_timeout` (seconds),
+  `max_connections`, `max_keepalive_connections`, `keepalive_expiry` (seconds)
+  and `max_concurrency`, i.e. the maximum number of upstream requests in flight
+  at the same time across the whole process.
+
+  The configuration is applied when the client is (re)created, so this should
+  be called before the first request or after `close()`.
+  """
+  for key in kwargs:
+    if key not in config:
+      raise ValueError(f"Unknown HTTP client option {key!r}")
+  config.update({key: value for key, value in kwargs.items() if value is not None})
+
+def get_client() -> httpx.AsyncClient:
+  """
+  Return the shared pooled, keep-alive HTTP client, creating it if needed.
+  """
+  global client, semaphore
+  if client is None or client.is_closed:
+    client = httpx.AsyncClient(
+      timeout=httpx.Timeout(config["timeout"], connect=config["connect_timeout"]),
+      limits=httpx.Limits(
+        max_connections=config["max_connections"],
+        max_keepalive_connections=config["max_keepalive_connections"],
+        keepalive_expiry=config["keepalive_expiry"]
+      )
+    )
+    semaphore = asyncio.Semaphore(config["max_concurrency"])
+  return client
+
+async def close():
+  """
+  Close the shared HTTP client and release pooled connections.
+  """
+  global client, semaphore
+  if client is not None:
+    await client.aclose()
+  client = None
+  semaphore = None
+
+async def send_request(endpoint, method, url, headers, data=None, params=None) -> httpx.Response:
+  """
+  Send a request through the shared client, waiting for a free slot if the
+  global concurrency cap has been reached. Non-2xx responses raise. The time
+  spent on the request itself (not waiting for a slot) is recorded in
+  `metrics` under the given endpoint name.
+
+  Connection errors, timeouts and 5xx responses count as failures of the
+  endpoint's circuit breaker: while it is open, requests fail right away with
+  `CircuitOpenError`.
+  """
+  breaker = get_breaker(endpoint)
+  if not breaker.allow():
+    raise CircuitOpenError(f"Circuit for {endpoint} is open")
+  http = get_client()
+  if isinstance(data, (str, bytes)):
+    body = {"content": data}
+  else:
+    body = {"data": data}
+  if params:
+    # Keep the same encoding as requests, e.g. True -> "True"
+    params = {key: str(value) if isinstance(value, bool) else value for key, value in params.items()}
+  try:
+    async with semaphore:
+      with measure(endpoint.strip("/")) as m:
+        response = await http.request(method, url, headers=headers, params=params, **body)
+        m["status"] = response.status_code
+        response.raise_for_status()
+  except httpx.HTTPStatusError as e:
+    if e.response.status_code >= 500:
+      breaker.record_failure()
+    else:
+      breaker.record_success()
+    raise
+  except httpx.TransportError:
+    breaker.record_failure()
+    raise
+  except BaseException:
+    breaker.release()
+    raise
+  breaker.record_success()
+  return response
+
+async def make_api_request(endpoint, headers={}, method="POST", data=None):
+  """
+  Asynchronous counterpart of `utils.make_api_request`.
+
+  The response body is returned as a string. Exceptions are logged and None
+  is returned in case one is thrown.
+  """
+  try:
+    response = await send_request(
+      endpoint,
+      method,
+      API_URL + endpoint + ("" if endpoint.endswith("/") else "/"),
+      headers={
+        **API_HEADERS,
+        **headers
+      },
+      data=data
+    )
+    return response.text
+  except Exception as e:
+    logger.warning("Request to %s failed: %r", endpoint, e)
+  return None
+
+async def fetch_rt_api_response(endpoint, headers={}, method="POST", data=None, params=None, refresh=False):
+  """
+  Same as `make_rt_api_request`, but return the response body along with the
+  time (as a Unix timestamp) it was fetched from the RT API, which for cached
+  responses can be in the past, or (None, None) on failure.
+
+  Cached endpoints may serve a stale response while it is being refreshed in
+  the background or when refreshing it fails, see `cache.TTLCache`. With
+  `refresh`, a cached response is fetched again even if it is still fresh.
+  """
+  async def fetch():
+    response = await send_request(
+      endpoint,
+      method,
+      RT_API_URL + endpoint + ("" if endpoint.endswith("/") else "/"),
+      headers={
+        **RT_API_HEADERS,
+        **headers
+      },
+      data=data,
+      params=params
+    )
+    return [time.time(), json_loads(response.content)]
+
+  cache = get_rt_cache(endpoint) if method == "GET" else None
+  try:
+    if cache is None:
+      fetched_at, result = await fetch()
+    else:
+      fetched_at, result = await cache.get_or_fetch(make_cache_key(params), fetch, refresh)
+    return result, fetched_at
+  except Exception as e:
+    logger.warning("Request to %s failed: %r", endpoint, e)
+  return None, None
+
+async def make_rt_api_request(endpoint, headers={}, method="POST", data=None, params=None):
+  """
+  Asynchronous counterpart of `utils.make_rt_api_request`.
+
+  The response body is returned as a json object. GET requests to endpoints
+  with a cache (see `cache.RT_CACHE_CONFIG`) are served from it when possible,
+  and concurrent identical requests share a single upstream call. Exceptions
+  are logged and None is returned in case one is thrown.
+  """
+  result, _ = await fetch_rt_api_response(endpoint, headers, method, data, params)
+  return result
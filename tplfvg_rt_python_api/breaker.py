@@ -0,0 +1,113 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+class CircuitOpenError(Exception):
+  """
+  Raised instead of sending a request to an endpoint whose circuit is open.
+  """
+
+class CircuitBreaker:
+  """
+  Stops sending requests to an endpoint after `failure_threshold` consecutive
+  failures, so that an unresponsive upstream is not piled up on. After
+  `reset_timeout` seconds a single trial request is let through: the circuit
+  closes again if it succeeds and stays open for another `reset_timeout`
+  seconds otherwise.
+  """
+
+  def __init__(self, name: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+    self.name = name
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.failures = 0
+    self.opened_at = None
+    self.trial = False
+    self.rejected = 0
+
+  @property
+  def state(self) -> str:
+    if self.opened_at is None:
+      return "closed"
+    if time.monotonic() - self.opened_at < self.reset_timeout or self.trial:
+      return "open"
+    return "half-open"
+
+  def allow(self) -> bool:
+    """
+    Whether a request may be sent now. Letting the trial request of a
+    half-open circuit through must be followed by a call to `record_success`,
+    `record_failure` or `release`.
+    """
+    if self.opened_at is None:
+      return True
+    if self.state != "half-open":
+      self.rejected += 1
+      return False
+    self.trial = True
+    return True
+
+  def record_success(self):
+    if self.opened_at is not None:
+      logger.warning("Circuit for %s closed", self.name)
+    self.failures = 0
+    self.opened_at = None
+    self.trial = False
+
+  def record_failure(self):
+    self.failures += 1
+    if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+      logger.warning("Circuit for %s opened after %d failures", self.name, self.failures)
+      self.opened_at = time.monotonic()
+      self.trial = False
+
+  def release(self):
+    """
+    Give up a request without an outcome, e.g. because it was cancelled.
+    """
+    self.trial = False
+
+breakers: dict[str, CircuitBreaker] = {}
+config = {
+  "failure_threshold": DEFAULT_FAILURE_THRESHOLD,
+  "reset_timeout": DEFAULT_RESET_TIMEOUT
+}
+
+def configure(failure_threshold: int = None, reset_timeout: float = None):
+  """
+  Change the thresholds of all circuits, including existing ones.
+  """
+  if failure_threshold is not None:
+    config["failure_threshold"] = failure_threshold
+  if reset_timeout is not None:
+    config["reset_timeout"] = reset_timeout
+  for breaker in breakers.values():
+    breaker.failure_threshold = config["failure_threshold"]
+    breaker.reset_timeout = config["reset_timeout"]
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+  endpoint = endpoint.strip("/")
+  breaker = breakers.get(endpoint)
+  if breaker is None:
+    breaker = breakers[endpoint] = CircuitBreaker(endpoint, **config)
+  return breaker
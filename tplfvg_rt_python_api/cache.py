@@ -0,0 +1,403 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+class TTLCache:
+  """
+  Size-bounded LRU cache whose entries expire `ttl` seconds after being stored.
+
+  Besides plain `get`/`put`, `get_or_fetch` coalesces concurrent lookups of
+  the same missing key: only the first caller actually runs the fetch
+  coroutine, the others wait for its outcome. Failed fetches are not cached
+  and their exception is raised to every waiting caller.
+
+  If a `SharedCache` is attached as `shared`, missing keys are looked up there
+  (under `namespace`) before being fetched, and fetched values are stored
+  there too for other processes.
+
+  With a `stale_ttl`, expired entries are kept that many seconds longer and
+  `get_or_fetch` falls back to them (stale-while-revalidate): it waits up to
+  `stale_wait` seconds for the refresh of an expired key, then returns the
+  stale value and lets the refresh go on in the background. A stale value is
+  returned right away, too, if the refresh fails.
+
+  `get_or_fetch` with `refresh` fetches a key again even if it is still
+  fresh, e.g. to renew it ahead of its expiry.
+
+  The plain accessors are guarded by a lock, so that the synchronous API can
+  share the cache between threads (e.g. the scraper's thread pools).
+  """
+
+  def __init__(self, ttl: float, maxsize: int = 1024, stale_ttl: float = 0, stale_wait: float = 0):
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self.stale_ttl = stale_ttl
+    self.stale_wait = stale_wait
+    self.entries = OrderedDict()
+    self.lock = threading.RLock()
+    self.pending = {}
+    self.shared = None
+    self.namespace = None
+    self.hits = 0
+    self.misses = 0
+    self.coalesced = 0
+    self.stale = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, key, default=None):
+    """
+    Return the cached value for `key`, or `default` if it is missing or
+    expired. Hit and miss counters are updated accordingly.
+    """
+    with self.lock:
+      entry = self.entries.get(key)
+      now = time.monotonic()
+      if entry is None or entry[0] <= now:
+        if entry is not None and entry[0] + self.stale_ttl <= now:
+          del self.entries[key]
+        self.misses += 1
+        return default
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  def put(self, key, value, ttl: float = None):
+    """
+    Store `value` for `key` for `ttl` seconds (the cache TTL by default),
+    evicting the least recently used entries if the cache grows past `maxsize`.
+    """
+    with self.lock:
+      self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+
+  def expires_in(self, key) -> float:
+    """
+    Seconds until the entry for `key` expires, 0 if it is missing or expired.
+    Counters are not updated.
+    """
+    entry = self.entries.get(key)
+    return max(entry[0] - time.monotonic(), 0) if entry is not None else 0
+
+  def get_stale(self, key, default=None):
+    """
+    Return the value for `key` even if expired, as long as it is within the
+    stale window, or `default`. Counters are not updated.
+    """
+    entry = self.entries.get(key)
+    if entry is None or entry[0] + self.stale_ttl <= time.monotonic():
+      return default
+    return entry[1]
+
+  def invalidate(self, key=MISSING):
+    """
+    Drop `key` from the cache, or every entry if no key is given.
+    """
+    with self.lock:
+      if key is MISSING:
+        self.entries.clear()
+      else:
+        self.entries.pop(key, None)
+
+  async def get_or_fetch(self, key, fetch, refresh: bool = False):
+    """
+    Return the cached value for `key` or await `fetch()` to obtain it, making
+    sure that at most one fetch per key is in flight at any time. With
+    `refresh`, the cached value is fetched again and never served instead.
+    """
+    if not refresh:
+      value = self.get(key, MISSING)
+      if value is not MISSING:
+        return value
+
+    task = self.pending.get(key)
+    if task is not None:
+      self.coalesced += 1
+    else:
+      task = asyncio.ensure_future(self.fetch_missing(key, fetch, refresh))
+      self.pending[key] = task
+
+      def done(task):
+        self.pending.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+          self.put(key, *task.result())
+      task.add_done_callback(done)
+
+    stale = self.get_stale(key, MISSING) if self.stale_ttl and not refresh else MISSING
+    if stale is MISSING:
+      # Shield the shared fetch so that a cancelled caller does not cancel it
+      # for everyone else waiting on the same key
+      value, _ = await asyncio.shield(task)
+      return value
+    if self.stale_wait > 0 or task.done():
+      try:
+        value, _ = await asyncio.wait_for(asyncio.shield(task), self.stale_wait)
+        return value
+      except Exception:
+        pass
+    self.stale += 1
+    return stale
+
+  async def fetch_missing(self, key, fetch, refresh: bool = False) -> tuple[object, float | None]:
+    """
+    Obtain the value of a missing key, from the shared cache if attached or
+    with `fetch()`, along with the TTL to keep it for (None for the default).
+    When refreshing, the shared entry is only taken if it outlives the local
+    one, i.e. if another process has refreshed it already.
+    """
+    if self.shared is not None:
+      entry = self.shared.get(self.namespace, key)
+      if entry is not None and (not refresh or entry[1] > self.expires_in(key)):
+        return entry
+    value = await fetch()
+    if self.shared is not None:
+      self.shared.put(self.namespace, key, value, self.ttl)
+    return value, None
+
+  def stats(self) -> dict:
+    lookups = self.hits + self.misses
+    return {
+      "size": len(self.entries),
+      "maxsize": self.maxsize,
+      "ttl": self.ttl,
+      "hits": self.hits,
+      "misses": self.misses,
+      "coalesced": self.coalesced,
+      "stale": self.stale,
+      "hit_ratio": self.hits / lookups if lookups else 0.0
+    }
+
+
+def get_service_day(now: datetime.datetime = None, rollover_hour: int = 3) -> datetime.date:
+  """
+  Service day the given time belongs to: trips running after midnight still
+  belong to the previous day until `rollover_hour`.
+  """
+  return ((now or datetime.datetime.now()) - datetime.timedelta(hours=rollover_hour)).date()
+
+class ServiceDayCache(TTLCache):
+  """
+  TTLCache whose entries are valid until the end of the current service day,
+  for data that does not change during the day such as trip timetables. The
+  contents can be saved to and loaded from disk, so that restarts during the
+  same service day do not start from a cold cache.
+  """
+
+  def __init__(self, maxsize: int = 4096, rollover_hour: int = 3):
+    super().__init__(ttl=0, maxsize=maxsize)
+    self.rollover_hour = rollover_hour
+    self.service_day = get_service_day(rollover_hour=rollover_hour)
+
+  def check_rollover(self):
+    service_day = get_service_day(rollover_hour=self.rollover_hour)
+    with self.lock:
+      if service_day != self.service_day:
+        self.service_day = service_day
+        self.entries.clear()
+
+  def get(self, key, default=None):
+    with self.lock:
+      self.check_rollover()
+      return super().get(key, default)
+
+  def put(self, key, value, ttl: float = None):
+    # Entries always expire at the end of the service day
+    with self.lock:
+      self.check_rollover()
+      now = datetime.datetime.now()
+      rollover = datetime.datetime.combine(
+        self.service_day + datetime.timedelta(days=1), datetime.time(self.rollover_hour)
+      )
+      self.ttl = max((rollover - now).total_seconds(), 0)
+      super().put(key, value)
+
+  def save(self, path: str, encode=lambda value: value):
+    """
+    Atomically save the entries to a JSON file, encoding values with `encode`.
+    """
+    self.check_rollover()
+    with self.lock:
+      service_day = self.service_day
+      entries = list(self.entries.items())
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+      f.write(json.dumps({
+        "service_day": service_day.isoformat(),
+        "entries": [[list(key), encode(value)] for key, (_, value) in entries]
+      }))
+    os.replace(tmp, path)
+
+  def load(self, path: str, decode=lambda value: value) -> int:
+    """
+    Load entries saved by `save` if they belong to the current service day,
+    decoding values with `decode`. Returns the number of loaded entries.
+    """
+    self.check_rollover()
+    if not os.path.exists(path):
+      return 0
+    with open(path, "r") as f:
+      saved = json.loads(f.read())
+    if saved["service_day"] != self.service_day.isoformat():
+      return 0
+    for key, value in saved["entries"]:
+      self.put(tuple(key), decode(value))
+    return len(saved["entries"])
+
+
+class SharedCache:
+  """
+  Cache shared by the processes of the same host, stored in a SQLite database
+  in WAL mode. Keys are namespaced and both keys and values are stored as
+  JSON, so only JSON serializable data can be cached.
+
+  Lookups are quick enough to be made from the event loop; the cache is best
+  effort, so errors (e.g. the database being locked for longer than `timeout`
+  seconds) are counted and treated as misses. Expired entries are purged
+  every `purge_every` writes.
+  """
+
+  def __init__(self, path: str, timeout: float = 0.05, purge_every: int = 1000):
+    self.path = path
+    self.purge_every = purge_every
+    self.hits = 0
+    self.misses = 0
+    self.errors = 0
+    self.writes = 0
+    self.db = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=OFF")
+    self.db.execute(
+      "CREATE TABLE IF NOT EXISTS entries (namespace TEXT NOT NULL, key TEXT NOT NULL, " + \
+        "value TEXT NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+    )
+
+  def get(self, namespace: str, key) -> tuple[object, float] | None:
+    """
+    Return the value stored for `key` and its remaining TTL in seconds, or
+    None if it is missing or expired.
+    """
+    try:
+      row = self.db.execute(
+        "SELECT value, expires_at FROM entries WHERE namespace = ? AND key = ?", (namespace, json.dumps(key))
+      ).fetchone()
+    except sqlite3.Error:
+      self.errors += 1
+      return None
+    now = time.time()
+    if row is None or row[1] <= now:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return json.loads(row[0]), row[1] - now
+
+  def put(self, namespace: str, key, value, ttl: float):
+    try:
+      now = time.time()
+      self.db.execute(
+        "INSERT OR REPLACE INTO entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+        (namespace, json.dumps(key), json.dumps(value), now + ttl)
+      )
+      self.writes += 1
+      if self.writes % self.purge_every == 0:
+        self.db.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+    except sqlite3.Error:
+      self.errors += 1
+
+  def stats(self) -> dict:
+    lookups = self.hits + self.misses
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "errors": self.errors,
+      "writes": self.writes,
+      "hit_ratio": self.hits / lookups if lookups else 0.0
+    }
+
+  def close(self):
+    self.db.close()
+
+# Per-endpoint cache configuration for the RT API. Stop information barely
+# ever changes, while pole monitor results are only worth a few seconds.
+# Both are served stale for a while when the RT API is slow or down, stop
+# monitors only after waiting a bit for fresh results.
+RT_CACHE_CONFIG = {
+  "polemonitor/info": {"ttl": 12 * 60 * 60, "maxsize": 8192, "stale_ttl": 7 * 24 * 60 * 60},
+  "polemonitor/mrcruns": {"ttl": 10, "maxsize": 2048, "stale_ttl": 15 * 60, "stale_wait": 2.0}
+}
+
+rt_caches = {
+  endpoint: TTLCache(**options) for endpoint, options in RT_CACHE_CONFIG.items()
+}
+shared_cache: SharedCache | None = None
+
+def configure_rt_cache(endpoint: str, ttl: float = None, maxsize: int = None, stale_ttl: float = None, stale_wait: float = None):
+  """
+  Change TTL, size bound and/or stale window (see `TTLCache`) of the cache of
+  the given RT API endpoint, enabling caching for it if it was not cached
+  already.
+  """
+  endpoint = endpoint.strip("/")
+  cache = rt_caches.get(endpoint)
+  if cache is None:
+    cache = rt_caches[endpoint] = TTLCache(ttl or 0, maxsize or 1024)
+    cache.shared, cache.namespace = shared_cache, endpoint
+  if ttl is not None:
+    cache.ttl = ttl
+  if maxsize is not None:
+    cache.maxsize = maxsize
+  if stale_ttl is not None:
+    cache.stale_ttl = stale_ttl
+  if stale_wait is not None:
+    cache.stale_wait = stale_wait
+
+def configure_shared_cache(path: str) -> SharedCache:
+  """
+  Back the RT API caches with a SharedCache at the given path, so that
+  processes configured with the same path share what they fetch.
+  """
+  global shared_cache
+  shared_cache = SharedCache(path)
+  for endpoint, cache in rt_caches.items():
+    cache.shared, cache.namespace = shared_cache, endpoint
+  return shared_cache
+
+def get_rt_cache(endpoint: str) -> TTLCache | None:
+  """
+  Return the cache of the given RT API endpoint, if it is cached at all.
+  """
+  return rt_caches.get(endpoint.strip("/"))
+
+def make_cache_key(params: dict | None):
+  return tuple(sorted((params or {}).items()))
+
+def rt_cache_stats() -> dict:
+  return {endpoint: cache.stats() for endpoint, cache in rt_caches.items()}
+
+# Trip routes, keyed by (line, direction, race)
+route_cache = ServiceDayCache()
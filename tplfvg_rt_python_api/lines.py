@@ -0,0 +1,152 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import pickle
+import sys
+from array import array
+from collections.abc import Mapping
+
+MAGIC = b"TPLFVG-LBS"
+VERSION = 1
+
+def zone_bit(zone: str) -> int:
+  """
+  Bit of the given zone in a zone bitmask. Zones are identified by their last
+  letter, e.g. both "T" and a zone group ending in "T" map to Trieste.
+  """
+  return 1 << (ord(zone[-1].upper()) - ord("A"))
+
+def zones_mask(zones) -> int:
+  mask = 0
+  for zone in zones:
+    mask |= zone_bit(zone)
+  return mask
+
+class LinesByStop(Mapping):
+  """
+  Lines calling at each stop, in compact form.
+
+  Lines are deduplicated and stored once in a shared table of
+  (`guideline_public_code`, `public_description`) tuples; each stop only keeps
+  a bitmask of the zones it is served in and a packed array of indexes into
+  the line table, which is only unpacked when the stop is looked up. The set
+  of stops served in each zone is precomputed as well.
+  """
+
+  def __init__(self, lines: tuple[tuple[str, str], ...], stops: dict[str, tuple[int, bytes]]):
+    self.lines = lines
+    self.stops = stops
+    # zone bit -> codes of the stops served in that zone
+    self.stops_by_zone = {}
+    for stop_code, (mask, _) in stops.items():
+      while mask:
+        bit = mask & -mask
+        self.stops_by_zone.setdefault(bit, set()).add(stop_code)
+        mask ^= bit
+    self.stops_by_mask = {}
+
+  def __getitem__(self, stop_code: str) -> list[tuple[str, str]]:
+    _, packed = self.stops[stop_code]
+    return [self.lines[i] for i in memoryview(packed).cast("H")]
+
+  def __iter__(self):
+    return iter(self.stops)
+
+  def __len__(self):
+    return len(self.stops)
+
+  def __contains__(self, stop_code):
+    return stop_code in self.stops
+
+  def zone_mask(self, stop_code: str) -> int:
+    """
+    Bitmask of the zones the given stop is served in (see `zone_bit`), 0 for
+    unknown stops.
+    """
+    stop = self.stops.get(stop_code)
+    return stop[0] if stop else 0
+
+  def stops_in_zones(self, zones) -> frozenset[str]:
+    """
+    Codes of the stops served in any of the given zones.
+    """
+    mask = zones_mask(zones)
+    stops = self.stops_by_mask.get(mask)
+    if stops is None:
+      stops = frozenset().union(*[
+        codes for bit, codes in self.stops_by_zone.items() if bit & mask
+      ])
+      self.stops_by_mask[mask] = stops
+    return stops
+
+  @classmethod
+  def from_raw(cls, raw: dict):
+    """
+    Build the compact form from the `lines_by_stop.json` dataset written by the
+    scraper, keeping only the first line with a given public code per stop.
+    """
+    line_ids = {}
+    stops = {}
+    for stop_code, stop in raw.items():
+      seen = set()
+      indexes = array("H")
+      for line in stop["lines"]:
+        code = line["guideline_public_code"]
+        if code in seen:
+          continue
+        seen.add(code)
+        key = (sys.intern(code), sys.intern(line["public_description"]))
+        indexes.append(line_ids.setdefault(key, len(line_ids)))
+      stops[sys.intern(stop_code)] = (zones_mask(stop["zones"]), indexes.tobytes())
+    return cls(tuple(line_ids), stops)
+
+  def dump(self, path: str):
+    """
+    Atomically write the compact artifact to the given path.
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+      f.write(MAGIC + VERSION.to_bytes(2, "little"))
+      pickle.dump((self.lines, self.stops), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+  @classmethod
+  def load(cls, path: str):
+    """
+    Load the compact artifact written by `dump`.
+    """
+    with open(path, "rb") as f:
+      header = f.read(len(MAGIC) + 2)
+      if header[:len(MAGIC)] != MAGIC or int.from_bytes(header[len(MAGIC):], "little") != VERSION:
+        raise ValueError(f"{path} is not a lines by stop artifact (version {VERSION})")
+      return cls(*pickle.load(f))
+
+def load_lines_by_stop(path: str) -> LinesByStop:
+  """
+  Load lines by stop either from the compact artifact or, if the path points
+  to a .json file, from the raw dataset.
+  """
+  if path.endswith(".json"):
+    with open(path, "r") as f:
+      return LinesByStop.from_raw(json.loads(f.read()))
+  return LinesByStop.load(path)
+
+if __name__ == "__main__":
+  if len(sys.argv) != 3:
+    sys.exit(f"Usage: {sys.argv[0]} [lines_by_stop.json] [lines_by_stop.bin]")
+  load_lines_by_stop(sys.argv[1]).dump(sys.argv[2])
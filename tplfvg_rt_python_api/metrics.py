@@ -0,0 +1,263 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import logging
+import os
+import threading
+import time
+
+from . import breaker, cache
+from .cache import rt_cache_stats, route_cache
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+class EndpointMetrics:
+  def __init__(self):
+    self.requests = 0
+    self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+    self.latency_sum = 0.0
+    self.statuses = {}
+    self.errors = {}
+    self.timeouts = 0
+
+  def record(self, duration: float, status: int = None, error: BaseException = None, timeout: bool = False):
+    self.requests += 1
+    self.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+    self.latency_sum += duration
+    if status is not None:
+      self.statuses[status] = self.statuses.get(status, 0) + 1
+    if error is not None:
+      name = type(error).__name__
+      self.errors[name] = self.errors.get(name, 0) + 1
+    if timeout:
+      self.timeouts += 1
+
+  def quantile(self, q: float) -> float:
+    """
+    Upper bound of the histogram bucket containing the q-th quantile.
+    """
+    rank = q * self.requests
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+      seen += count
+      if seen >= rank:
+        return bound
+    return LATENCY_BUCKETS[-1]
+
+# Requests sent upstream (cache hits excluded), by endpoint
+endpoints: dict[str, EndpointMetrics] = {}
+lock = threading.Lock()
+hooks = []
+current_trace: contextvars.ContextVar[list | None] = contextvars.ContextVar("current_trace", default=None)
+
+def add_hook(hook):
+  """
+  Call `hook(event)` after each upstream request. Events are dicts with the
+  `endpoint`, `duration` (seconds), `status` (or None), `error` (or None) and
+  `timeout` of the request.
+  """
+  hooks.append(hook)
+
+def remove_hook(hook):
+  hooks.remove(hook)
+
+@contextlib.contextmanager
+def trace():
+  """
+  Collect the events of the upstream requests made within this context (and
+  the tasks it spawns) in the yielded list, e.g. to attach them to a bot
+  update.
+  """
+  events = []
+  token = current_trace.set(events)
+  try:
+    yield events
+  finally:
+    current_trace.reset(token)
+
+def record_request(endpoint: str, duration: float, status: int = None, error: BaseException = None, timeout: bool = False):
+  with lock:
+    metrics = endpoints.get(endpoint)
+    if metrics is None:
+      metrics = endpoints[endpoint] = EndpointMetrics()
+    metrics.record(duration, status, error, timeout)
+  event = {
+    "endpoint": endpoint,
+    "duration": duration,
+    "status": status,
+    "error": error,
+    "timeout": timeout
+  }
+  events = current_trace.get()
+  if events is not None:
+    events.append(event)
+  for hook in hooks:
+    try:
+      hook(event)
+    except Exception as e:
+      logger.warning("Metrics hook %r failed: %r", hook, e)
+
+@contextlib.contextmanager
+def measure(endpoint: str):
+  """
+  Time the request made within this context and record it. The yielded dict
+  can be given the response `status`; exceptions are recorded and re-raised.
+  """
+  result = {"status": None}
+  start = time.perf_counter()
+  try:
+    yield result
+  except Exception as e:
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    record_request(endpoint, time.perf_counter() - start, status, e, "Timeout" in type(e).__name__)
+    raise
+  record_request(endpoint, time.perf_counter() - start, result["status"])
+
+def reset():
+  with lock:
+    endpoints.clear()
+
+def get_cache_stats() -> dict:
+  return {
+    **rt_cache_stats(),
+    "routes": route_cache.stats()
+  }
+
+def format_summary() -> list[str]:
+  """
+  One human readable line per endpoint and per cache.
+  """
+  lines = []
+  with lock:
+    for endpoint, metrics in sorted(endpoints.items()):
+      lines.append(
+        f"{endpoint}: {metrics.requests} requests, " + \
+          f"avg {metrics.latency_sum / metrics.requests * 1000:.0f} ms, " + \
+          f"p50 <= {metrics.quantile(0.5)}s, p99 <= {metrics.quantile(0.99)}s, " + \
+          f"{metrics.timeouts} timeouts, statuses {metrics.statuses}, errors {metrics.errors}"
+      )
+  for name, stats in get_cache_stats().items():
+    lines.append(
+      f"cache {name}: {stats['size']}/{stats['maxsize']} entries, " + \
+        f"hit ratio {stats['hit_ratio']:.1%} ({stats['hits']} hits, {stats['misses']} misses, {stats['coalesced']} coalesced, {stats['stale']} stale)"
+    )
+  for endpoint, circuit in sorted(breaker.breakers.items()):
+    lines.append(f"circuit {endpoint}: {circuit.state}, {circuit.rejected} requests rejected")
+  if cache.shared_cache is not None:
+    stats = cache.shared_cache.stats()
+    lines.append(
+      f"shared cache: hit ratio {stats['hit_ratio']:.1%} ({stats['hits']} hits, {stats['misses']} misses, " + \
+        f"{stats['writes']} writes, {stats['errors']} errors)"
+    )
+  return lines
+
+def format_prometheus() -> str:
+  """
+  Render all metrics in the Prometheus text exposition format.
+  """
+  out = [
+    "# TYPE tplfvg_upstream_request_duration_seconds histogram",
+  ]
+  with lock:
+    for endpoint, metrics in sorted(endpoints.items()):
+      cumulative = 0
+      for bound, count in zip(LATENCY_BUCKETS, metrics.latency_buckets):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else bound
+        out.append(f'tplfvg_upstream_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {cumulative}')
+      out.append(f'tplfvg_upstream_request_duration_seconds_sum{{endpoint="{endpoint}"}} {metrics.latency_sum}')
+      out.append(f'tplfvg_upstream_request_duration_seconds_count{{endpoint="{endpoint}"}} {metrics.requests}')
+    out.append("# TYPE tplfvg_upstream_responses_total counter")
+    for endpoint, metrics in sorted(endpoints.items()):
+      for status, count in sorted(metrics.statuses.items()):
+        out.append(f'tplfvg_upstream_responses_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+    out.append("# TYPE tplfvg_upstream_errors_total counter")
+    for endpoint, metrics in sorted(endpoints.items()):
+      for error, count in sorted(metrics.errors.items()):
+        out.append(f'tplfvg_upstream_errors_total{{endpoint="{endpoint}",error="{error}"}} {count}')
+    out.append("# TYPE tplfvg_upstream_timeouts_total counter")
+    for endpoint, metrics in sorted(endpoints.items()):
+      out.append(f'tplfvg_upstream_timeouts_total{{endpoint="{endpoint}"}} {metrics.timeouts}')
+  cache_stats = get_cache_stats()
+  for metric, key in [("hits_total", "hits"), ("misses_total", "misses"), ("coalesced_total", "coalesced"), ("stale_total", "stale"), ("entries", "size")]:
+    out.append(f"# TYPE tplfvg_cache_{metric} {'gauge' if metric == 'entries' else 'counter'}")
+    for name, stats in sorted(cache_stats.items()):
+      out.append(f'tplfvg_cache_{metric}{{cache="{name}"}} {stats[key]}')
+  out.append("# TYPE tplfvg_circuit_open gauge")
+  for endpoint, circuit in sorted(breaker.breakers.items()):
+    out.append(f'tplfvg_circuit_open{{endpoint="{endpoint}"}} {int(circuit.state == "open")}')
+  out.append("# TYPE tplfvg_circuit_rejected_total counter")
+  for endpoint, circuit in sorted(breaker.breakers.items()):
+    out.append(f'tplfvg_circuit_rejected_total{{endpoint="{endpoint}"}} {circuit.rejected}')
+  if cache.shared_cache is not None:
+    stats = cache.shared_cache.stats()
+    for key in ["hits", "misses", "writes", "errors"]:
+      out.append(f"# TYPE tplfvg_shared_cache_{key}_total counter")
+      out.append(f"tplfvg_shared_cache_{key}_total {stats[key]}")
+  return "\n".join(out) + "\n"
+
+def write_prometheus_file(path: str):
+  """
+  Atomically dump the metrics to a file, e.g. for node_exporter's textfile
+  collector.
+  """
+  tmp = f"{path}.tmp"
+  with open(tmp, "w") as f:
+    f.write(format_prometheus())
+  os.replace(tmp, path)
+
+async def serve_prometheus(host: str = "127.0.0.1", port: int = 9464):
+  """
+  Serve the metrics over HTTP on the given address, answering any request
+  with the Prometheus text dump.
+  """
+  async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+      await reader.readuntil(b"\r\n\r\n")
+      body = format_prometheus().encode()
+      writer.write(
+        b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n" + \
+          f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+      )
+      await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+      pass
+    finally:
+      writer.close()
+
+  return await asyncio.start_server(handle, host, port)
+
+async def export_periodically(interval: float = 60, log: bool = True, path: str = None):
+  """
+  Every `interval` seconds, log a summary and/or dump the metrics to `path`.
+  """
+  while True:
+    await asyncio.sleep(interval)
+    if log:
+      for line in format_summary():
+        logger.info(line)
+    if path:
+      try:
+        write_prometheus_file(path)
+      except OSError as e:
+        logger.warning("Could not write metrics to %s: %r", path, e)
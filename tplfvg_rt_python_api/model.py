@@ -17,7 +17,13 @@
 from dataclasses import dataclass
 from datetime import datetime
 
-@dataclass
+# Models are slotted, as they are built by the dozen for every stop monitor
+# and route. Stop information and routes are cached and shared by concurrent
+# handlers, so they are frozen too; results are not, since a frozen
+# dataclass is several times slower to build and every stop monitor request
+# decodes a fresh batch of them.
+
+@dataclass(slots=True)
 class RTResult:
   line: str
   departure_time: datetime
@@ -35,7 +41,7 @@ class RTResult:
   notes: str
   is_destination: bool
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class StopInfo:
   address: str
   stop_code: str
@@ -46,11 +52,39 @@ class StopInfo:
   is_maritime: bool
   is_station: bool
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class RouteStop:
   seq: int
   line_seq: int
   stop_code: str
   stop_description: str
   stop_type: str
-  time: int
\ No newline at end of file
+  time: int
+
+class Route(list):
+  """
+  List of the RouteStop of a trip, with a precomputed index of the position
+  of each stop in the trip by stop code.
+  """
+
+  def __init__(self, stops=()):
+    super().__init__(stops)
+    self.stop_indexes = {}
+    for i, stop in enumerate(self):
+      self.stop_indexes.setdefault(stop.stop_code, i)
+
+  def index_of(self, stop_code: str) -> int | None:
+    return self.stop_indexes.get(stop_code)
+
+class Monitor(list):
+  """
+  List of the RTResult of a stop monitor, along with the time it was fetched
+  from the RT API, which is in the past when it is served from a cache.
+  Monitors built from the local timetable rather than the RT API are flagged
+  as `scheduled`.
+  """
+
+  def __init__(self, results=(), fetched_at: datetime = None, scheduled: bool = False):
+    super().__init__(results)
+    self.fetched_at = fetched_at or datetime.now()
+    self.scheduled = scheduled
\ No newline at end of file
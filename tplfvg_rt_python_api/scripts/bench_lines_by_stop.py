@@ -0,0 +1,79 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compare startup time and retained memory of the raw lines_by_stop.json
+# loading path formerly used by the bot with the compact artifact.
+
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from tplfvg_rt_python_api.lines import LinesByStop, load_lines_by_stop
+
+def load_json_legacy(path):
+	with open(path, "r") as stf:
+		lines_by_stop = json.loads(stf.read())
+		for stop in lines_by_stop:
+			lines = []
+			[lines.append(line) for line in lines_by_stop[stop]["lines"] if line['guideline_public_code'] not in [
+				l['guideline_public_code'] for l in lines
+			]]
+			lines_by_stop[stop] = {
+				"lines": lines,
+				"zones": lines_by_stop[stop]["zones"]
+			}
+	return lines_by_stop
+
+def measure(name, load, repeat):
+	timings = []
+	for _ in range(repeat):
+		gc.collect()
+		start = time.perf_counter()
+		data = load()
+		timings.append(time.perf_counter() - start)
+		del data
+	gc.collect()
+	tracemalloc.start()
+	data = load()
+	gc.collect()
+	retained, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	print(f"{name:<24} best {min(timings) * 1000:8.1f} ms   retained {retained / 2**20:7.1f} MiB   peak {peak / 2**20:7.1f} MiB")
+	return data
+
+if __name__ == "__main__":
+	if len(sys.argv) not in (2, 3):
+		sys.exit(f"Usage: {sys.argv[0]} [lines_by_stop.json] [repeat]")
+	json_path = sys.argv[1]
+	repeat = int(sys.argv[2]) if len(sys.argv) == 3 else 5
+
+	with tempfile.TemporaryDirectory() as tmp:
+		bin_path = os.path.join(tmp, "lines_by_stop.bin")
+		load_lines_by_stop(json_path).dump(bin_path)
+		print(f"{os.path.getsize(json_path) / 2**20:.1f} MiB JSON, {os.path.getsize(bin_path) / 2**20:.1f} MiB compact artifact")
+
+		legacy = measure("json (legacy dedup)", lambda: load_json_legacy(json_path), repeat)
+		measure("json -> compact", lambda: load_lines_by_stop(json_path), repeat)
+		compact = measure("compact artifact", lambda: LinesByStop.load(bin_path), repeat)
+
+	for stop in legacy:
+		assert [(l["guideline_public_code"], l["public_description"]) for l in legacy[stop]["lines"]] == compact[stop], stop
+	print(f"Checked {len(legacy)} stops: compact artifact matches the legacy loader")
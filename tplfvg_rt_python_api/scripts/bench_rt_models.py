@@ -0,0 +1,106 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compare parse time per `polemonitor/mrcruns` response and memory per
+# decoded stop monitor of the plain dataclass models and per-field parsing
+# formerly used with the slotted models and batch decoder.
+
+import dataclasses
+import datetime
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from tplfvg_rt_python_api.api import parse_stop_monitor
+from tplfvg_rt_python_api.model import RTResult, Monitor
+from tplfvg_rt_python_api.utils import json_loads
+
+LegacyRTResult = dataclasses.make_dataclass("LegacyRTResult", [(f.name, f.type) for f in dataclasses.fields(RTResult)])
+
+def convert_legacy(dt):
+	try:
+		return datetime.datetime.fromisoformat(dt)
+	except:
+		return dt
+
+def parse_legacy(f):
+	return Monitor((LegacyRTResult(
+		line=result["Line"],
+		departure_time=convert_legacy(result["DepartureTime"]),
+		arrival_time=convert_legacy(result["ArrivalTime"]),
+		destination=result["Destination"],
+		origin=result["Departure"],
+		next_passes=result["NextPasses"],
+		direction=result["Direction"],
+		line_code=result["LineCode"],
+		line_type=result["LineType"],
+		vehicle=result["Vehicle"],
+		trip=result["Race"],
+		latitude=result["Latitude"],
+		longitude=result["Longitude"],
+		notes=result["Note"],
+		is_destination=result["IsDestination"]
+	) for result in f))
+
+def measure_time(name, parse, bodies, repeat):
+	timings = []
+	for _ in range(repeat):
+		gc.collect()
+		start = time.perf_counter()
+		for body in bodies:
+			parse(body)
+		timings.append((time.perf_counter() - start) / len(bodies))
+	print(f"{name:<28} best {min(timings) * 1e6:8.1f} us/response")
+
+def measure_memory(name, parse, bodies):
+	gc.collect()
+	tracemalloc.start()
+	monitors = [parse(body) for body in bodies]
+	gc.collect()
+	retained, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	print(f"{name:<28} {retained / len(monitors) / 2**10:8.1f} KiB/monitor")
+	return monitors
+
+if __name__ == "__main__":
+	if len(sys.argv) not in (2, 3, 4):
+		sys.exit(f"Usage: {sys.argv[0]} [mrcruns.json] [monitors] [repeat]")
+	with open(sys.argv[1], "rb") as f:
+		raw = f.read()
+	count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+	repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+	print(f"{len(json.loads(raw))} results per response, {count} responses")
+
+	raws = [raw] * count
+	measure_time("json.loads", json.loads, raws, repeat)
+	if json_loads is not json.loads:
+		measure_time(f"{json_loads.__module__}.loads", json_loads, raws, repeat)
+
+	# Distinct bodies, as cached monitors of different stops would be
+	bodies = [json.loads(raw) for _ in range(count)]
+	measure_time("dataclass, per-field parse", parse_legacy, bodies, repeat)
+	measure_time("slotted, batch decoder", parse_stop_monitor, bodies, repeat)
+	measure_memory("raw JSON body", lambda body: json.loads(raw), bodies)
+	legacy = measure_memory("dataclass", parse_legacy, bodies)
+	slotted = measure_memory("slotted", parse_stop_monitor, bodies)
+
+	for old, new in zip(legacy[0], slotted[0]):
+		assert dataclasses.astuple(old) == dataclasses.astuple(new)
+	print("Checked: both decoders build the same results")
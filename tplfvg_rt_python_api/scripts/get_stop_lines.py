@@ -14,7 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import argparse
 import geojson
+import hashlib
 import requests
 import sys
 import re
@@ -22,7 +24,10 @@ import json
 import time
 import random
 import os
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from tplfvg_rt_python_api.lines import LinesByStop
 
 DEFAULT_HEADERS = {
 	"User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0",
@@ -34,45 +39,104 @@ DEFAULT_HEADERS = {
 
 LOCAL_FILES_DIR = "../local"
 TMP_STOPS_DIR = f"{LOCAL_FILES_DIR}/stops"
+ALL_STOPS_FILE = f"{LOCAL_FILES_DIR}/all_stops.json"
+
+def write_atomically(path, content, mode="w"):
+	"""
+	Write to a temporary file and move it over the destination, so that readers
+	(e.g. the running bot) never see a partially written file.
+	"""
+	tmp = f"{path}.tmp"
+	with open(tmp, mode) as f:
+		f.write(content)
+	os.replace(tmp, path)
+
+def get_with_retries(url, retries=5, backoff=1.0):
+	"""
+	GET the given URL, retrying with exponential backoff (and some jitter) on
+	network errors and error responses. The last error is raised once retries
+	are exhausted.
+	"""
+	for attempt in range(retries + 1):
+		try:
+			response = requests.get(url, headers=DEFAULT_HEADERS, timeout=30)
+			response.raise_for_status()
+			return response.text
+		except Exception as e:
+			if attempt == retries:
+				raise
+			delay = backoff * 2 ** attempt * (1 + random.random())
+			print(f"Request to {url} failed ({e!r}), retrying in {delay:.1f}s...")
+			time.sleep(delay)
 
 def get_all_stops():
-	try:
-		f = requests.get(
-			"https://tplfvg.it/services/bus-stops/all/",
-			headers=DEFAULT_HEADERS
-		).text
-	except Exception as e:
-		print(f"Could not get all stops: {e!r}")
-		sys.exit(1)
+	f = get_with_retries("https://tplfvg.it/services/bus-stops/all/")
+	# Keep the whole dataset around for the bot's offline stop search
+	write_atomically(ALL_STOPS_FILE, f)
 	return geojson.loads(f).features
 
 def get_lines_calling_at_stop(stop_code):
-	try:
-		f = requests.get(
-			f"https://tplfvg.it/it/il-viaggio/costruisci-il-tuo-orario/?bus_stop={stop_code}&search-lines-by-bus-stops",
-			headers=DEFAULT_HEADERS
-		).text
-	except Exception as e:
-		print(f"Could not get lines for stop {stop_code}: {e!r}")
-		sys.exit(1)
-	
+	f = get_with_retries(
+		f"https://tplfvg.it/it/il-viaggio/costruisci-il-tuo-orario/?bus_stop={stop_code}&search-lines-by-bus-stops"
+	)
 	lines = []
 	panels = re.findall(r"<script>\s*.*data\((\{.*\})\).*\s*</script>", f)
 	for panel in panels:
 		lines.append(json.loads(panel))
 	return lines
 
-def get_and_save_stop_lines(stop_code, output):
+def get_stop_fingerprint(stop):
+	"""
+	Hash of a stop as listed in the all stops dataset: when it changes, the
+	lines calling at the stop are fetched again regardless of their age.
+	"""
+	return hashlib.sha1(json.dumps({
+		"properties": stop.properties,
+		"geometry": stop.geometry
+	}, sort_keys=True).encode()).hexdigest()
+
+def read_saved_stop(path):
+	"""
+	Return the saved lines of a stop and the fingerprint they were fetched for
+	(None for files saved by older versions of this script), or None if the
+	stop has not been saved yet.
+	"""
+	try:
+		with open(path, "r") as f:
+			saved = json.loads(f.read())
+	except (OSError, ValueError):
+		return None
+	if isinstance(saved, list):
+		return {"fingerprint": None, "lines": saved}
+	return saved
+
+def is_stale(path, fingerprint, max_age):
+	saved = read_saved_stop(path)
+	if saved is None:
+		return True
+	if saved["fingerprint"] is not None and saved["fingerprint"] != fingerprint:
+		return True
+	return time.time() - os.path.getmtime(path) > max_age
+
+def get_and_save_stop_lines(stop_code, fingerprint, output):
 	time.sleep(random.random())
 	print(f"Getting lines for stop {stop_code}...")
 	lines = get_lines_calling_at_stop(stop_code)
-	with open(output, "w") as f:
-		f.write(json.dumps(lines))
+	write_atomically(output, json.dumps({
+		"fingerprint": fingerprint,
+		"lines": lines
+	}))
 
 if __name__ == "__main__":
-	if len(sys.argv) != 2:
-		sys.exit(f"Usage: {sys.argv[0]} [output_file.json]")
-	outfile = sys.argv[1]
+	parser = argparse.ArgumentParser(
+		description="Incrementally refresh the lines calling at every stop and merge them into a single dataset."
+	)
+	parser.add_argument("outfile", help="merged output file, e.g. ../local/lines_by_stop.json")
+	parser.add_argument("--max-age", type=float, default=7 * 24, help="hours after which a stop is fetched again (default: %(default)s)")
+	parser.add_argument("--workers", type=int, default=16, help="number of concurrent requests (default: %(default)s)")
+	parser.add_argument("--force", action="store_true", help="fetch every stop again regardless of its age")
+	args = parser.parse_args()
+	outfile = args.outfile
 
 	if not os.path.exists(LOCAL_FILES_DIR):
 		sys.exit(f"Invalid local path {LOCAL_FILES_DIR}")
@@ -81,26 +145,49 @@ if __name__ == "__main__":
 	elif not os.path.isdir(TMP_STOPS_DIR):
 		sys.exit(f"{TMP_STOPS_DIR} exists but is not a directory: aborting.")
 
-	stops = get_all_stops()
-	print(f"Got {len(stops)} stops. Spawning threads to retrieve lines calling at stops...")
-	
-	with ThreadPoolExecutor(max_workers=16) as executor:
-		for stop in stops:
-			stop_code = stop.properties["code"]
-			executor.submit(get_and_save_stop_lines, stop_code, f"{TMP_STOPS_DIR}/{stop_code}.json")
-	print(f"Successfully retrieved lines for {len(stops)} stops. Merging...")
+	try:
+		stops = get_all_stops()
+	except Exception as e:
+		sys.exit(f"Could not get all stops: {e!r}")
 
+	fingerprints = {stop.properties["code"]: get_stop_fingerprint(stop) for stop in stops}
+	stale = [
+		stop_code for stop_code in fingerprints
+		if args.force or is_stale(f"{TMP_STOPS_DIR}/{stop_code}.json", fingerprints[stop_code], args.max_age * 60 * 60)
+	]
+	print(f"Got {len(stops)} stops, {len(stale)} of which need to be refreshed. Spawning threads to retrieve lines calling at stops...")
+
+	failed = []
+	with ThreadPoolExecutor(max_workers=args.workers) as executor:
+		futures = {
+			executor.submit(get_and_save_stop_lines, stop_code, fingerprints[stop_code], f"{TMP_STOPS_DIR}/{stop_code}.json"): stop_code
+			for stop_code in stale
+		}
+		for future in as_completed(futures):
+			if future.exception() is not None:
+				print(f"Could not get lines for stop {futures[future]}: {future.exception()!r}")
+				failed.append(futures[future])
+	print(f"Retrieved lines for {len(stale) - len(failed)} stops ({len(failed)} failed). Merging...")
+
+	# Only stops still listed upstream are merged; stops whose refresh failed
+	# keep their previously saved lines, if any
 	lines_by_stop = {}
-	saved = os.listdir(TMP_STOPS_DIR)
-	for stop in saved:
-		with open(f"{TMP_STOPS_DIR}/{stop}", "r") as f:
-			lines = json.loads(f.read())
-		lines_by_stop[stop.replace(".json", "")] = {
-			"lines": lines,
-			"zones": list(set([line["zone_group"] for line in lines]))
+	for stop_code in fingerprints:
+		saved = read_saved_stop(f"{TMP_STOPS_DIR}/{stop_code}.json")
+		if saved is None:
+			continue
+		lines_by_stop[stop_code] = {
+			"lines": saved["lines"],
+			"zones": list(set([line["zone_group"] for line in saved["lines"]]))
 		}
-	
+
 	print(f"Saving to {outfile}")
-	with open(outfile, "w") as f:
-		f.write(json.dumps(lines_by_stop))
-	print(f"All OK!")
\ No newline at end of file
+	write_atomically(outfile, json.dumps(lines_by_stop))
+
+	compact_outfile = os.path.splitext(outfile)[0] + ".bin"
+	print(f"Saving compact artifact to {compact_outfile}")
+	LinesByStop.from_raw(lines_by_stop).dump(compact_outfile)
+
+	if failed:
+		sys.exit(f"Lines for {len(failed)} stops could not be refreshed, run again to retry them.")
+	print(f"All OK!")
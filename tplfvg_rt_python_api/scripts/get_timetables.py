@@ -0,0 +1,135 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import datetime
+import json
+import sys
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from tplfvg_rt_python_api import api
+from tplfvg_rt_python_api.timetable import TimetableStore, get_service_date, get_service_day
+
+LOCAL_FILES_DIR = "../local"
+ALL_STOPS_FILE = f"{LOCAL_FILES_DIR}/all_stops.json"
+
+# The RT API has no timetable endpoint: trips are found in the next departures
+# from every stop, then each of them is fetched once with its whole route. A
+# sweep only sees the trips departing in the next hour or so, so this script is
+# meant to run periodically (e.g. hourly from cron): every sweep adds the trips
+# it finds to the timetable of their service day, which is complete once a
+# week of sweeps has covered every kind of service day.
+#
+# Sweeps go through the same realtime API the bot uses, so they are heavily
+# rate limited (see --rate): at the default rate a sweep of the whole network
+# takes the best part of an hour. Trips already stored for their service day
+# are not fetched again.
+
+class RateLimiter:
+	"""
+	Space out the requests made from any thread to at most `rate` per second.
+	"""
+
+	def __init__(self, rate):
+		self.interval = 1 / rate
+		self.lock = threading.Lock()
+		self.next = time.monotonic()
+
+	def wait(self):
+		with self.lock:
+			now = time.monotonic()
+			delay = self.next - now
+			self.next = max(self.next, now) + self.interval
+		if delay > 0:
+			time.sleep(delay)
+
+limiter = None
+
+def get_trips_at_stop(stop_code):
+	limiter.wait()
+	monitor = api.get_stop_monitor(stop_code)
+	if monitor is None:
+		raise RuntimeError("the RT API request failed")
+	return [
+		(r.line, r.line_code, r.direction, r.trip, r.departure_time)
+		for r in monitor if r.trip
+	]
+
+def get_route(line, direction, race):
+	limiter.wait()
+	return api.get_line_route(line, direction, race)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Sweep the departures from every stop and add the trips found to the local timetable."
+	)
+	parser.add_argument("outfile", nargs="?", default=f"{LOCAL_FILES_DIR}/timetable.sqlite", help="timetable database (default: %(default)s)")
+	parser.add_argument("--workers", type=int, default=4, help="number of concurrent requests (default: %(default)s)")
+	parser.add_argument("--rate", type=float, default=2, help="requests per second to the RT API (default: %(default)s)")
+	parser.add_argument("--purge-days", type=int, default=21, help="days after which trips no longer seen are dropped (default: %(default)s)")
+	args = parser.parse_args()
+
+	try:
+		with open(ALL_STOPS_FILE, "r") as asf:
+			stop_codes = [feature["properties"]["code"] for feature in json.loads(asf.read())["features"]]
+	except Exception as e:
+		sys.exit(f"Could not read all stops from {ALL_STOPS_FILE}, run get_stop_lines.py first: {e!r}")
+
+	limiter = RateLimiter(args.rate)
+	now = datetime.datetime.now()
+	today = now.date()
+	store = TimetableStore(args.outfile)
+
+	print(f"Sweeping departures from {len(stop_codes)} stops...")
+	trips = {}
+	failed = 0
+	with ThreadPoolExecutor(max_workers=args.workers) as executor:
+		futures = {executor.submit(get_trips_at_stop, stop_code): stop_code for stop_code in stop_codes}
+		for future in as_completed(futures):
+			if future.exception() is not None:
+				print(f"Could not get departures from stop {futures[future]}: {future.exception()!r}")
+				failed += 1
+				continue
+			for line, line_code, direction, race, departure_time in future.result():
+				# Trips are filed under the service day they depart on, which is
+				# not today's for the first trips of the morning swept at night
+				service_date = get_service_date(departure_time) if isinstance(departure_time, datetime.datetime) else get_service_date(now)
+				trips.setdefault((line, direction, race), (line_code, get_service_day(service_date)))
+
+	known = [trip for trip, (line_code, service_day) in trips.items() if store.mark_seen(service_day, line_code, trip[2], today)]
+	for trip in known:
+		del trips[trip]
+	print(f"Found {len(trips) + len(known)} trips ({failed} stops failed), {len(known)} already stored. Retrieving the routes of the others...")
+	added = 0
+	with ThreadPoolExecutor(max_workers=args.workers) as executor:
+		futures = {executor.submit(get_route, *trip): trip for trip in trips}
+		for future in as_completed(futures):
+			line, direction, race = futures[future]
+			line_code, service_day = trips[futures[future]]
+			if future.exception() is not None or not future.result():
+				print(f"Could not get the route of trip {race} of line {line}: {future.exception()!r}")
+				continue
+			store.add_trip(service_day, line, line_code, direction, race, future.result(), today)
+			added += 1
+
+	purged = store.purge(today - datetime.timedelta(days=args.purge_days))
+	print(f"Added {added} trips, purged {purged} departures no longer seen. The timetable has {len(store)} departures.")
+	store.close()
+	print(f"All OK!")
@@ -0,0 +1,148 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import json
+import re
+import unicodedata
+from collections import Counter
+
+EXACT_SCORE = 1.0
+PREFIX_SCORE = 0.8
+FUZZY_SCORE = 0.6
+MIN_FUZZY_SIMILARITY = 0.4
+MAX_PREFIX_EXPANSIONS = 256
+
+def normalize(text: str) -> list[str]:
+  """
+  Split text into lowercase, accent-free alphanumeric tokens.
+  """
+  text = unicodedata.normalize("NFKD", text or "")
+  text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+  return re.findall(r"[a-z0-9]+", text)
+
+def trigrams(token: str) -> set[str]:
+  padded = f"  {token} "
+  return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class StopIndex:
+  """
+  In-process full text index over stop names and codes.
+
+  Every query token is matched exactly, as a prefix of an indexed token or,
+  failing both, by trigram similarity to tolerate typos. Tokens with digits,
+  e.g. stop codes, are only matched exactly or as a prefix, as similar
+  numbers are unrelated stops rather than typos. A stop matches a
+  query if all of its tokens match; stops are ranked by match quality.
+  Results have the same shape as the ones of `api.get_stops_by_keyword`.
+  """
+
+  def __init__(self, stops: list[tuple[str, str]]):
+    self.stops = stops
+    self.names = dict(stops)
+    self.postings = {}
+    for i, (code, name) in enumerate(stops):
+      for token in set(normalize(name)) | {code.lower()}:
+        self.postings.setdefault(token, []).append(i)
+    self.tokens = sorted(self.postings)
+    self.trigrams = {}
+    for token in self.tokens:
+      if not token.isalpha():
+        continue
+      for trigram in trigrams(token):
+        self.trigrams.setdefault(trigram, []).append(token)
+    self.lengths = [len(normalize(name)) for _, name in stops]
+
+  def __len__(self):
+    return len(self.stops)
+
+  def get_name(self, code: str) -> str | None:
+    """
+    Name of the stop with exactly the given code, if indexed.
+    """
+    return self.names.get(code)
+
+  @classmethod
+  def from_features(cls, features):
+    """
+    Build the index from the GeoJSON features of the all stops dataset.
+    """
+    return cls([
+      (feature["properties"]["code"], feature["properties"]["name"]) for feature in features
+    ])
+
+  def match_token(self, token: str) -> dict[str, float]:
+    """
+    Return the indexed tokens matching the given query token, with a score.
+    """
+    matches = {}
+    if token in self.postings:
+      matches[token] = EXACT_SCORE
+    if len(token) > 1:
+      start = bisect.bisect_left(self.tokens, token)
+      for candidate in self.tokens[start:start + MAX_PREFIX_EXPANSIONS]:
+        if not candidate.startswith(token):
+          break
+        matches.setdefault(candidate, PREFIX_SCORE)
+    if not matches and len(token) > 2 and token.isalpha():
+      query_trigrams = trigrams(token)
+      shared = Counter(
+        candidate for trigram in query_trigrams for candidate in self.trigrams.get(trigram, ())
+      )
+      for candidate, count in shared.items():
+        similarity = count / (len(query_trigrams) + len(candidate) + 1 - count)
+        if similarity >= MIN_FUZZY_SIMILARITY:
+          matches[candidate] = FUZZY_SCORE * similarity
+    return matches
+
+  def match_stops(self, token: str) -> dict[int, float]:
+    scores = {}
+    for candidate, score in self.match_token(token).items():
+      for i in self.postings[candidate]:
+        if scores.get(i, 0) < score:
+          scores[i] = score
+    return scores
+
+  def search(self, query: str, limit: int = None, allowed: set[str] = None):
+    """
+    Return the stops matching all the tokens of the query, best matches first.
+    If `allowed` is given, only stops whose code is in it are returned.
+    """
+    tokens = normalize(query)
+    if not tokens:
+      return []
+    matches = sorted((self.match_stops(token) for token in set(tokens)), key=len)
+    scores = matches[0]
+    if allowed is not None:
+      scores = {i: score for i, score in scores.items() if self.stops[i][0] in allowed}
+    for other in matches[1:]:
+      scores = {i: score + other[i] for i, score in scores.items() if i in other}
+      if not scores:
+        return []
+    ranked = sorted(scores, key=lambda i: (-scores[i], self.lengths[i], self.stops[i][1]))
+    if limit:
+      ranked = ranked[:limit]
+    return [{
+      "id": self.stops[i][0],
+      "text": self.stops[i][1]
+    } for i in ranked]
+
+def load_stop_index(path: str) -> StopIndex:
+  """
+  Load the index from the all stops GeoJSON dataset saved by the scraper.
+  """
+  with open(path, "r") as f:
+    return StopIndex.from_features(json.loads(f.read())["features"])
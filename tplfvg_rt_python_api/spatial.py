@@ -0,0 +1,132 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import json
+import math
+
+EARTH_RADIUS = 6371000  # meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+def haversine(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+  """
+  Great-circle distance in meters between two (latitude, longitude) points.
+  """
+  phi1 = math.radians(lat1)
+  phi2 = math.radians(lat2)
+  a = math.sin((phi2 - phi1) / 2) ** 2 + \
+    math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+  return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+class SpatialIndex:
+  """
+  Uniform grid over stop positions answering radius and k-nearest queries
+  in-process. Cells are roughly `cell_size` meters wide around the reference
+  latitude, which is more than accurate enough at the scale of a region.
+
+  Results have the same shape as the ones of `api.get_stops_by_location`, with
+  the distance from the query point (in meters) in the `distance` field, and
+  are sorted by it.
+  """
+
+  def __init__(self, stops: list[tuple[str, str, float, float]], cell_size: float = 250, reference_latitude: float = 46.0):
+    self.stops = stops
+    self.cell_size = cell_size
+    self.lat_step = cell_size / METERS_PER_DEGREE
+    self.lng_step = cell_size / (METERS_PER_DEGREE * math.cos(math.radians(reference_latitude)))
+    self.cells = {}
+    for i, (_, _, lat, lng) in enumerate(stops):
+      self.cells.setdefault(self.cell_of(lat, lng), []).append(i)
+
+  def __len__(self):
+    return len(self.stops)
+
+  @classmethod
+  def from_features(cls, features, **kwargs):
+    """
+    Build the index from the GeoJSON features of the all stops dataset.
+    """
+    return cls([(
+      feature["properties"]["code"],
+      feature["properties"]["name"],
+      # GeoJSON points are (longitude, latitude)
+      feature["geometry"]["coordinates"][1],
+      feature["geometry"]["coordinates"][0]
+    ) for feature in features if feature.get("geometry")], **kwargs)
+
+  def cell_of(self, lat: float, lng: float) -> tuple[int, int]:
+    return (math.floor(lat / self.lat_step), math.floor(lng / self.lng_step))
+
+  def result(self, i: int, distance: float) -> dict:
+    return {
+      "id": self.stops[i][0],
+      "text": self.stops[i][1],
+      "distance": distance
+    }
+
+  def ring(self, center: tuple[int, int], n: int, allowed: set[str] = None):
+    """
+    Yield the stops in the cells at Chebyshev distance `n` from `center`,
+    restricted to the `allowed` stop codes if given.
+    """
+    ci, cj = center
+    for i in range(ci - n, ci + n + 1):
+      for j in ((cj - n, cj + n) if abs(i - ci) != n else range(cj - n, cj + n + 1)):
+        for k in self.cells.get((i, j), ()):
+          if allowed is None or self.stops[k][0] in allowed:
+            yield k
+
+  def within(self, lat: float, lng: float, radius: float, limit: int = None, allowed: set[str] = None):
+    """
+    Return the stops within `radius` meters from the given point, closest
+    first, optionally restricted to the `allowed` stop codes.
+    """
+    center = self.cell_of(lat, lng)
+    found = []
+    for n in range(math.ceil(radius / self.cell_size) + 1):
+      for i in self.ring(center, n, allowed):
+        distance = haversine(lat, lng, self.stops[i][2], self.stops[i][3])
+        if distance <= radius:
+          found.append((distance, i))
+    found.sort()
+    if limit:
+      found = found[:limit]
+    return [self.result(i, distance) for distance, i in found]
+
+  def nearest(self, lat: float, lng: float, k: int = 10, max_distance: float = 5000, allowed: set[str] = None):
+    """
+    Return the `k` stops closest to the given point, up to `max_distance`
+    meters away, closest first, optionally restricted to the `allowed` stop
+    codes.
+    """
+    center = self.cell_of(lat, lng)
+    found = []
+    for n in range(math.ceil(max_distance / self.cell_size) + 1):
+      for i in self.ring(center, n, allowed):
+        distance = haversine(lat, lng, self.stops[i][2], self.stops[i][3])
+        if distance <= max_distance:
+          found.append((distance, i))
+      # Anything in outer rings is at least n cells away from the query point
+      if len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= n * self.cell_size:
+        break
+    return [self.result(i, distance) for distance, i in heapq.nsmallest(k, found)]
+
+def load_spatial_index(path: str, **kwargs) -> SpatialIndex:
+  """
+  Load the index from the all stops GeoJSON dataset saved by the scraper.
+  """
+  with open(path, "r") as f:
+    return SpatialIndex.from_features(json.loads(f.read())["features"], **kwargs)
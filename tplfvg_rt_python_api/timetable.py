@@ -0,0 +1,174 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import sqlite3
+
+from .model import RTResult, Route, Monitor
+
+# Service days start at this hour: later trips of the previous day are listed
+# with times past 24:00, as in the RT API timetables
+ROLLOVER_HOUR = 3
+
+# Timetables differ between working days, Saturdays and Sundays/holidays
+WEEKDAY = "feriale"
+SATURDAY = "sabato"
+HOLIDAY = "festivo"
+
+def get_easter(year: int) -> datetime.date:
+  """
+  Date of Easter Sunday in the given year (anonymous Gregorian algorithm).
+  """
+  a, b, c = year % 19, year // 100, year % 100
+  d, e = divmod(b, 4)
+  f = (b + 8) // 25
+  g = (b - f + 1) // 3
+  h = (19 * a + b - d - g + 15) % 30
+  i, k = divmod(c, 4)
+  l = (32 + 2 * e + 2 * i - h - k) % 7
+  m = (a + 11 * h + 22 * l) // 451
+  month, day = divmod(h + l - 7 * m + 114, 31)
+  return datetime.date(year, month, day + 1)
+
+def get_holidays(year: int) -> set[datetime.date]:
+  """
+  National holidays, on which the Sunday timetable applies.
+  """
+  return {
+    datetime.date(year, month, day) for month, day in [
+      (1, 1), (1, 6), (4, 25), (5, 1), (6, 2), (8, 15), (11, 1), (12, 8), (12, 25), (12, 26)
+    ]
+  } | {get_easter(year) + datetime.timedelta(days=1)}
+
+def get_service_day(day: datetime.date) -> str:
+  if day.weekday() == 6 or day in get_holidays(day.year):
+    return HOLIDAY
+  if day.weekday() == 5:
+    return SATURDAY
+  return WEEKDAY
+
+def get_service_date(now: datetime.datetime) -> datetime.date:
+  """
+  Date of the service day in progress at the given time.
+  """
+  return (now - datetime.timedelta(hours=ROLLOVER_HOUR)).date()
+
+def to_minutes(time: int) -> int:
+  """
+  Convert an RT API timetable time (e.g. 2415 for 00:15 of the next day) into
+  minutes since the start of the service date.
+  """
+  return time // 100 * 60 + time % 100
+
+class TimetableStore:
+  """
+  Scheduled departures from every stop, by service day (see
+  `get_service_day`), stored in a SQLite database indexed by stop and time so
+  that the next departures from a stop are a single range scan.
+
+  The store is filled by `scripts/get_timetables.py` with the trips found in
+  the RT API; trips not seen for a while are purged, as timetables change.
+  """
+
+  def __init__(self, path: str, readonly: bool = False):
+    self.path = path
+    if readonly:
+      self.db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+      return
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute(
+      "CREATE TABLE IF NOT EXISTS departures (service_day TEXT NOT NULL, stop_code TEXT NOT NULL, " + \
+        "minute INTEGER NOT NULL, line_code TEXT NOT NULL, race TEXT NOT NULL, line TEXT NOT NULL, " + \
+        "direction TEXT NOT NULL, origin TEXT NOT NULL, destination TEXT NOT NULL, start_minute INTEGER NOT NULL, " + \
+        "is_last INTEGER NOT NULL, seen_on TEXT NOT NULL, " + \
+        "PRIMARY KEY (service_day, stop_code, minute, line_code, race)) WITHOUT ROWID"
+    )
+    self.db.execute("CREATE INDEX IF NOT EXISTS departures_by_trip ON departures (service_day, line_code, race)")
+
+  def __len__(self):
+    return self.db.execute("SELECT COUNT(*) FROM departures").fetchone()[0]
+
+  def add_trip(self, service_day: str, line: str, line_code: str, direction: str, race: str, route: Route, seen_on: datetime.date):
+    """
+    Store the departures of a trip from each stop of its route.
+    """
+    if not route:
+      return
+    # Times are kept increasing along the trip, for trips crossing midnight
+    # listed with times wrapping around to 00:00
+    minutes = []
+    for stop in route:
+      minute = to_minutes(stop.time)
+      while minutes and minute < minutes[-1]:
+        minute += 24 * 60
+      minutes.append(minute)
+    origin, destination = route[0].stop_description, route[-1].stop_description
+    with self.db:
+      self.db.executemany(
+        "INSERT OR REPLACE INTO departures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(
+          service_day, stop.stop_code, minute, line_code, race, line, direction,
+          origin, destination, minutes[0], i == len(route) - 1, seen_on.isoformat()
+        ) for i, (stop, minute) in enumerate(zip(route, minutes))]
+      )
+
+  def mark_seen(self, service_day: str, line_code: str, race: str, seen_on: datetime.date) -> bool:
+    """
+    Mark the departures of a stored trip as seen on the given date, returning
+    whether the trip was stored at all.
+    """
+    with self.db:
+      return self.db.execute(
+        "UPDATE departures SET seen_on = ? WHERE service_day = ? AND line_code = ? AND race = ?",
+        (seen_on.isoformat(), service_day, line_code, race)
+      ).rowcount > 0
+
+  def purge(self, seen_before: datetime.date) -> int:
+    """
+    Drop the departures of trips not seen since the given date.
+    """
+    with self.db:
+      return self.db.execute("DELETE FROM departures WHERE seen_on < ?", (seen_before.isoformat(),)).rowcount
+
+  def get_departures(self, stop_code: str, service_date: datetime.date, after: int, limit: int) -> Monitor:
+    midnight = datetime.datetime.combine(service_date, datetime.time())
+    rows = self.db.execute(
+      "SELECT minute, line_code, race, line, direction, origin, destination, start_minute, is_last FROM departures " + \
+        "WHERE service_day = ? AND stop_code = ? AND minute >= ? ORDER BY minute LIMIT ?",
+      (get_service_day(service_date), stop_code, after, limit)
+    ).fetchall()
+    return Monitor([RTResult(
+      line, midnight + datetime.timedelta(minutes=start_minute), destination,
+      midnight + datetime.timedelta(minutes=minute), "", direction, line_code, "", origin, "", race,
+      0.0, 0.0, "", bool(is_last)
+    ) for minute, line_code, race, line, direction, origin, destination, start_minute, is_last in rows])
+
+  def next_departures(self, stop_code: str, now: datetime.datetime = None, limit: int = 8) -> Monitor:
+    """
+    Next scheduled departures from the given stop, as a Monitor flagged as
+    `scheduled`, continuing into the next service day if needed.
+    """
+    now = now or datetime.datetime.now()
+    service_date = get_service_date(now)
+    minute = (now - datetime.datetime.combine(service_date, datetime.time())) // datetime.timedelta(minutes=1)
+    departures = self.get_departures(stop_code, service_date, minute, limit)
+    if len(departures) < limit:
+      departures += self.get_departures(stop_code, service_date + datetime.timedelta(days=1), 0, limit - len(departures))
+    return Monitor(departures, now, scheduled=True)
+
+  def close(self):
+    self.db.close()
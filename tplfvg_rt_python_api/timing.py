@@ -0,0 +1,68 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextvars
+import functools
+import os
+import time
+
+# Phases of the updates profiled by the bot (see `profiling`), kept free of
+# dependencies so that any module can be timed
+ENABLED = os.environ.get("TPLFVG_PROFILE", "0") == "1"
+
+class UpdateProfile:
+  """
+  Time spent in each phase while processing an update. Phases running in
+  concurrent tasks (e.g. upstream requests for several stops) add up, so
+  their sum can exceed the total.
+  """
+
+  def __init__(self):
+    self.phases = {}
+    self.calls = {}
+    self.active = set()
+
+  def add(self, phase: str, duration: float):
+    self.phases[phase] = self.phases.get(phase, 0.0) + duration
+    self.calls[phase] = self.calls.get(phase, 0) + 1
+
+current_profile: contextvars.ContextVar[UpdateProfile | None] = contextvars.ContextVar("current_profile", default=None)
+
+def timed(phase: str):
+  """
+  Decorator recording the time spent in a (synchronous) function under the
+  given phase of the update being profiled. Nested calls within the same
+  phase are only counted once. When profiling is disabled, the function is
+  returned unchanged.
+  """
+  def decorator(f):
+    if not ENABLED:
+      return f
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+      profile = current_profile.get()
+      if profile is None or phase in profile.active:
+        return f(*args, **kwargs)
+      profile.active.add(phase)
+      start = time.perf_counter()
+      try:
+        return f(*args, **kwargs)
+      finally:
+        profile.active.discard(phase)
+        profile.add(phase, time.perf_counter() - start)
+    return wrapper
+  return decorator
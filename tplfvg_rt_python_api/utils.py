@@ -14,11 +14,42 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import logging
 import math
+import os
 import requests
-
-API_URL = "https://tplfvg.it/services/bus-stops/"
-RT_API_URL = "https://realtime.tplfvg.it/API/v1.0/"
+import time
+
+try:
+  # Optional faster drop-in for decoding response bodies
+  from orjson import loads as json_loads
+except ImportError:
+  from json import loads as json_loads
+
+from .cache import MISSING, get_rt_cache, make_cache_key
+from .metrics import measure
+
+logger = logging.getLogger(__name__)
+
+# Both can be pointed elsewhere, e.g. to a local stand-in for benchmarks
+API_URL = os.environ.get("TPLFVG_API_URL", "https://tplfvg.it/services/bus-stops/")
+RT_API_URL = os.environ.get("TPLFVG_RT_API_URL", "https://realtime.tplfvg.it/API/v1.0/")
+
+# (connect, read) timeouts in seconds, so that an unresponsive upstream never
+# blocks a caller indefinitely
+REQUEST_TIMEOUT = (5.0, 10.0)
+
+API_HEADERS = {
+  "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0",
+  "Accept": "application/json, text/plain, */*",
+  "Referer": "https://realtime.tplfvg.it/",
+  "X-Requested-With": "XMLHttpRequest"
+}
+RT_API_HEADERS = {
+  "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0",
+  "Accept": "application/json, text/plain, */*",
+  "Referer": "https://realtime.tplfvg.it/"
+}
 
 def get_destination_point(lat, lon, bearing, distance):
   """
@@ -64,24 +95,25 @@ def make_api_request(endpoint, headers={}, method="POST", data=None):
   (if any).
 
   The response body is returned as a string, as it is primarily meant to be
-  parsed by geojson. Exceptions are logged on stdout and None is returned in
-  case one is thrown.
+  parsed by geojson. Exceptions are logged and None is returned in case one is
+  thrown. Requests are timed and counted in `metrics`.
   """
   try:
-    return requests.request(
-      method=method,
-      url=API_URL + endpoint + ("" if endpoint.endswith("/") else "/"),
-      headers={
-        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0",
-        "Accept": "application/json, text/plain, */*",
-        "Referer": "https://realtime.tplfvg.it/",
-        "X-Requested-With": "XMLHttpRequest",
-        **headers
-      },
-      data=data
-    ).text
+    with measure(endpoint.strip("/")) as m:
+      response = requests.request(
+        method=method,
+        url=API_URL + endpoint + ("" if endpoint.endswith("/") else "/"),
+        headers={
+          **API_HEADERS,
+          **headers
+        },
+        data=data,
+        timeout=REQUEST_TIMEOUT
+      )
+      m["status"] = response.status_code
+    return response.text
   except Exception as e:
-    print(e)
+    logger.warning("Request to %s failed: %r", endpoint, e)
   return None
 
 def make_rt_api_request(endpoint, headers={}, method="POST", data=None, params=None):
@@ -93,22 +125,35 @@ def make_rt_api_request(endpoint, headers={}, method="POST", data=None, params=N
   (if any). Query parameters are sent as they are provided.
 
   The response body is returned as a json object, given it is the response type
-  for all calls of this API. Exceptions are logged on stdout and None is 
-  returned in case one is thrown.
+  for all calls of this API. GET requests to cached endpoints are served from
+  the shared cache when possible. Exceptions are logged and None is returned
+  in case one is thrown. Requests sent upstream are timed and counted
+  in `metrics`.
   """
+  cache = get_rt_cache(endpoint) if method == "GET" else None
+  if cache is not None:
+    cached = cache.get(make_cache_key(params), MISSING)
+    if cached is not MISSING:
+      # Cached values are [fetch time, response body], see `async_utils`
+      return cached[1]
   try:
-    return requests.request(
-      method=method,
-      url=RT_API_URL + endpoint + ("" if endpoint.endswith("/") else "/"),
-      headers={
-        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0",
-        "Accept": "application/json, text/plain, */*",
-        "Referer": "https://realtime.tplfvg.it/",
-        **headers
-      },
-      data=data,
-      params=params
-    ).json()
+    with measure(endpoint.strip("/")) as m:
+      response = requests.request(
+        method=method,
+        url=RT_API_URL + endpoint + ("" if endpoint.endswith("/") else "/"),
+        headers={
+          **RT_API_HEADERS,
+          **headers
+        },
+        data=data,
+        params=params,
+        timeout=REQUEST_TIMEOUT
+      )
+      m["status"] = response.status_code
+    result = json_loads(response.content)
+    if cache is not None:
+      cache.put(make_cache_key(params), [time.time(), result])
+    return result
   except Exception as e:
-    print(e)
+    logger.warning("Request to %s failed: %r", endpoint, e)
   return None
\ No newline at end of file
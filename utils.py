@@ -14,65 +14,333 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
 import json
+import os
 import re
-from datetime import datetime
+import sqlite3
+from datetime import datetime, timedelta
 
 from telegram import Message, MessageEntity, Update
 from telegram.helpers import escape_markdown
 from telegram.constants import MessageLimit
 
-from tplfvg_rt_python_api.model import RTResult, StopInfo, RouteStop
-
-lines_by_stop = {}
-try:
-  with open("tplfvg_rt_python_api/local/lines_by_stop.json", "r") as stf:
-    lines_by_stop = json.loads(stf.read())
-    for stop in lines_by_stop:
-      lines = []
-      [lines.append(line) for line in lines_by_stop[stop]["lines"] if line['guideline_public_code'] not in [
-        l['guideline_public_code'] for l in lines
-      ]]
-      lines_by_stop[stop] = {
-        "lines": lines,
-        "zones": lines_by_stop[stop]["zones"]
-      }
-except Exception as e:
-  print(f"Warning: could not load lines by stop: {e!r}")
+from tplfvg_rt_python_api.model import RTResult, StopInfo, RouteStop, Route, Monitor
+from tplfvg_rt_python_api.async_api import get_stop_monitor
+from tplfvg_rt_python_api.cache import TTLCache
+from tplfvg_rt_python_api.lines import LinesByStop, load_lines_by_stop
+from tplfvg_rt_python_api.search import StopIndex
+from tplfvg_rt_python_api.spatial import SpatialIndex
+from tplfvg_rt_python_api.timetable import TimetableStore
+from tplfvg_rt_python_api.timing import timed
 
+LOCAL_FILES_DIR = "tplfvg_rt_python_api/local"
+LINES_BY_STOP_FILES = [f"{LOCAL_FILES_DIR}/lines_by_stop.bin", f"{LOCAL_FILES_DIR}/lines_by_stop.json"]
+ALL_STOPS_FILE = f"{LOCAL_FILES_DIR}/all_stops.json"
+TIMETABLE_FILE = os.environ.get("TPLFVG_TIMETABLE_FILE", f"{LOCAL_FILES_DIR}/timetable.sqlite")
+# Stops whose next scheduled departure is further away than this (in minutes)
+# are answered from the timetable alone, as no realtime data is available yet
+# that far ahead. 0 always queries the RT API
+TIMETABLE_HORIZON = float(os.environ.get("TPLFVG_TIMETABLE_HORIZON", 60))
+TIMETABLE_DEPARTURES = int(os.environ.get("TPLFVG_TIMETABLE_DEPARTURES", 8))
+
+lines_by_stop: LinesByStop | None = None
+stop_index: StopIndex | None = None
+spatial_index: SpatialIndex | None = None
+# (stop code, long) -> (stop name, lines fragment), rendered on first use
+line_fragments: dict[tuple[str, bool], tuple[str | None, str]] = {}
+dataset_version = None
+
+def get_dataset_version():
+  """
+  Modification times of the local dataset files, used to detect refreshes.
+  """
+  return tuple(
+    os.stat(path).st_mtime_ns if os.path.exists(path) else None
+    for path in [*LINES_BY_STOP_FILES, ALL_STOPS_FILE]
+  )
+
+def render_lines(lines: list[tuple[str, str]], stop_name: str | None, long: bool) -> str:
+  """
+  MarkdownV2 list of the lines calling at a stop, either as a line per line
+  with its destination seen from the stop (long) or as a row of line codes.
+  """
+  if long:
+    return "\n" + "\n".join([
+      f"*{escape_markdown(code, version=2)}* ⇒ {escape_markdown(description.split(" - ")[-1] if description.split(" - ")[-1] != stop_name else description.split(" - ")[0], version=2)}" for code, description in lines
+    ]) + "\n"
+  return "\n_Linee:_ " + " \\- ".join([
+    f"*{escape_markdown(code, version=2)}*" for code, _ in lines
+  ]) + "\n"
+
+def load_dataset() -> dict:
+  """
+  Load the local dataset files written by the scraper. Parts that could not be
+  loaded are missing from the returned dict.
+  """
+  dataset = {"version": get_dataset_version()}
+  try:
+    # Prefer the compact artifact built by the scraper over the raw dataset
+    dataset["lines_by_stop"] = load_lines_by_stop(
+      LINES_BY_STOP_FILES[0] if os.path.exists(LINES_BY_STOP_FILES[0]) else LINES_BY_STOP_FILES[1]
+    )
+  except Exception as e:
+    print(f"Warning: could not load lines by stop: {e!r}")
+
+  try:
+    with open(ALL_STOPS_FILE, "r") as asf:
+      all_stops = json.loads(asf.read())["features"]
+    dataset["stop_index"] = StopIndex.from_features(all_stops)
+    dataset["spatial_index"] = SpatialIndex.from_features(all_stops)
+  except Exception as e:
+    print(f"Warning: could not load local stop indexes, falling back to remote search: {e!r}")
+  return dataset
+
+def install_dataset(dataset: dict):
+  """
+  Swap in a dataset returned by `load_dataset`. Parts missing from it keep
+  their current value, so that a failed reload never unloads data.
+  """
+  global lines_by_stop, line_fragments, stop_index, spatial_index, dataset_version
+  lines_by_stop = dataset.get("lines_by_stop", lines_by_stop)
+  if "lines_by_stop" in dataset:
+    line_fragments = {}
+  stop_index = dataset.get("stop_index", stop_index)
+  spatial_index = dataset.get("spatial_index", spatial_index)
+  dataset_version = dataset["version"]
+
+async def watch_dataset(interval: float = 60):
+  """
+  Reload the dataset whenever its files change. Loading happens in a worker
+  thread, while the swap itself happens on the event loop between updates,
+  so that handlers always see either the old or the new dataset.
+  """
+  while True:
+    await asyncio.sleep(interval)
+    if get_dataset_version() != dataset_version:
+      print("Local dataset changed, reloading...")
+      install_dataset(await asyncio.to_thread(load_dataset))
+
+install_dataset(load_dataset())
+
+timetable: TimetableStore | None = None
+# Learns the demand for each stop from the requests for its departures, see
+# `warmer.CacheWarmer`
+warmer = None
+
+def get_scheduled_departures(stop_code: str) -> Monitor | None:
+  """
+  Next departures from a stop according to the local timetable, None if the
+  timetable is not available or has none. The timetable is opened once the
+  scraper has built it, and is read in place, so its updates are seen live.
+  """
+  global timetable
+  try:
+    if timetable is None:
+      if not os.path.exists(TIMETABLE_FILE):
+        return None
+      timetable = TimetableStore(TIMETABLE_FILE, readonly=True)
+    return timetable.next_departures(stop_code, limit=TIMETABLE_DEPARTURES) or None
+  except sqlite3.Error as e:
+    print(f"Warning: could not query the timetable: {e!r}")
+    return None
+
+async def get_departures(stop_code: str, timeout: float = None) -> Monitor | None:
+  """
+  Departures from a stop, from the RT API when realtime data may be available
+  and from the local timetable otherwise (see `TIMETABLE_HORIZON`) or when
+  the RT API cannot be reached. Scheduled departures the RT API did not
+  return, e.g. later ones, are merged into its results.
+  """
+  if warmer is not None:
+    warmer.record(stop_code)
+  scheduled = get_scheduled_departures(stop_code)
+  if scheduled and TIMETABLE_HORIZON and get_arrival_minutes(scheduled[0]) > TIMETABLE_HORIZON:
+    return scheduled
+  try:
+    monitor = await asyncio.wait_for(get_stop_monitor(stop_code), timeout)
+  except asyncio.TimeoutError:
+    monitor = None
+  if monitor is None:
+    return scheduled
+  if not scheduled:
+    return monitor
+  # Realtime results win over the scheduled departures of the same trips
+  realtime = {get_trip_key(r) for r in monitor}
+  stop = {"id": stop_code}
+  merged = merge_departures([stop, stop], [monitor, [r for r in scheduled if get_trip_key(r) not in realtime]])
+  return Monitor([r for _, r in merged][:max(len(monitor), TIMETABLE_DEPARTURES)], monitor.fetched_at)
+
+# Monitors fetched longer ago than this (in seconds) were served stale, as
+# the RT API could not be reached, and are flagged as such
+STALE_MONITOR_AGE = 60
+
+def get_monitor_age(monitor: list[RTResult]) -> float:
+  """
+  Seconds since the given monitor was fetched from the RT API.
+  """
+  fetched_at = getattr(monitor, "fetched_at", None)
+  return (datetime.now() - fetched_at).total_seconds() if fetched_at else 0
+
+def format_monitor_age(monitor: list[RTResult]) -> str:
+  """
+  Footer of a stop monitor with the time it was fetched at, warning about
+  stale results.
+  """
+  if getattr(monitor, "scheduled", False):
+    return "\n\n🗓 _Orari programmati: nessun dato in tempo reale disponibile al momento_\\."
+  fetched_at = getattr(monitor, "fetched_at", None) or datetime.now()
+  footer = f"\n\n_Aggiornato alle {fetched_at.strftime('%H:%M')} del {fetched_at.strftime('%d/%m/%Y')}_\\."
+  if get_monitor_age(monitor) > STALE_MONITOR_AGE:
+    footer += f"\n⚠️ _Il servizio in tempo reale non risponde: i passaggi mostrati risalgono a {round(get_monitor_age(monitor) / 60)} minuti fa_\\."
+  return footer
+
+# Rendered stop monitors (without their footer), by stop and fetch time: a
+# monitor served from the cache to many users is only formatted once
+rendered_monitors = TTLCache(ttl=60, maxsize=2048)
+
+def format_departure_time(r: RTResult) -> str:
+  return r.arrival_time.strftime('%H:%M') if type(r.arrival_time) == datetime else r.arrival_time
+
+@timed("render")
 def format_stop_monitor(stop: str, query: str, monitor: list[RTResult]) -> str:
-  number_emojis = {
-    '0': "\U00000030\U000020E3",
-    '1': "\U00000031\U000020E3",
-    '2': "\U00000032\U000020E3",
-    '3': "\U00000033\U000020E3",
-    '4': "\U00000034\U000020E3",
-    '5': "\U00000035\U000020E3",
-    '6': "\U00000036\U000020E3",
-    '7': "\U00000037\U000020E3",
-    '8': "\U00000038\U000020E3",
-    '9': "\U00000039\U000020E3"
-  }
-  return f"🚏 /{query} *{escape_markdown(stop, version=2)}*\n\n>Prossimi passaggi \\(in tempo reale se segnalato con ✱\\):\n\n" + "\n".join([
-    f"*Linea {r.line_code}* ⇒ {escape_markdown(r.destination, version=2)}" + (f" \\[{escape_markdown(r.notes, version=2)}\\]" if r.notes else "") + (" _\\[ultima fermata di questa corsa\\]_" if r.is_destination else "") + "\n" + \
-      ("\\(✱\\)  " if r.vehicle else "") + f"{r.arrival_time.strftime('%H:%m') if type(r.arrival_time) == datetime else r.arrival_time}" + ("\n_succ\\._ " if r.next_passes else "") + escape_markdown(r.next_passes, version=2) + "\n" for r in monitor
-  ]) + f"\n\n_Aggiornato alle {datetime.now().strftime('%H:%M')} del {datetime.now().strftime('%d/%m/%Y')}_\\."
+  # Scheduled monitors are built on every request, so they are not cached
+  fetched_at = None if getattr(monitor, "scheduled", False) else getattr(monitor, "fetched_at", None)
+  key = (query, stop, fetched_at)
+  body = rendered_monitors.get(key) if fetched_at else None
+  if body is None:
+    body = f"🚏 /{query} *{escape_markdown(stop, version=2)}*\n\n>Prossimi passaggi \\(in tempo reale se segnalato con ✱\\):\n\n" + "\n".join([
+      f"*Linea {escape_markdown(r.line_code, version=2)}* ⇒ {escape_markdown(r.destination, version=2)}" + (f" \\[{escape_markdown(r.notes, version=2)}\\]" if r.notes else "") + (" _\\[ultima fermata di questa corsa\\]_" if r.is_destination else "") + "\n" + \
+        ("\\(✱\\)  " if r.vehicle else "") + escape_markdown(format_departure_time(r), version=2) + ("\n_succ\\._ " if r.next_passes else "") + escape_markdown(r.next_passes, version=2) + "\n" for r in monitor
+    ])
+    if fetched_at:
+      rendered_monitors.put(key, body)
+  # The footer depends on the current time, as it flags stale results
+  return body + format_monitor_age(monitor)
+
+@timed("render")
+def format_dashboard_stop(stop: str, query: str, monitor: list[RTResult] | None, departures: int = 3) -> str:
+  """
+  Format the next few departures from a stop as a section of the favourite
+  stops dashboard. A None monitor means the stop could not be queried in time.
+  """
+  header = f"🚏 /{query} *{escape_markdown(stop, version=2)}*"
+  if getattr(monitor, "scheduled", False):
+    header += " 🗓 _orari programmati_"
+  elif monitor and get_monitor_age(monitor) > STALE_MONITOR_AGE:
+    header += f" ⚠️ _dati di {round(get_monitor_age(monitor) / 60)} minuti fa_"
+  header += "\n"
+  if monitor is None:
+    return header + "_Passaggi non disponibili al momento_"
+  if not monitor:
+    return header + "_Nessun passaggio previsto_"
+  return header + "\n".join([
+    ("✱ " if r.vehicle else "") + f"*{escape_markdown(r.line_code, version=2)}* ⇒ {escape_markdown(r.destination, version=2)} " + \
+      escape_markdown(format_departure_time(r), version=2)
+    for r in monitor[:departures]
+  ])
+
+def get_arrival_minutes(r: RTResult, now: datetime = None) -> float:
+  """
+  Minutes until the arrival of a monitor result, whether given as a datetime,
+  as minutes (e.g. "5'") or as a time label (e.g. "14:05"). Other labels are
+  only shown for imminent arrivals, so they count as arriving now.
+  """
+  now = now or datetime.now()
+  if isinstance(r.arrival_time, datetime):
+    return (r.arrival_time - now).total_seconds() / 60
+  if match := re.match(r"\s*(\d+)\s*'", r.arrival_time):
+    return int(match[1])
+  if match := re.match(r"\s*(\d{1,2})[:.](\d{2})\b", r.arrival_time):
+    arrival = now.replace(hour=int(match[1]) % 24, minute=int(match[2]), second=0, microsecond=0)
+    if arrival < now - timedelta(hours=1):
+      arrival += timedelta(days=1)
+    return (arrival - now).total_seconds() / 60
+  return 0
+
+def get_trip_key(r: RTResult) -> tuple:
+  return (r.line, r.direction, r.trip or r.departure_time)
+
+def merge_departures(stops: list[dict], monitors: list[list[RTResult] | None]) -> list[tuple[dict, RTResult]]:
+  """
+  Merge the monitors of the given stops into a single list of (stop, result)
+  sorted by arrival time. A trip calling at more than one of the stops is only
+  kept at the stop it reaches first (or at the closest one, on ties).
+  """
+  now = datetime.now()
+  departures = sorted([
+    (get_arrival_minutes(r, now), stop.get("distance") or 0, i, stop, r)
+    for i, (stop, monitor) in enumerate(zip(stops, monitors)) for r in monitor or []
+  ], key=lambda departure: departure[:3])
+  seen = set()
+  merged = []
+  for _, _, _, stop, r in departures:
+    key = get_trip_key(r)
+    if key in seen:
+      continue
+    seen.add(key)
+    merged.append((stop, r))
+  return merged
+
+@timed("render")
+def format_nearby_departure(stop: dict, r: RTResult) -> str:
+  """
+  Format a departure of the nearby departures board, along with the stop it
+  calls at.
+  """
+  return ("✱ " if r.vehicle else "") + \
+    f"*Linea {escape_markdown(r.line_code, version=2)}* ⇒ {escape_markdown(r.destination, version=2)} " + \
+    escape_markdown(format_departure_time(r), version=2) + \
+    f"\n  da {format_stop_result(stop)}"
 
+@timed("render")
+def pack_sections(sections: list[str], header: str = "", separator: str = "\n\n") -> list[str]:
+  """
+  Join the given sections into as few messages as possible, never splitting a
+  section across messages unless it is too long by itself, and split the
+  resulting messages further if they exceed the entity limit.
+  """
+  msgs = []
+  current = header
+  for section in sections:
+    candidate = current + (separator if current and current != header else "") + section
+    if len(candidate) <= MessageLimit.MAX_TEXT_LENGTH or current in ("", header):
+      current = candidate
+    else:
+      msgs.append(current)
+      current = section
+  if current:
+    msgs.append(current)
+  return [chunk for msg in msgs for chunk in split_entities_if_needed(msg)]
+
+@timed("render")
 def format_lines_for_stop(stop_code, stop_name, long=False):
   if not lines_by_stop:
     return ""
+  fragment = line_fragments.get((stop_code, long))
+  # The long fragment depends on the stop name it was rendered for
+  if fragment is not None and (not long or fragment[0] == stop_name):
+    return fragment[1]
   if not (lines := lines_by_stop.get(stop_code)):
     return "\n_Nessuna linea trovata_\n"
-  lines = lines["lines"]
-  return "\n" + ("\n".join([
-    f"*{escape_markdown(line['guideline_public_code'], version=2)}* ⇒ {escape_markdown(line['public_description'].split(" - ")[-1] if line['public_description'].split(" - ")[-1] != stop_name else line['public_description'].split(" - ")[0], version=2)}" for line in lines
-  ]) if long else "_Linee:_ " + " \\- ".join([
-    f"*{escape_markdown(line['guideline_public_code'], version=2)}*" for line in lines
-  ])) + "\n"
-
-def format_line_route(code: str, info: StopInfo, route: list[RouteStop]):
+  rendered = render_lines(lines, stop_name, long)
+  line_fragments[(stop_code, long)] = (stop_name, rendered)
+  return rendered
+
+def format_stop_result(result: dict) -> str:
+  """
+  Format a stop search result as a command to query the stop, followed by
+  its name and, for stops found by location, its distance.
+  """
+  return f"/{escape_markdown(result['id'], version=2)} {escape_markdown(result['text'], version=2)}" + \
+    (f" \\({round(result['distance'])} m\\)" if result.get("distance") is not None else "")
+
+@timed("render")
+def format_line_route(code: str, info: StopInfo, route: Route):
   line, line_code, trip_direction, trip_id, stop_code, trip_arrival_time = code.split("|")
-  current_stop_idx = [stop.stop_code for stop in route].index(info.stop_code)
+  current_stop_idx = route.index_of(info.stop_code)
+  if current_stop_idx is None:
+    current_stop_idx = -1
   return f"🚍 *Linea {escape_markdown(line_code, version=2)} • Corsa {trip_id}*\n\n" + \
     f">Percorso completo corsa\n\n" + "\n".join([
       ("┏ " if i == 0 else "┗ " if i == len(route) - 1 else ("┃ " if i > current_stop_idx else ("┋ " if i < current_stop_idx else "┏ "))) + \
@@ -88,33 +356,115 @@ def format_line_route(code: str, info: StopInfo, route: list[RouteStop]):
       for i, stop in enumerate(route)
     ]) 
 
-def split_entities_if_needed(msg: str):
+# Tokens relevant to entity counting: escaped characters (skipped), line and
+# paragraph breaks (candidate split points), code and pre markers, blockquote
+# markers at the start of a line, formatting markers, links and commands
+ENTITY_TOKENS = re.compile(r"\\.|\n\n?|```|`|(?m:^)(?:\*\*)?>|\|\||__|[*_~]|\[|\]\((?:\\.|[^\\)])*\)|(?<!\S)/\w+")
+CONTINUED_SUFFIX = "\n\n⇓ _prosegue nel prossimo messaggio_ ⇓"
+
+@timed("render")
+def split_entities_if_needed(msg: str) -> list[str]:
   """
   Solve the annoying entity limit issue: an undocumented Telegram limit for bot messages is apparently
   the number of entities (formatting, commands and so on) in a single message. Commands are always preferred
-  over formatting, which just gets lost after the hard limit is reached. To circumvent this, entities are
-  searched for in the final message in to find the last allowed one and the message is recursively split into
-  two parts in order for all remaining entities to be parsed as well. 
+  over formatting, which just gets lost after the hard limit is reached. To circumvent this, the message is
+  scanned once, counting entities as they are opened, and split before the limit is hit (leaving room for the
+  continuation notice) at the last paragraph break outside of any formatting or, lacking one, at the last
+  line break. Code and pre blocks, links and (expandable) blockquotes are never split.
 
-  This function returns a list of message strings.  
+  This function returns a list of message strings.
   """
-  entities_match = re.search(r"([\_\*/]).*\1*", msg)
-  
+  chunks = []
   start = 0
-  ecount = 0
-  while entities_match:
-    start += entities_match.end()
-    ecount += 1
-    if ecount > MessageLimit.MESSAGE_ENTITIES:
-      break
-    entities_match = re.search(r"([\_\*/]).*?\1+", msg[start + 1:])
-  else:
-    return [msg]
-
-  last_parsed_entity_end = start
-  prev_break = msg[:last_parsed_entity_end].rfind("\n\n")
-  return [msg[:prev_break] + "\n\n⇓ _prosegue nel prossimo messaggio_ ⇓", *split_entities_if_needed(msg[prev_break:])]
+  count = 0
+  open_markers = set()
+  # Marker of the code or pre block being scanned, within which nothing else
+  # is parsed, and of the blockquote, which goes on while lines start with ">"
+  code = quote = None
+  # Last paragraph and line breaks of the current chunk outside of any
+  # formatting, as (position, length, entities before it)
+  paragraph_break = line_break = None
+  for token in ENTITY_TOKENS.finditer(msg):
+    text = token.group()
+    if text[0] == "\\":
+      continue
+    if code:
+      if text == code:
+        code = None
+      continue
+    if text[0] == "\n":
+      if quote and not msg.startswith(">", token.end()):
+        quote = None
+      # Splitting before the first entity of the chunk would be pointless
+      if not open_markers and not quote and count:
+        if text == "\n\n":
+          paragraph_break = (token.start(), 2, count)
+        line_break = (token.start(), len(text), count)
+      continue
+    if text[-1] == ">":
+      if quote:
+        continue
+      quote = text
+    elif text == "||" and quote == "**>" and (msg.startswith("\n", token.end()) or token.end() == len(msg)):
+      # End of an expandable blockquote, rather than a spoiler
+      continue
+    elif text[0] == "`":
+      code = text
+    elif text[0] == "]":
+      open_markers.discard("[")
+      continue
+    elif text in open_markers:
+      open_markers.remove(text)
+      continue
+    elif text[0] != "/":
+      open_markers.add(text)
+    count += 1
+    split = paragraph_break or line_break
+    if count > MessageLimit.MESSAGE_ENTITIES - 1 and split:
+      position, length, before = split
+      chunks.append(msg[start:position] + CONTINUED_SUFFIX)
+      start = position + length
+      count -= before
+      paragraph_break = line_break = None
+  chunks.append(msg[start:])
+  return chunks
+
+@timed("render")
+def format_stops_list(results: list[dict], header: str = "Fermate trovate:\n\n") -> list[str]:
+  """
+  Format stop search results as a list of messages, using the richest variant
+  that fits in a single message: with the lines calling at each stop and their
+  destinations, with the line codes only or with no lines at all. Variants are
+  rendered one result at a time and abandoned as soon as they get too long.
+
+  An empty list is returned if not even the shortest variant fits.
+  """
+  stops = [format_stop_result(result) for result in results]
+  for long in (True, False, None):
+    length = len(header) - 1
+    fragments = []
+    for stop, result in zip(stops, results):
+      fragment = stop if long is None else stop + format_lines_for_stop(result["id"], result["text"], long)
+      length += len(fragment) + 1
+      if length > MessageLimit.MAX_TEXT_LENGTH:
+        break
+      fragments.append(fragment)
+    else:
+      return split_entities_if_needed(header + "\n".join(fragments))
+  return []
+
+def get_stops_in_zones(zones: list[str]):
+  """
+  Codes of the stops served in any of the given zones, or None if no zone is
+  given or zones are unknown since lines by stop could not be loaded.
+  """
+  if not zones or not lines_by_stop:
+    return None
+  return lines_by_stop.stops_in_zones(zones)
 
 def filter_stops_by_zone(stops: list, zones: list[str]):
   # return [stop for stop in list(filter(lambda stop: zone in [z[-1] for z in lines_by_stop[stop['id']]["zone"]], stops)) for zone in zones]
-  return [stop for stop in stops if [z for z in lines_by_stop[stop['id']]["zones"] if z[-1] in zones]]
\ No newline at end of file
+  allowed = get_stops_in_zones(zones)
+  if allowed is None:
+    return stops
+  return [stop for stop in stops if stop['id'] in allowed]
\ No newline at end of file
@@ -0,0 +1,243 @@
+# tg-tplfvg: Python Telegram Bot for TPLFVG's public transit services 
+# Copyright (C) 2024 Andrea Esposito <aespositox@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import datetime
+import json
+import os
+import time
+
+from tplfvg_rt_python_api.async_api import get_cached_ttl, get_stop_monitor_params, get_stop_info_params
+from tplfvg_rt_python_api.async_utils import fetch_rt_api_response
+from tplfvg_rt_python_api.breaker import get_breaker
+from tplfvg_rt_python_api.timetable import get_service_date, get_service_day
+
+# Demand is counted in time of day slots of this many minutes
+SLOT_MINUTES = 15
+# Stops referenced by the sessions are counted again this often (in seconds)
+REFS_INTERVAL = 60 * 60
+# Upstream requests made by the warmer at the same time, so that it never
+# takes up the slots of the requests made for users
+CONCURRENCY = 4
+
+class CacheWarmer:
+  """
+  Prefetches the stop monitors (and stop information) users are about to ask
+  for, so that the first requests of a rush are served from the cache.
+
+  Requests for each stop are counted by service day (see
+  `timetable.get_service_day`) and time of day, in slots of `SLOT_MINUTES`.
+  Counts decay by `decay` every day, so that they follow changing habits.
+  Stops in the users' favourites and recents also get a `prior` share of
+  the overall demand at each time of day, per user, so that they are warmed
+  before their own demand has been learned.
+
+  Every `interval` seconds, the stops expecting at least `min_demand`
+  requests over the next `lead` minutes are refreshed, busiest first, as
+  their cached monitor is about to expire. At most `budget` upstream calls
+  per minute are made, and none while the RT API circuit is not closed.
+  Responses another process already refreshed in the shared cache are not
+  counted as calls.
+  """
+
+  def __init__(self, sessions, budget: float = 30, interval: float = 10, lead: float = 15, decay: float = 0.9,
+      prior: float = 0.5, min_demand: float = 1.0):
+    self.sessions = sessions
+    self.budget = budget
+    self.interval = interval
+    self.lead = lead
+    self.decay = decay
+    self.prior = prior
+    self.min_demand = min_demand
+    # stop_code -> "service day/slot" -> decayed number of requests
+    self.demand = {}
+    # "service day/slot" -> decayed number of requests for any stop
+    self.activity = collections.Counter()
+    # stop_code -> number of sessions with the stop in favourites or recents
+    self.refs = collections.Counter()
+    self.refs_updated = None
+    self.decayed_on = None
+    # Times of the upstream calls made in the last minute
+    self.calls = collections.deque()
+    # Monitors refreshed ahead of their expiry
+    self.warmed = 0
+    self.task = None
+
+  def stats(self) -> dict:
+    return {
+      "stops": len(self.demand),
+      "warmed": self.warmed,
+      "calls_last_minute": len(self.calls)
+    }
+
+  def get_slot(self, when: datetime.datetime) -> str:
+    service_date = get_service_date(when)
+    return f"{get_service_day(service_date)}/{(when.hour * 60 + when.minute) // SLOT_MINUTES}"
+
+  def record(self, stop_code: str, when: datetime.datetime = None):
+    """
+    Count a request for the departures from the given stop.
+    """
+    slot = self.get_slot(when or datetime.datetime.now())
+    slots = self.demand.setdefault(stop_code, {})
+    slots[slot] = slots.get(slot, 0) + 1
+    self.activity[slot] += 1
+
+  def update_refs(self):
+    refs = collections.Counter()
+    for session in self.sessions.iter_sessions():
+      stops = {stop for stop, name in (session.get("fav_stops") or {}).items() if name}
+      stops.update(
+        (recent_stop[1:] if recent_stop.startswith("/") else recent_stop).split(" ")[0]
+        for recent_stop in session.get("recent_stops") or []
+      )
+      refs.update(stops)
+    self.refs = refs
+    self.refs_updated = time.monotonic()
+
+  def rollover(self, now: datetime.datetime):
+    """
+    Decay the demand once per service day elapsed since it was last decayed.
+    """
+    today = get_service_date(now)
+    if self.decayed_on == today:
+      return
+    if self.decayed_on is not None:
+      factor = self.decay ** max((today - self.decayed_on).days, 1)
+      for stop_code in list(self.demand):
+        slots = {slot: count * factor for slot, count in self.demand[stop_code].items() if count * factor >= 0.01}
+        if slots:
+          self.demand[stop_code] = slots
+        else:
+          del self.demand[stop_code]
+      self.update_activity()
+    self.decayed_on = today
+
+  def update_activity(self):
+    self.activity = collections.Counter()
+    for slots in self.demand.values():
+      self.activity.update(slots)
+
+  def get_expected_demand(self, now: datetime.datetime) -> list[tuple[float, str]]:
+    """
+    Expected requests for each stop over the next `lead` minutes, busiest
+    stops first.
+    """
+    slots = list(dict.fromkeys(
+      self.get_slot(now + datetime.timedelta(minutes=minutes))
+      for minutes in range(0, int(self.lead) + 1, SLOT_MINUTES)
+    ))
+    busiest = max(self.activity.values(), default=0)
+    # Overall demand over the next minutes relative to the busiest slot
+    share = sum(self.activity[slot] for slot in slots) / busiest if busiest else 0
+    expected = [(
+      sum(self.demand.get(stop_code, {}).get(slot, 0) for slot in slots) + self.prior * self.refs[stop_code] * share,
+      stop_code
+    ) for stop_code in self.demand.keys() | self.refs.keys()]
+    expected.sort(reverse=True)
+    return expected
+
+  async def tick(self):
+    """
+    Refresh the cached monitors of the busiest stops within the call budget.
+    """
+    now = datetime.datetime.now()
+    self.rollover(now)
+    if self.refs_updated is None or time.monotonic() - self.refs_updated > REFS_INTERVAL:
+      self.update_refs()
+    if get_breaker("polemonitor/mrcruns").state != "closed":
+      return
+
+    while self.calls and self.calls[0] <= time.monotonic() - 60:
+      self.calls.popleft()
+    allowance = int(self.budget - len(self.calls))
+    monitors = []
+    for demand, stop_code in self.get_expected_demand(now):
+      if demand < self.min_demand or len(monitors) >= allowance:
+        break
+      # Monitors still fresh at the next tick can wait for it
+      if get_cached_ttl("polemonitor/mrcruns", get_stop_monitor_params(stop_code)) <= self.interval:
+        monitors.append(stop_code)
+    infos = [
+      stop_code for stop_code in monitors
+      if not get_cached_ttl("polemonitor/info", get_stop_info_params(stop_code))
+    ][:allowance - len(monitors)]
+    if not monitors:
+      return
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def warm(endpoint, params, refresh=False) -> bool:
+      """
+      Fetch a response, returning whether it was fetched during the call.
+      """
+      async with semaphore:
+        started = time.time()
+        result, fetched_at = await fetch_rt_api_response(endpoint, method="GET", params=params, refresh=refresh)
+        # Failed requests went upstream too, responses found in the shared
+        # cache did not
+        if result is None or fetched_at >= started:
+          self.calls.append(time.monotonic())
+        return result is not None and fetched_at >= started
+
+    refreshed = await asyncio.gather(
+      *[warm("polemonitor/mrcruns", get_stop_monitor_params(stop_code), True) for stop_code in monitors],
+      *[warm("polemonitor/info", get_stop_info_params(stop_code)) for stop_code in infos],
+      return_exceptions=True
+    )
+    self.warmed += sum(result is True for result in refreshed[:len(monitors)])
+
+  def start(self):
+    if self.task is None:
+      self.task = asyncio.get_running_loop().create_task(self.run())
+
+  async def close(self):
+    if self.task is not None:
+      self.task.cancel()
+      try:
+        await self.task
+      except asyncio.CancelledError:
+        pass
+      self.task = None
+
+  async def run(self):
+    while True:
+      await asyncio.sleep(self.interval)
+      try:
+        await self.tick()
+      except Exception as e:
+        print(f"Warning: could not warm the stop monitors cache: {e!r}")
+
+  def save(self, path: str):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+      json.dump({
+        "decayed_on": self.decayed_on.isoformat() if self.decayed_on else None,
+        "demand": self.demand
+      }, f)
+    os.replace(tmp, path)
+
+  def load(self, path: str) -> int:
+    """
+    Load the demand saved by `save`, returning the number of stops in it.
+    """
+    with open(path, "r") as f:
+      saved = json.load(f)
+    self.demand = saved["demand"]
+    self.decayed_on = datetime.date.fromisoformat(saved["decayed_on"]) if saved["decayed_on"] else None
+    self.update_activity()
+    return len(self.demand)